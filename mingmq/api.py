@@ -24,6 +24,8 @@ from flask_httpauth import HTTPBasicAuth
 from mingmq.client import Pool
 from mingmq.settings import CONFIG_FILE
 from mingmq.db import AckProcessDB
+from mingmq.compress import decode
+from mingmq.metrics import render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 from gevent.pywsgi import WSGIServer
 from gevent import monkey
@@ -103,7 +105,7 @@ def get_message_data():
     message_id = request.form['message_id']
     ack_msg = AckProcessDB(_ACK_PROCESS_DB_FILE)
 
-    return { 'data': ack_msg.get_message_data_by_message_id(message_id) }
+    return { 'data': decode(ack_msg.get_message_data_by_message_id(message_id)) }
 
 
 @_APP.route('/', methods=['GET'])
@@ -246,7 +248,10 @@ def get():
     global _USER_NAME, _PASSWD, _POOL
     queue_name = request.args.get('queue_name')
     result = _POOL.opera('get_data_from_queue', *(queue_name,))
-    if result: return result
+    if result:
+        for task in result['json_obj']:
+            if task and 'message_data' in task: task['message_data'] = decode(task['message_data'])
+        return result
 
 
 @_APP.route('/put', methods=['POST'])
@@ -329,6 +334,32 @@ def get_all():
     if result: return result
 
 
+@_APP.route('/metrics')
+@_AUTH.login_required
+def metrics():
+    """prometheus格式的监控指标，需要用户登陆后才能访问，访问地址为"/metrics"。
+
+    包括队列的任务数和内存占用，未确认的任务数，send/get/ack/redeliver/expire
+    的累计次数和速度，投递和确认的延迟直方图，命令耗时直方图，连接数，以及发送给
+    持久化进程的数据量，指标的说明见mingmq.metrics。
+
+    Examples.
+
+    成功::
+
+        # HELP mingmq_queue_messages 队列中的任务数
+        # TYPE mingmq_queue_messages gauge
+        mingmq_queue_messages{queue="11"} 128
+        ...
+
+    """
+    global _POOL
+    result = _POOL.opera('get_stat')
+    if not result or result['status'] != 1:
+        return Response('GET_STAT失败\n', status=503, mimetype='text/plain')
+    return Response(render_metrics(result['json_obj'][0]), content_type=METRICS_CONTENT_TYPE)
+
+
 @_APP.route('/clear')
 @_AUTH.login_required
 def clear():
@@ -518,7 +549,8 @@ def delete_ack_message():
 @_APP.route('/get_resend_interval', methods=['POST'])
 @_AUTH.login_required
 def get_resend_interval():
-    """获取重发未确认任务的时间间隔RESEND_INTERVAL的值。
+    """获取重发未确认任务的时间间隔RESEND_INTERVAL的值，这个值是从MingMQ
+    服务器中实时获取的。
 
     用户需要登录，并且访问"/get_resend_interval"。
 
@@ -534,19 +566,22 @@ def get_resend_interval():
             "json_obj": [{
                             "resend_interval": xxx
                         }],
-            "status": 1
+            "status": 1,
+            "type": 18
         }
 
     """
-    config: dict = _load_mingmq_config()
-    resend_interval = config['RESEND_INTERVAL']
-    return {"json_obj": [{"resend_interval": resend_interval}], "status": 1}
+    global _POOL
+    result = _POOL.opera('get_resend_interval')
+    if result: return result
 
 
 @_APP.route('/edit_resend_interval', methods=['POST'])
 @_AUTH.login_required
 def edit_resend_interval():
-    """修改重发未确认任务的时间间隔RESEND_INTERVAL的值。
+    """修改重发未确认任务的时间间隔RESEND_INTERVAL的值。修改会立即通过
+    SET_RESEND_INTERVAL命令通知MingMQ服务器，同时写入配置文件，下次用
+    CONFIG_REUSE启动时仍然有效。
 
     用户需要登录，并且访问"/edit_resend_interval"，并且
     还要带post表单参数，resend_interval。
@@ -570,6 +605,11 @@ def edit_resend_interval():
     if resend_interval < 60:
         return {"json_obj": [], "status": 0}
 
+    global _POOL
+    result = _POOL.opera('set_resend_interval', *(resend_interval,))
+    if not result or result['status'] != 1:
+        return {"json_obj": [], "status": 0}
+
     config: dict = _load_mingmq_config()
     config['RESEND_INTERVAL'] = resend_interval
     _dump_mingmq_config(config)
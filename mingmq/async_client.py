@@ -0,0 +1,634 @@
+"""为MingMQ提供一个基于asyncio的客户端驱动，适合在aiohttp等异步框架中使用，
+不再需要用run_in_executor包装同步的Client而浪费线程；
+
+* AsyncClient封装了对MingMQ的各种操作，同一个连接上可以同时发出多个请求(流水线)
+* AsyncPool维护少量的AsyncClient，把请求分散到请求最少的连接上
+* AsyncProducer异步生产者，支持批量发送任务
+* AsyncConsumer异步消费者，支持async for，批量确认任务
+
+服务器对同一个连接上的请求是按顺序处理、按顺序响应的，所以AsyncClient给
+每个请求分配一个本地的关联ID(correlation id)，按发送顺序保存等待中的请求，
+响应到达时与最早的等待请求匹配。
+
+Command line example:
+
+>>> import asyncio
+>>> from mingmq.async_client import AsyncConsumer
+>>> async def main():
+...     async with AsyncConsumer('localhost', 15673, 'mingmq', 'mm5201314', 'img') as consumer:
+...         async for message_data, message_id in consumer:
+...             print(message_data)
+...             consumer.ack(message_id)
+>>> asyncio.run(main())
+
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import struct
+import traceback
+from collections import OrderedDict
+
+from mingmq.message import (ReqLoginMessage,
+                            SUCCESS, ReqLogoutMessage, ReqDeclareQueueMessage,
+                            ReqGetDataFromQueueMessage, ReqClearQueueMessage,
+                            ReqSendDataToQueueMessage, ReqDeleteQueueMessage,
+                            ReqACKMessage, ReqPingMessage,
+                            ReqGetSpeedMessage, ReqGetStatMessage, FAIL,
+                            ReqSetResendIntervalMessage, ReqGetResendIntervalMessage,
+                            ReqACKMessagesMessage, ReqSendDatasToQueueMessage,
+                            ReqDeclareExchangeMessage, ReqDeleteExchangeMessage,
+                            ReqBindQueueMessage, ReqUnbindQueueMessage, ReqPublishMessage,
+                            ReqReadFromMessage, ReqCommitOffsetMessage)
+from mingmq.utils import to_json
+from mingmq.compress import encode, decode
+from mingmq.client import UNIX_SCHEME, LONG_POLL_TIMEOUT, retry_after
+
+# 单个连接上最多同时等待响应的请求数
+MAX_PENDING = 1000
+# 消费者批量确认的最长间隔，单位秒
+ACK_INTERVAL = 0.1
+
+
+class AsyncClient(object):
+    """
+    异步服务器客户端
+    """
+    logger = logging.getLogger('AsyncClient')
+
+    def __init__(self, host, port, max_pending=MAX_PENDING):
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self._read_task = None
+        self._pending = OrderedDict()
+        self._correlation_ids = itertools.count()
+        self._slots = asyncio.Semaphore(max_pending)
+
+    def is_connected(self):
+        return self._connected
+
+    def pending_num(self):
+        """等待响应的请求数"""
+        return len(self._pending)
+
+    async def connect(self):
+        if self._host.startswith(UNIX_SCHEME):
+            self._reader, self._writer = await asyncio.open_unix_connection(self._host[len(UNIX_SCHEME):])
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        self._connected = True
+        self._read_task = asyncio.ensure_future(self._read_forever())
+
+    async def _read_forever(self):
+        """读取服务器的响应，按顺序交给等待中的请求
+        """
+        try:
+            while True:
+                recv_header = await self._reader.readexactly(4)
+                data_size, = struct.unpack('!i', recv_header)
+                data = await self._reader.readexactly(data_size)
+                msg = to_json(data)
+                self.logger.debug('服务器发送过来的消息[%s]。', repr(msg))
+
+                if not self._pending:
+                    self.logger.error('收到了没有请求对应的响应: %s', repr(msg))
+                    break
+                _, future = self._pending.popitem(last=False)
+                if not future.done():
+                    future.set_result(msg)
+        except asyncio.CancelledError:
+            pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.logger.debug('服务器断开了连接')
+        except Exception:
+            self.logger.error(traceback.format_exc())
+        finally:
+            self._connected = False
+            self._fail_pending()
+
+    def _fail_pending(self):
+        while self._pending:
+            _, future = self._pending.popitem(last=False)
+            if not future.done():
+                future.set_result(False)
+
+    async def _request(self, req_msg):
+        """发送一个请求并等待响应，连接断开时返回False；
+
+        :param req_msg: 请求消息；
+        :type req_msg: dict
+        :return: 响应消息；
+        :rtype: dict
+
+        """
+        async with self._slots:
+            if not self._connected:
+                return False
+
+            req_pkg = json.dumps(req_msg).encode()
+            future = asyncio.get_running_loop().create_future()
+            # 写入和登记必须在同一步完成，中间不能有await，否则响应顺序会错乱
+            self._pending[next(self._correlation_ids)] = future
+            self._writer.write(struct.pack('!i', len(req_pkg)) + req_pkg)
+            try:
+                await self._writer.drain()
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                self._connected = False
+                self._fail_pending()
+            return await future
+
+    async def close(self):
+        """
+        关闭连接
+        """
+        self._connected = False
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                self.logger.debug(traceback.format_exc())
+        if self._read_task:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+        self._fail_pending()
+
+    async def login(self, user_name, passwd):
+        """
+        登录服务器
+        :param user_name: str，帐号
+        :param passwd: str，密码
+        :return: SUCCESS登录成功，FAIL登录失败
+        """
+        msg = await self._request(ReqLoginMessage(user_name, passwd))
+        if msg and msg['status'] == SUCCESS:
+            self._user_name = user_name
+            self._passwd = passwd
+            return SUCCESS
+        return FAIL
+
+    async def logout(self, user_name, passwd):
+        """
+        退出
+        """
+        return await self._request(ReqLogoutMessage(user_name, passwd))
+
+    async def declare_queue(self, queue_name, arguments=None):
+        """
+        声明队列，arguments为{'type': 'stream', ...}时声明流队列
+        """
+        return await self._request(ReqDeclareQueueMessage(queue_name, arguments))
+
+    async def declare_exchange(self, exchange_name, exchange_type='direct'):
+        """
+        声明交换机，exchange_type为direct、fanout或者topic
+        """
+        return await self._request(ReqDeclareExchangeMessage(exchange_name, exchange_type))
+
+    async def delete_exchange(self, exchange_name):
+        """
+        删除交换机
+        """
+        return await self._request(ReqDeleteExchangeMessage(exchange_name))
+
+    async def bind_queue(self, exchange_name, queue_name, routing_key=''):
+        """
+        把队列绑定到交换机，topic交换机的routing_key中可以使用*和#
+        """
+        return await self._request(ReqBindQueueMessage(exchange_name, queue_name, routing_key))
+
+    async def unbind_queue(self, exchange_name, queue_name, routing_key=''):
+        """
+        解除队列和交换机的绑定
+        """
+        return await self._request(ReqUnbindQueueMessage(exchange_name, queue_name, routing_key))
+
+    async def publish(self, exchange_name, routing_key, message_data):
+        """
+        向交换机发布任务，json_obj中是每个目标队列的queue_name和message_id
+        """
+        return await self._request(ReqPublishMessage(exchange_name, routing_key, message_data))
+
+    async def read_from(self, queue_name, offset=None, max_count=100, consumer_group=None):
+        """
+        从流队列的offset开始读取任务，offset为None时从consumer_group提交的位置开始
+        """
+        return await self._request(ReqReadFromMessage(queue_name, offset, max_count, consumer_group))
+
+    async def commit_offset(self, queue_name, consumer_group, offset):
+        """
+        提交消费组在流队列中下一次要读取的位置
+        """
+        return await self._request(ReqCommitOffsetMessage(queue_name, consumer_group, offset))
+
+    async def get_data_from_queue(self, queue_name, timeout=None):
+        """
+        从队列中获取数据，带timeout时队列为空或者被限速由服务器等待最多timeout秒，
+        有任务就立即返回
+        """
+        return await self._request(ReqGetDataFromQueueMessage(queue_name, timeout))
+
+    async def send_data_to_queue(self, queue_name: str, message_data: str, dedup_key: str = None,
+                                 unique_key: str = None):
+        """
+        向队列中发送数据，带dedup_key时去重窗口内重复的数据不会再放入队列，可以放心重试；
+        唯一键队列中unique_key(默认为message_data)见过的数据不会再放入队列
+        """
+        return await self._request(ReqSendDataToQueueMessage(queue_name, message_data, dedup_key, unique_key))
+
+    async def send_datas_to_queue(self, queue_name: str, message_datas: list):
+        """
+        向队列中批量发送数据，json_obj中按顺序返回每条数据的message_id
+        """
+        return await self._request(ReqSendDatasToQueueMessage(queue_name, message_datas))
+
+    async def ack_message(self, queue_name: str, message_id: str):
+        """
+        消息确认
+        """
+        return await self._request(ReqACKMessage(queue_name, message_id))
+
+    async def ack_messages(self, queue_name: str, message_ids: list):
+        """
+        批量消息确认，json_obj中是确认失败的message_id
+        """
+        return await self._request(ReqACKMessagesMessage(queue_name, message_ids))
+
+    async def del_queue(self, queue_name):
+        """
+        删除队列
+        """
+        return await self._request(ReqDeleteQueueMessage(queue_name))
+
+    async def clear_queue(self, queue_name):
+        """
+        清空队列
+        """
+        return await self._request(ReqClearQueueMessage(queue_name))
+
+    async def get_speed(self, queue_name):
+        """
+        获取队列速度
+        """
+        return await self._request(ReqGetSpeedMessage(queue_name))
+
+    async def get_stat(self):
+        """
+        获取统计数据
+        """
+        return await self._request(ReqGetStatMessage())
+
+    async def set_resend_interval(self, resend_interval):
+        """
+        修改重发未确认任务的时间间隔，单位秒
+        """
+        return await self._request(ReqSetResendIntervalMessage(resend_interval))
+
+    async def get_resend_interval(self):
+        """
+        获取重发未确认任务的时间间隔
+        """
+        return await self._request(ReqGetResendIntervalMessage())
+
+    async def ping(self):
+        return await self._request(ReqPingMessage())
+
+
+class AsyncPool(object):
+    """异步连接池。因为每个连接都可以流水线发送请求，所以不需要很多连接，
+    请求会被分配到等待响应最少的连接上；
+
+    """
+    _logger = logging.getLogger('AsyncPool')
+
+    def __init__(self, host, port, user_name, passwd, size):
+        """保存连接信息，调用init()后才会真正创建连接；
+
+        :param host: 服务器主机地址；
+        :type host: str
+        :param port: 服务器端口；
+        :type port: int
+        :param user_name: 用户名；
+        :type user_name: str
+        :param passwd: 密码；
+        :type passwd: str
+        :param size: 连接池大小；
+        :type size: int
+        """
+        self._host = host
+        self._port = port
+        self._user_name = user_name
+        self._passwd = passwd
+        self._size = size
+        self._conns = []
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    async def _create_conn(self):
+        cli = AsyncClient(self._host, self._port)
+        await cli.connect()
+        if await cli.login(self._user_name, self._passwd) != SUCCESS:
+            await cli.close()
+            raise Exception('登录失败')
+        return cli
+
+    async def init(self):
+        """创建连接并登录；
+
+        """
+        self._conns = list(await asyncio.gather(*[self._create_conn() for _ in range(self._size)]))
+
+    async def get_conn(self):
+        """返回等待响应最少的连接，断开的连接会被重新创建；
+
+        :return: client连接；
+        :rtype: AsyncClient
+
+        """
+        i, conn = min(enumerate(self._conns), key=lambda item: item[1].pending_num())
+        if not conn.is_connected():
+            self._logger.debug('连接已断开，重新连接: %d', i)
+            await conn.close()
+            conn = await self._create_conn()
+            self._conns[i] = conn
+        return conn
+
+    async def opera(self, method_name, *args):
+        """用来向服务器发送请求，和Pool.opera一样，失败时返回None；
+
+        :param method_name: 方法名；
+        :type method_name: str
+        :param args: 方法名方法的参数；
+        :type args: 可变参数
+
+        :return: 方法名调用后返回的结果；
+        :rtype: dict
+
+        """
+        try:
+            conn = await self.get_conn()
+            result = await getattr(conn, method_name)(*args)
+            if result: return result
+            self._logger.debug('返回数据：%s', repr(result))
+        except Exception:
+            self._logger.error(traceback.format_exc())
+
+    async def release(self):
+        """关闭连接池中所有连接；
+
+        """
+        for conn in self._conns:
+            try:
+                await conn.close()
+            except Exception:
+                self._logger.error(traceback.format_exc())
+        self._conns = []
+
+
+class AsyncProducer(object):
+    """异步生产者，用于发送消息到指定队列
+    """
+
+    def __init__(self, host, port, user_name, passwd, task_queue_name, size=1, compress_threshold=None, codec=None):
+        """初始化生产者
+
+        :param compress_threshold: 设置后，json序列化后超过这个长度的数据会被压缩，
+                消费者会自动解压，见mingmq.compress；
+        :type compress_threshold: int
+        :param codec: 压缩算法名，默认使用当前环境中最好的算法；
+        :type codec: str
+        """
+        self._task_queue_name = task_queue_name
+        self._compress_threshold = compress_threshold
+        self._codec = codec
+        self._mingmq_pool = AsyncPool(host, port, user_name, passwd, size)
+        self._log = logging.getLogger('AsyncProducer')
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    async def init(self):
+        await self._mingmq_pool.init()
+        await self._mingmq_pool.opera('declare_queue', self._task_queue_name)
+
+    def _encode(self, task_data):
+        json_obj = json.dumps(task_data)
+        if self._compress_threshold is not None:
+            json_obj = encode(json_obj, self._codec, self._compress_threshold)
+        return json_obj
+
+    async def _send(self, command, message_data):
+        # 服务器内存超过高水位时按照retry_after等待后重新发送
+        while True:
+            result = await self._mingmq_pool.opera(command, self._task_queue_name, message_data)
+            wait = retry_after(result)
+            if wait is None:
+                return result
+            self._log.warning('服务器内存超过高水位，%s秒后重新发送', wait)
+            await asyncio.sleep(wait)
+
+    async def send_task(self, task_data):
+        """发送数据到消息队列中
+
+        :param task_data: 数据，会被json序列化
+        """
+        result = await self._send('send_data_to_queue', self._encode(task_data))
+        if result is None or result['status'] != SUCCESS:
+            raise Exception('发送任务到消息队列中失败！')
+        self._log.debug('发送数据到消息队列中成功: queue=%s, data=%s', self._task_queue_name, task_data)
+
+    async def send_tasks(self, task_datas, batch_size=500):
+        """批量发送数据到消息队列中，每batch_size条数据一个SEND_DATAS_TO_QUEUE请求，
+        所有请求流水线发送，不等待上一批的响应
+
+        :param task_datas: 数据列表，每条都会被json序列化
+        :param batch_size: 每个请求的数据条数
+        :type batch_size: int
+        """
+        message_datas = [self._encode(task_data) for task_data in task_datas]
+        results = await asyncio.gather(*[
+            self._send('send_datas_to_queue', message_datas[i:i + batch_size])
+            for i in range(0, len(message_datas), batch_size)
+        ])
+        failed = sum(1 for result in results if result is None or result['status'] != SUCCESS)
+        if failed:
+            raise Exception('发送任务到消息队列中失败：%d批' % failed)
+        self._log.debug('批量发送数据到消息队列中成功: queue=%s, count=%d', self._task_queue_name, len(results))
+
+    async def release(self):
+        await self._mingmq_pool.release()
+
+
+class AsyncConsumer(object):
+    """异步消费者，后台任务流水线预取prefetch个任务，用async for逐个取出，
+    处理完后调用ack()，确认会被攒成一批发送；
+
+    队列为空时在单独的连接上长轮询，服务器挂起长轮询的请求期间不读取这个连接
+    后面的请求，不能和预取、确认共用连接；
+
+    """
+
+    def __init__(self, host, port, user_name, passwd, task_queue_name, prefetch=10,
+                 ack_batch_size=100, size=1):
+        """初始化消费者
+
+        :param task_queue_name: 任务队列名
+        :type task_queue_name: str
+        :param prefetch: 本地缓冲的任务数；
+        :type prefetch: int
+        :param ack_batch_size: 一次最多确认的任务数；
+        :type ack_batch_size: int
+        :param size: 预取和确认用的连接数，长轮询另外使用一个连接；
+        :type size: int
+        """
+        self._task_queue_name = task_queue_name
+        self._prefetch = prefetch
+        self._ack_batch_size = ack_batch_size
+        self._mingmq_pool = AsyncPool(host, port, user_name, passwd, size)
+        self._wait_pool = AsyncPool(host, port, user_name, passwd, 1)
+
+        self._buffer = None
+        self._acks = []
+        self._ack_event = None
+        self._tasks = []
+
+        self._log = logging.getLogger('AsyncConsumer')
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        :return: (message_data, message_id)
+        :rtype: tuple
+        """
+        return await self._buffer.get()
+
+    async def init(self):
+        await self._mingmq_pool.init()
+        await self._wait_pool.init()
+        await self._mingmq_pool.opera('declare_queue', self._task_queue_name)
+
+        self._buffer = asyncio.Queue(self._prefetch)
+        self._ack_event = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._fetch_forever()),
+                       asyncio.ensure_future(self._ack_forever())]
+
+    async def _fetch_forever(self):
+        """缓冲区有多少空位，就同时发出多少个获取任务的请求，一个也没有取到时
+        长轮询等待下一个任务
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            free = max(self._prefetch - self._buffer.qsize(), 1)
+            results = await asyncio.gather(*[
+                self._mingmq_pool.opera('get_data_from_queue', self._task_queue_name) for _ in range(free)
+            ])
+
+            got = 0
+            for mq_res in results:
+                if mq_res and mq_res['status'] == SUCCESS:
+                    got += 1
+                    task = mq_res['json_obj'][0]
+                    await self._buffer.put((decode(task['message_data']), task['message_id']))
+
+            if got == 0:
+                # 队列为空或者被限速，由服务器挂起请求，有任务或者超时的时候再返回
+                start = loop.time()
+                mq_res = await self._wait_pool.opera('get_data_from_queue', self._task_queue_name,
+                                                     LONG_POLL_TIMEOUT)
+                if mq_res and mq_res['status'] == SUCCESS:
+                    task = mq_res['json_obj'][0]
+                    await self._buffer.put((decode(task['message_data']), task['message_id']))
+                elif loop.time() - start < LONG_POLL_TIMEOUT / 2:
+                    # 队列不存在或者连接断开时马上返回，等一个长轮询的时间
+                    await asyncio.sleep(retry_after(mq_res) or LONG_POLL_TIMEOUT)
+
+    def ack(self, message_id):
+        """登记一个处理完的任务，由后台任务批量确认；
+
+        :param message_id: 任务ID；
+        :type message_id: str
+
+        """
+        self._acks.append(message_id)
+        if len(self._acks) >= self._ack_batch_size:
+            self._ack_event.set()
+
+    async def flush_acks(self):
+        """立刻确认所有登记的任务；
+
+        """
+        while self._acks:
+            message_ids = self._acks[:self._ack_batch_size]
+            del self._acks[:self._ack_batch_size]
+
+            msg = await self._mingmq_pool.opera('ack_messages', self._task_queue_name, message_ids)
+            if msg and msg['status'] == SUCCESS:
+                self._log.debug('确认消息成功: %s, %d', self._task_queue_name, len(message_ids))
+            else:
+                self._log.debug('确认消息失败: %s, %s', self._task_queue_name, repr(msg))
+
+    async def _ack_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ack_event.wait(), ACK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._ack_event.clear()
+            await self.flush_acks()
+
+    async def serv_forever(self, func, concurrency=10):
+        """用concurrency个协程处理任务，回调函数正常返回后确认任务
+
+        :param func: 回调协程函数，async def callback(message_data, message_id)
+        :param concurrency: 同时处理的任务数
+        :type concurrency: int
+        """
+        async def worker():
+            async for message_data, message_id in self:
+                try:
+                    await func(message_data, message_id)
+                    self.ack(message_id)
+                except Exception:
+                    self._log.error(traceback.format_exc())
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    async def release(self):
+        """停止预取，确认剩余的任务，然后关闭连接；
+        缓冲区中还没有处理的任务不会被确认，超时后由服务器重新投递
+
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush_acks()
+        await self._mingmq_pool.release()
+        await self._wait_pool.release()
@@ -0,0 +1,436 @@
+"""MingMQ的基准测试和压力生成工具，对应命令mmbench。
+
+默认会在临时目录中启动一个本地服务器(包括持久化进程)，也可以用--HOST和
+--PORT指定一个已经在运行的服务器。每个场景都会输出吞吐量和延迟的百分位数，
+结果是JSON格式，可以保存下来和其它提交的结果做比较::
+
+    $ mmbench --SCENARIOS publish,consume --MESSAGES 20000 > before.json
+
+场景:
+
+* ``publish``: 只发送；
+* ``consume``: 预先填满队列，然后只获取和确认；
+* ``mixed``: 同时发送、获取和确认；
+* ``large``: 大消息的发送和获取；
+* ``idle``: 保持大量空闲连接，测量活动连接的延迟、服务器内存和每个空闲连接的Handler占用的内存；
+* ``recovery``: 写入后重启服务器，测量从快照和日志恢复的时间，只支持本地服务器；
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from multiprocessing import Process
+from threading import Thread
+
+from mingmq.channel import BatchChannel
+from mingmq.client import Client
+from mingmq.handler import Handler, Broker
+from mingmq.memory import QueueMemory, TaskAckMemory, StatMemory
+from mingmq.message import (ACK_PROCESS_MESSAGE_FIELDS, COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS, SUCCESS,
+                            ReqLoginMessage)
+from mingmq.process import MQProcess, AckProcess, CompletelyPersistentProcess
+from mingmq.status import ServerStatus
+
+SCENARIOS = ('publish', 'consume', 'mixed', 'large', 'idle', 'recovery')
+
+LOGGER = logging.getLogger('Bench')
+
+
+def percentiles(samples):
+    """计算延迟的百分位数，单位毫秒；
+
+    :param samples: 延迟，单位秒；
+    :type samples: list
+    :rtype: dict
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    n = len(samples)
+
+    def at(p):
+        return round(samples[min(n - 1, int(p * n))] * 1000, 3)
+
+    return {
+        'p50': at(0.5),
+        'p90': at(0.9),
+        'p99': at(0.99),
+        'p999': at(0.999),
+        'max': round(samples[-1] * 1000, 3),
+        'mean': round(sum(samples) / n * 1000, 3)
+    }
+
+
+def handler_footprint(n=200):
+    """在当前进程中创建n个已经登录的空闲连接，用tracemalloc测量每个连接的Handler
+    和客户端地址占用的Python堆内存，不包括socket对象和内核的缓冲区；
+
+    :rtype: float，字节
+    """
+    server_status = ServerStatus('', 0, 1, 'mingmq', 'mm5201314', 1)
+    broker = Broker(QueueMemory(), TaskAckMemory(), StatMemory(), server_status,
+                    BatchChannel(COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS), BatchChannel(ACK_PROCESS_MESSAGE_FIELDS))
+    login = json.dumps(ReqLoginMessage('mingmq', 'mm5201314')).encode()
+    pairs = [socket.socketpair() for _ in range(n)]
+    handlers = [None] * n
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i, (server_sock, _) in enumerate(pairs):
+            handler = Handler(server_sock, ('127.0.%d.%d' % (i // 256, i % 256), 40000 + i), broker)
+            handler._deal_message(login)
+            handlers[i] = handler
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+    return round(size / n, 1)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid):
+    """读取进程的常驻内存，只支持linux；"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+
+
+class LocalServer:
+    """在临时目录中启动的服务器，包括两个持久化进程和快照目录；
+    """
+
+    def __init__(self, user_name, passwd, work_dir=None):
+        self._user_name = user_name
+        self._passwd = passwd
+        self._own_dir = work_dir is None
+        self._work_dir = work_dir or tempfile.mkdtemp(prefix='mmbench')
+        self.host = '127.0.0.1'
+        self.port = _free_port()
+        self._processes = []
+
+    def start(self):
+        snapshot_dir = os.path.join(self._work_dir, 'snapshot')
+        ack_db_file = os.path.join(self._work_dir, 'ack_process_db_file.db')
+        cpp_db_file = os.path.join(self._work_dir, 'completely_persistent_process_db_file.db')
+
+        server_status = ServerStatus(self.host, self.port, 1024, self._user_name, self._passwd, 1,
+                                     snapshot_dir if sys.platform.startswith('linux') else None)
+        completely_persistent_process_queue = BatchChannel(COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS)
+        ack_process_queue = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS)
+
+        ackp = AckProcess(ack_db_file, self.host, self.port, self._user_name, self._passwd, ack_process_queue)
+        cpp = CompletelyPersistentProcess(cpp_db_file, completely_persistent_process_queue,
+                                          self.host, self.port, self._user_name, self._passwd)
+        mmserver = MQProcess(server_status, completely_persistent_process_queue, ack_process_queue)
+
+        self._processes = [Process(target=mmserver.serv_forever, name='mq_process', daemon=True),
+                           Process(target=ackp.serv_forever, name='ack_process', daemon=True),
+                           Process(target=cpp.serv_forever, name='completely_persistent_process', daemon=True)]
+        for p in self._processes:
+            p.start()
+        self.wait_ready()
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                cli = Client(self.host, self.port)
+                ok = cli.login(self._user_name, self._passwd) == SUCCESS
+                cli.close()
+                if ok: return
+            except OSError:
+                pass
+            time.sleep(0.01)
+        raise Exception('本地服务器启动超时')
+
+    def server_pid(self):
+        return self._processes[0].pid
+
+    def stop(self):
+        for p in self._processes:
+            p.terminate()
+        for p in self._processes:
+            p.join()
+        self._processes = []
+
+    def cleanup(self):
+        if self._own_dir:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+
+
+class Bench:
+    def __init__(self, host, port, user_name, passwd, messages, size, concurrency, large_size,
+                 idle_connections, local_server=None):
+        self._host = host
+        self._port = port
+        self._user_name = user_name
+        self._passwd = passwd
+        self._messages = messages
+        self._size = size
+        self._concurrency = concurrency
+        self._large_size = large_size
+        self._idle_connections = idle_connections
+        self._local_server = local_server
+
+    def _client(self):
+        cli = Client(self._host, self._port)
+        if cli.login(self._user_name, self._passwd) != SUCCESS:
+            raise Exception('登录失败')
+        return cli
+
+    def _fresh_queue(self, queue_name):
+        cli = self._client()
+        cli.declare_queue(queue_name)
+        cli.clear_queue(queue_name)
+        cli.close()
+
+    def _fill(self, queue_name, n, payload, batch_size=500):
+        cli = self._client()
+        for i in range(0, n, batch_size):
+            cli.send_datas_to_queue(queue_name, [payload] * min(batch_size, n - i))
+        cli.close()
+
+    def _run_threads(self, targets):
+        """启动线程并等待结束，返回耗时；
+
+        """
+        ts = [Thread(target=target) for target in targets]
+        start = time.time()
+        for t in ts: t.start()
+        for t in ts: t.join()
+        return time.time() - start
+
+    def _split(self, n):
+        return [n // self._concurrency + (1 if i < n % self._concurrency else 0) for i in range(self._concurrency)]
+
+    def _publisher(self, queue_name, n, payload, latencies):
+        def run():
+            cli = self._client()
+            for _ in range(n):
+                start = time.perf_counter()
+                cli.send_data_to_queue(queue_name, payload)
+                latencies.append(time.perf_counter() - start)
+            cli.close()
+        return run
+
+    def _consumer(self, queue_name, n, get_latencies, ack_latencies, counter, timeout=60):
+        def run():
+            cli = self._client()
+            got = 0
+            deadline = time.time() + timeout
+            while got < n and time.time() < deadline:
+                start = time.perf_counter()
+                res = cli.get_data_from_queue(queue_name)
+                if not res or res['status'] != SUCCESS:
+                    time.sleep(0.001)
+                    continue
+                get_latencies.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                cli.ack_message(queue_name, res['json_obj'][0]['message_id'])
+                ack_latencies.append(time.perf_counter() - start)
+                got += 1
+            counter.append(got)
+            cli.close()
+        return run
+
+    def _result(self, ops, seconds, **latencies):
+        result = {
+            'ops': ops,
+            'seconds': round(seconds, 3),
+            'throughput': round(ops / seconds, 1) if seconds else None,
+        }
+        for name, samples in latencies.items():
+            result[name + '_latency_ms'] = percentiles(samples)
+        return result
+
+    def publish(self, size=None, messages=None):
+        queue_name = 'mmbench_publish'
+        self._fresh_queue(queue_name)
+        payload = 'x' * (size or self._size)
+        latencies = []
+        seconds = self._run_threads([self._publisher(queue_name, n, payload, latencies)
+                                     for n in self._split(messages or self._messages)])
+        return self._result(len(latencies), seconds, send=latencies)
+
+    def consume(self, size=None, messages=None):
+        queue_name = 'mmbench_consume'
+        messages = messages or self._messages
+        self._fresh_queue(queue_name)
+        self._fill(queue_name, messages, 'x' * (size or self._size))
+
+        get_latencies, ack_latencies, counter = [], [], []
+        seconds = self._run_threads([self._consumer(queue_name, n, get_latencies, ack_latencies, counter)
+                                     for n in self._split(messages)])
+        return self._result(sum(counter), seconds, get=get_latencies, ack=ack_latencies)
+
+    def mixed(self):
+        queue_name = 'mmbench_mixed'
+        self._fresh_queue(queue_name)
+        payload = 'x' * self._size
+
+        send_latencies, get_latencies, ack_latencies, counter = [], [], [], []
+        targets = [self._publisher(queue_name, n, payload, send_latencies) for n in self._split(self._messages)]
+        targets += [self._consumer(queue_name, n, get_latencies, ack_latencies, counter)
+                    for n in self._split(self._messages)]
+        seconds = self._run_threads(targets)
+        return self._result(len(send_latencies) + sum(counter), seconds,
+                            send=send_latencies, get=get_latencies, ack=ack_latencies)
+
+    def large(self):
+        messages = max(1, self._messages // 100)
+        return {
+            'size': self._large_size,
+            'publish': self.publish(self._large_size, messages),
+            'consume': self.consume(self._large_size, messages)
+        }
+
+    def idle(self):
+        pid = self._local_server.server_pid() if self._local_server else None
+        rss_before = _rss_kb(pid) if pid else None
+
+        idle_clients = []
+        try:
+            for _ in range(self._idle_connections):
+                idle_clients.append(self._client())
+            rss_after = _rss_kb(pid) if pid else None
+
+            cli = self._client()
+            latencies = []
+            start = time.time()
+            for _ in range(min(self._messages, 10000)):
+                t = time.perf_counter()
+                cli.ping()
+                latencies.append(time.perf_counter() - t)
+            result = self._result(len(latencies), time.time() - start, ping=latencies)
+            cli.close()
+        finally:
+            for idle_client in idle_clients:
+                idle_client.close()
+
+        result['idle_connections'] = len(idle_clients)
+        result['handler_bytes_per_connection'] = handler_footprint()
+        if rss_before is not None and rss_after is not None:
+            result['server_rss_kb'] = rss_after
+            result['rss_per_connection_bytes'] = round((rss_after - rss_before) * 1024 / max(1, len(idle_clients)), 1)
+        return result
+
+    def recovery(self):
+        if self._local_server is None:
+            return {'skipped': '只支持本地服务器'}
+
+        queue_name = 'mmbench_recovery'
+        self._fresh_queue(queue_name)
+        self._fill(queue_name, self._messages, 'x' * self._size)
+        time.sleep(1.5)  # 等待日志和持久化进程写完
+
+        self._local_server.stop()
+        start = time.time()
+        self._local_server.start()
+        ready = time.time() - start
+
+        cli = self._client()
+        queue_infor = cli.get_stat()['json_obj'][0]['queue_infor']
+        cli.close()
+        return {
+            'messages': self._messages,
+            'restored': queue_infor.get(queue_name, [0])[0],
+            'seconds': round(ready, 3),
+            'throughput': round(self._messages / ready, 1)
+        }
+
+    def run(self, scenarios):
+        results = {}
+        for scenario in scenarios:
+            LOGGER.info('正在运行场景: %s', scenario)
+            results[scenario] = getattr(self, scenario)()
+        return results
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s:%(asctime)s:%(name)s[%(message)s]')
+
+    parser = argparse.ArgumentParser('MingMQ基准测试。')
+    parser.add_argument('--HOST', type=str, default='',
+                        help='输入服务器IP地址，为空则启动一个本地服务器')
+    parser.add_argument('--PORT', type=int, default=15673,
+                        help='输入服务器端口，默认，15673')
+    parser.add_argument('--USER_NAME', type=str, default='mingmq',
+                        help='输入服务器账号，默认，mingmq')
+    parser.add_argument('--PASSWD', type=str, default='mm5201314',
+                        help='输入服务器密码，默认，mm5201314')
+    parser.add_argument('--SCENARIOS', type=str, default=','.join(SCENARIOS),
+                        help='输入要运行的场景，用逗号分隔，默认，全部：' + ','.join(SCENARIOS))
+    parser.add_argument('--MESSAGES', type=int, default=10000,
+                        help='输入每个场景的消息数，默认，10000')
+    parser.add_argument('--SIZE', type=int, default=100,
+                        help='输入消息大小，单位字节，默认，100')
+    parser.add_argument('--LARGE_SIZE', type=int, default=256 * 1024,
+                        help='输入large场景的消息大小，默认，262144')
+    parser.add_argument('--CONCURRENCY', type=int, default=4,
+                        help='输入并发的客户端数，默认，4')
+    parser.add_argument('--IDLE_CONNECTIONS', type=int, default=500,
+                        help='输入idle场景的空闲连接数，默认，500')
+    parser.add_argument('--OUTPUT', type=str, default='',
+                        help='输入结果文件路径，为空则输出到标准输出')
+    flags = parser.parse_args()
+
+    scenarios = [s for s in flags.SCENARIOS.split(',') if s]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('未知的场景: %s' % scenario)
+
+    local_server = None
+    host, port = flags.HOST, flags.PORT
+    if not host:
+        local_server = LocalServer(flags.USER_NAME, flags.PASSWD)
+        local_server.start()
+        host, port = local_server.host, local_server.port
+
+    try:
+        bench = Bench(host, port, flags.USER_NAME, flags.PASSWD, flags.MESSAGES, flags.SIZE,
+                      flags.CONCURRENCY, flags.LARGE_SIZE, flags.IDLE_CONNECTIONS, local_server)
+        report = {
+            'config': {
+                'server': 'local' if local_server else '%s:%d' % (host, port),
+                'messages': flags.MESSAGES,
+                'size': flags.SIZE,
+                'concurrency': flags.CONCURRENCY,
+                'python': sys.version.split()[0],
+                'time': time.strftime('%Y-%m-%d %H:%M:%S')
+            },
+            'results': bench.run(scenarios)
+        }
+    finally:
+        if local_server:
+            local_server.stop()
+            local_server.cleanup()
+
+    output = json.dumps(report, ensure_ascii=False, indent=4)
+    if flags.OUTPUT:
+        with open(flags.OUTPUT, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
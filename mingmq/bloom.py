@@ -0,0 +1,193 @@
+"""可扩展的布隆过滤器(scalable bloom filter)，用于唯一键队列。
+
+爬虫的待抓取队列要求每个url在整个任务中只入队一次，用集合保存所有见过的url太
+占内存，布隆过滤器只需要每个元素十几个比特，代价是有error_rate的概率把没有见过
+的url误判为见过，不会把见过的url判断为没有见过。
+
+单个布隆过滤器的容量是固定的，元素超过容量后误判率会迅速上升，所以这里按照
+Almeida等人的方法，在当前的过滤器满了之后追加一个容量为growth倍、误判率为
+ratio倍的新过滤器，所有过滤器的误判率之和不超过error_rate::
+
+    error_rate * (1 - ratio) * (1 + ratio + ratio ** 2 + ...) = error_rate
+
+Command line example:
+
+>>> f = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+>>> f.add('http://example.com/')
+True
+>>> f.add('http://example.com/')
+False
+
+"""
+
+import hashlib
+import math
+import platform
+
+# 声明唯一键队列时arguments的默认值
+DEFAULT_INITIAL_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.001
+
+
+def _hashes(key):
+    """两个64位的哈希值，第i个比特位置为h1 + i * h2 (Kirsch-Mitzenmacher)
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+
+class BloomFilter:
+    """容量固定的布隆过滤器
+    """
+
+    def __init__(self, capacity, error_rate, count=0, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = count
+        # 比特数和哈希函数个数的最优值
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    def contains_hashes(self, h1, h2):
+        bits = self.bits
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            p = (h1 + i * h2) % num_bits
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add_hashes(self, h1, h2):
+        bits = self.bits
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            p = (h1 + i * h2) % num_bits
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return self.contains_hashes(*_hashes(key))
+
+    def add(self, key):
+        self.add_hashes(*_hashes(key))
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter:
+    """可扩展的布隆过滤器
+    """
+    GROWTH = 2
+    RATIO = 0.5
+
+    def __init__(self, initial_capacity=DEFAULT_INITIAL_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.filters = []
+
+    def _new_filter(self):
+        i = len(self.filters)
+        bloom_filter = BloomFilter(self.initial_capacity * self.GROWTH ** i,
+                                   self.error_rate * (1 - self.RATIO) * self.RATIO ** i)
+        self.filters.append(bloom_filter)
+        return bloom_filter
+
+    def _contains_hashes(self, h1, h2):
+        # 新的过滤器元素多，从后往前找
+        for bloom_filter in reversed(self.filters):
+            if bloom_filter.contains_hashes(h1, h2):
+                return True
+        return False
+
+    def __contains__(self, key):
+        return self._contains_hashes(*_hashes(key))
+
+    def add(self, key):
+        """
+        :return: boolean，True为新的键，False为(可能)已经见过的键
+        """
+        h1, h2 = _hashes(key)
+        if self._contains_hashes(h1, h2):
+            return False
+        bloom_filter = self.filters[-1] if self.filters else None
+        if bloom_filter is None or bloom_filter.is_full():
+            bloom_filter = self._new_filter()
+        bloom_filter.add_hashes(h1, h2)
+        return True
+
+    def load_filter(self, capacity, error_rate, count, bits):
+        """恢复快照中的一个过滤器，需要按顺序调用
+        """
+        self.filters.append(BloomFilter(capacity, error_rate, count, bits))
+
+    def get_count(self):
+        return sum(bloom_filter.count for bloom_filter in self.filters)
+
+    def get_size(self):
+        return sum(len(bloom_filter.bits) for bloom_filter in self.filters)
+
+
+class UniqueMemory:
+    """
+    唯一键队列的布隆过滤器的内存模型
+    """
+
+    def __init__(self):
+        self._map = dict()
+
+    def get_self(self):
+        return self._map
+
+    def declare(self, queue_name, initial_capacity=DEFAULT_INITIAL_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        if queue_name in self._map:
+            return False
+        self._map[queue_name] = ScalableBloomFilter(initial_capacity, error_rate)
+        return True
+
+    def delete(self, queue_name):
+        return self._map.pop(queue_name, None) is not None
+
+    def add(self, queue_name, unique_key):
+        """
+        :return: boolean，True为新的键，False为已经见过的键，None表示不是唯一键队列
+        """
+        bloom_filter = self._map.get(queue_name)
+        if bloom_filter is None:
+            return None
+        return bloom_filter.add(unique_key)
+
+    def get_stat(self):
+        tmp = dict()
+        for k, v in self._map.items():
+            tmp[k] = [v.get_count(), v.get_size()]
+        return tmp
+
+
+if not platform.platform().startswith('Linux'):
+    from threading import Lock
+
+    _LOCK = Lock()
+
+
+class SyncUniqueMemory(UniqueMemory):
+    """
+    唯一键队列的布隆过滤器的内存模型，线程安全
+    """
+
+    def declare(self, queue_name, initial_capacity=DEFAULT_INITIAL_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        with _LOCK:
+            return super().declare(queue_name, initial_capacity, error_rate)
+
+    def delete(self, queue_name):
+        with _LOCK:
+            return super().delete(queue_name)
+
+    def add(self, queue_name, unique_key):
+        with _LOCK:
+            return super().add(queue_name, unique_key)
+
+    def get_stat(self):
+        with _LOCK:
+            return super().get_stat()
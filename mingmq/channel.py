@@ -0,0 +1,250 @@
+"""服务器进程与持久化进程之间的批量通道。
+
+multiprocessing.Queue每发送一条消息都要pickle一次，写一次管道，还要唤醒
+一次feeder线程。BatchChannel先把消息用mingmq.codec编码后追加到内存缓冲区，
+服务器在每一轮事件循环结束时调用flush()，这一轮产生的所有消息作为一个批次
+交给写线程，写线程一次系统调用就能把一个批次发送出去；持久化进程则用get_batch()
+一次读取所有已经到达的批次。
+
+管道的缓冲区只有64K，持久化进程落后时写管道会阻塞，所以flush()不直接写管道，
+阻塞的只是写线程，事件循环照常处理请求，还没有写入管道的字节数见get_stat()
+的buffered_bytes。
+
+消息在两端都是dict，字段由schema决定，schema是消息类型到字段名元组的映射，
+例如mingmq.message.ACK_PROCESS_MESSAGE_FIELDS。
+
+持久化进程每提交一个事务就调用commit()，把已经提交的批次数、消息数和提交耗时
+写到一块共享内存中，服务器读取后就能知道持久化进程落后了多少，见get_stat()。
+共享内存只有持久化进程一个写者，写的时候不会阻塞，也不需要服务器去读。
+"""
+
+import os
+import time
+from collections import deque
+from multiprocessing import Pipe, Array
+from threading import Condition, Lock, Thread
+
+from mingmq.codec import encode_record, iter_records
+from mingmq.memory import Histogram, RateWindow
+
+# 缓冲区超过这个大小时，不等事件循环结束就直接发送
+MAX_BATCH_BYTES = 1024 * 1024
+
+# 共享内存的布局，后面是提交耗时直方图的桶
+_COMMITTED_BATCHES = 0
+_COMMITTED_RECORDS = 1
+_COMMITS = 2
+_COMMIT_SECONDS = 3
+_COMMIT_MAX_SECONDS = 4
+_LAST_BATCH_SIZE = 5
+_HISTOGRAM = 6
+
+
+class BatchChannel:
+    def __init__(self, schema, max_batch_bytes=MAX_BATCH_BYTES):
+        """初始化；
+
+        :param schema: 消息类型到字段名元组的映射；
+        :type schema: dict
+        :param max_batch_bytes: 缓冲区的最大字节数；
+        :type max_batch_bytes: int
+
+        """
+        self._schema = schema
+        self._max_batch_bytes = max_batch_bytes
+        self._reader, self._writer = Pipe(duplex=False)
+        self._buf = bytearray()
+        self._lock = Lock()
+        self._init_writer()
+
+        self._records = 0
+        self._batches = 0
+        self._sent_bytes = 0
+        self._buffered_since = None
+        # 已经发送还没有提交的批次，(批次序号, 累计消息数, 第一条消息放入缓冲区的时间)
+        self._inflight = deque()
+        self._last_committed_records = 0
+        self._committed_rate = RateWindow()
+
+        # 持久化进程写，服务器读
+        self._committed = Array('d', _HISTOGRAM + Histogram.BUCKETS, lock=False)
+        # 持久化进程已经读取的批次数
+        self._received = 0
+
+    def _init_writer(self):
+        # 已经flush、写线程还没有写入管道的批次
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._has_pending = Condition(self._lock)
+        self._all_written = Condition(self._lock)
+        self._writer_thread = None
+        self._writer_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_lock', '_pending', '_has_pending', '_all_written', '_writer_thread'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        self._init_writer()
+
+    def put_nowait(self, msg):
+        """编码一条消息并放入缓冲区，不会立刻发送；
+
+        :param msg: 消息，必须包含type字段；
+        :type msg: dict
+
+        """
+        _type = msg['type']
+        record = encode_record(_type, *[msg[field] for field in self._schema[_type]])
+
+        with self._lock:
+            if not self._buf:
+                self._buffered_since = time.time()
+            self._buf += record
+            self._records += 1
+            if len(self._buf) >= self._max_batch_bytes:
+                self._flush()
+
+    def flush(self):
+        """将缓冲区中的所有消息一次性发送出去；
+
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buf:
+            self._pending.append(self._buf)
+            self._pending_bytes += len(self._buf)
+            self._batches += 1
+            self._buf = bytearray()
+            self._inflight.append((self._batches, self._records, self._buffered_since))
+            self._start_writer()
+            self._has_pending.notify()
+
+        # flush在每一轮事件循环都会调用，顺便统计持久化进程的速度
+        committed_records = int(self._committed[_COMMITTED_RECORDS])
+        if committed_records != self._last_committed_records:
+            self._committed_rate.add(committed_records - self._last_committed_records, time.time())
+            self._last_committed_records = committed_records
+
+    def _start_writer(self):
+        # fork之后的子进程中没有父进程的线程，写的进程变了就重新启动写线程
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            self._writer_thread = Thread(target=self._write_forever, name='BatchChannelWriter', daemon=True)
+            self._writer_thread.start()
+
+    def _write_forever(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._has_pending.wait()
+                buf = self._pending.popleft()
+
+            # 持久化进程落后时在这里阻塞，不影响事件循环
+            self._writer.send_bytes(buf)
+
+            with self._lock:
+                self._pending_bytes -= len(buf)
+                self._sent_bytes += len(buf)
+                if not self._pending_bytes:
+                    self._all_written.notify_all()
+
+    def join(self, timeout=None):
+        """等待写线程把已经flush的批次都写入管道；
+
+        :return: 是否在timeout之前全部写入
+        """
+        with self._lock:
+            return self._all_written.wait_for(lambda: not self._pending_bytes, timeout)
+
+    def get_stat(self):
+        """发送端的统计；
+
+        :return: records为放入的消息数，batches为已经flush的批次数，sent_bytes为已经写入
+                 管道的字节数，buffered_bytes为还没有写入管道的字节数，committed_开头的是持久化
+                 进程已经提交的数量，backlog_records为还没有提交的消息数，
+                 oldest_unpersisted_age为最早的没有提交的消息已经等待的秒数；
+        :rtype: dict
+
+        """
+        with self._lock:
+            now = time.time()
+            committed_batches = int(self._committed[_COMMITTED_BATCHES])
+            committed_records = int(self._committed[_COMMITTED_RECORDS])
+            commits = int(self._committed[_COMMITS])
+
+            while self._inflight and self._inflight[0][0] <= committed_batches:
+                self._inflight.popleft()
+
+            if self._inflight:
+                oldest = self._inflight[0][2]
+            elif self._buf:
+                oldest = self._buffered_since
+            else:
+                oldest = now
+
+            return {
+                'records': self._records,
+                'batches': self._batches,
+                'sent_bytes': self._sent_bytes,
+                'buffered_bytes': len(self._buf) + self._pending_bytes,
+                'committed_batches': committed_batches,
+                'committed_records': committed_records,
+                'committed_per_second': self._committed_rate.rate(now),
+                'backlog_batches': self._batches - committed_batches,
+                'backlog_records': self._records - committed_records,
+                'oldest_unpersisted_age': now - oldest,
+                'mean_batch_size': committed_records / commits if commits else 0.0,
+                'last_batch_size': int(self._committed[_LAST_BATCH_SIZE]),
+                'commit_latency': Histogram.from_buckets(
+                    [int(n) for n in self._committed[_HISTOGRAM:]],
+                    self._committed[_COMMIT_SECONDS],
+                    self._committed[_COMMIT_MAX_SECONDS]).get_stat()
+            }
+
+    def get_batch(self):
+        """阻塞直到有数据，然后读取所有已经到达的批次；
+
+        :return: 消息列表；
+        :rtype: list
+
+        """
+        msgs = []
+        self._decode(self._reader.recv_bytes(), msgs)
+        self._received += 1
+        while self._reader.poll():
+            self._decode(self._reader.recv_bytes(), msgs)
+            self._received += 1
+        return msgs
+
+    def commit(self, records, seconds):
+        """持久化进程提交了get_batch()读取的所有消息后调用；
+
+        :param records: 这个事务中的消息数；
+        :type records: int
+        :param seconds: 提交耗时，单位秒；
+        :type seconds: float
+
+        """
+        committed = self._committed
+        committed[_COMMITTED_RECORDS] += records
+        committed[_COMMITS] += 1
+        committed[_COMMIT_SECONDS] += seconds
+        if seconds > committed[_COMMIT_MAX_SECONDS]:
+            committed[_COMMIT_MAX_SECONDS] = seconds
+        committed[_LAST_BATCH_SIZE] = records
+        committed[_HISTOGRAM + Histogram.bucket(seconds)] += 1
+        # 最后写批次数，服务器看到批次数时，其它字段已经写好了
+        committed[_COMMITTED_BATCHES] = self._received
+
+    def _decode(self, buf, msgs):
+        for _type, fields, _ in iter_records(buf):
+            msg = dict(zip(self._schema[_type], fields))
+            msg['type'] = _type
+            msgs.append(msg)
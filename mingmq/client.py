@@ -1,10 +1,11 @@
 """为MingMQ提供一个Python的客户端驱动，并且还提供了一个连接池，但是是
 基于多线程的，因为传统编程框架大多数是使用多线程的，所以是必须提供一个，
-后面就再增加一个异步的客户端驱动；
+异步的客户端驱动在mingmq.async_client中；
 
 * Producer生产者用于向消息队列中发送任务
-* ConsumerTaskThread用于消费者任务线程处理
-* Consumer消费者用于从任务消息队列中获取任务再将处理后的数据放入存储队列的应用中
+* BatchProducer批量生产者，在内存中攒批后一次发送，适合大量发送任务的场景
+* Consumer消费者用于从任务消息队列中获取任务再将处理后的数据放入存储队列的应用中，
+  回调函数在线程池(或进程池)中执行，任务执行成功后批量确认
 * Client封装了对MingMQ的各种操作；
 * Pool主要是不用经常登陆，可以很好的节省时间，如果是其它应用调用连接池，还能保持服务的高可用，用户根本不需要管出现的问题
 """
@@ -17,6 +18,8 @@ import socket
 import struct
 import traceback
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from functools import partial
 
 from mingmq.message import (ReqLoginMessage,
                             SUCCESS, ReqLogoutMessage, ReqDeclareQueueMessage,
@@ -25,23 +28,64 @@ from mingmq.message import (ReqLoginMessage,
                             ReqACKMessage, MAX_DATA_LENGTH, ReqPingMessage,
                             ReqGetSpeedMessage, ReqGetStatMessage,
                             ReqDeleteAckMessageIDMessage, ReqRestoreAckMessageIDMessage,
-                            ReqRestoreSendMessage, FAIL)
+                            ReqRestoreSendMessage, FAIL, RETRY, ReqSetResendIntervalMessage,
+                            ReqGetResendIntervalMessage, ReqACKMessagesMessage,
+                            ReqSendDatasToQueueMessage, ReqDeclareExchangeMessage,
+                            ReqDeleteExchangeMessage, ReqBindQueueMessage,
+                            ReqUnbindQueueMessage, ReqPublishMessage,
+                            ReqReadFromMessage, ReqCommitOffsetMessage)
 from mingmq.utils import to_json
+from mingmq.compress import encode, decode
 from mingmq.error import ClientPoolEmpty
 
-from threading import Lock, Thread
+from threading import Lock, Thread, BoundedSemaphore, Event, Condition
+
+# 消费者长轮询的超时时间，队列为空时由服务器挂起请求最多这么多秒，单位秒；
+# 服务器设置了IDLE_TIMEOUT时要比它小
+LONG_POLL_TIMEOUT = 5
+# 消费者批量确认的最长间隔，单位秒
+ACK_INTERVAL = 0.1
+# 用unix domain socket连接服务器时，host的前缀
+UNIX_SCHEME = 'unix://'
+# 批量生产者缓冲区的默认最大字节数
+MAX_BUFFER_BYTES = 32 * 1024 * 1024
+# 连接池中空闲连接的最长保留时间，单位秒
+POOL_IDLE_TIMEOUT = 300
+# 连接池中空闲超过这个时间的连接在借出前要先ping，单位秒
+POOL_CHECK_INTERVAL = 30
+
+
+def retry_after(result):
+    """服务器内存超过高水位或者队列被限速时返回RETRY；
+
+    :return: 建议等待的秒数，不是RETRY时返回None
+    :rtype: float
+    """
+    if result and result['status'] == RETRY:
+        return result['json_obj'][0].get('retry_after', 1)
+    return None
 
 
 class Producer(object):
-    """生产者，用于发送消息到指定队列
+    """生产者，用于发送消息到指定队列，服务器内存超过高水位时按照retry_after等待后重新发送
     """
 
-    def __init__(self, host, port, user_name, passwd, task_queue_name):
+    def __init__(self, host, port, user_name, passwd, task_queue_name, compress_threshold=None, codec=None):
+        """初始化生产者
+
+        :param compress_threshold: 设置后，json序列化后超过这个长度的数据会被压缩，
+                消费者会自动解压，见mingmq.compress；
+        :type compress_threshold: int
+        :param codec: 压缩算法名，默认使用当前环境中最好的算法；
+        :type codec: str
+        """
         self._host = host
         self._port = port
         self._user_name = user_name
         self._passwd = passwd
         self._task_queue_name = task_queue_name
+        self._compress_threshold = compress_threshold
+        self._codec = codec
         self._log = logging.getLogger('Producer')
         self._init_mingmq_conn()
         self._mingmq_conn.declare_queue(self._task_queue_name)
@@ -63,7 +107,15 @@ class Producer(object):
                 })))
         """
         json_obj = json.dumps(task_data)
-        result = self._mingmq_conn.send_data_to_queue(self._task_queue_name, json_obj)
+        if self._compress_threshold is not None:
+            json_obj = encode(json_obj, self._codec, self._compress_threshold)
+        while True:
+            result = self._mingmq_conn.send_data_to_queue(self._task_queue_name, json_obj)
+            wait = retry_after(result)
+            if wait is None:
+                break
+            self._log.warning('服务器内存超过高水位，%s秒后重新发送', wait)
+            time.sleep(wait)
         if result is None or result and result['status'] != SUCCESS:
             raise Exception('发送任务到消息队列中失败！')
         self._log.debug('发送数据到消息队列中成功: queue=%s, data=%s', self._task_queue_name, task_data)
@@ -72,55 +124,193 @@ class Producer(object):
         self._mingmq_conn.close()
 
 
-class ConsumerTaskThread(Thread):
-    """消费者线程任务处理类
+class BatchProducer(object):
+    """批量生产者，send_task只是把任务放到内存缓冲区中并返回一个Future，
+    后台线程在积累了batch_size个任务，或者最早的任务等待了linger_ms毫秒后，
+    用一个SEND_DATAS_TO_QUEUE请求把这一批任务发送出去，服务器确认后Future
+    才会完成。缓冲区中的数据超过max_buffer_bytes时，send_task会阻塞，直到
+    有任务发送出去为止。服务器内存超过高水位返回RETRY时，发送线程等待retry_after
+    秒后重新发送这一批，期间缓冲区满了send_task就会阻塞，生产者自然就慢下来了。
     """
 
-    def __init__(self, target, args, consumer) -> None:
-        """初始化
+    def __init__(self, host, port, user_name, passwd, task_queue_name, batch_size=500, linger_ms=5,
+                 max_buffer_bytes=MAX_BUFFER_BYTES, compress_threshold=None, codec=None):
+        """初始化生产者
 
-        :param target: 回调函数
-        :type target: callable function
-        :param args: 函数参数
-        :type args: tuple
-        :param consumer: 消费者
-        :type consumer: Consumer
+        :param task_queue_name: 任务队列名
+        :type task_queue_name: str
+        :param batch_size: 一批最多发送的任务数；
+        :type batch_size: int
+        :param linger_ms: 任务在缓冲区中最多等待的时间，单位毫秒；
+        :type linger_ms: float
+        :param max_buffer_bytes: 缓冲区的最大字节数，按压缩后的长度计算；
+        :type max_buffer_bytes: int
+        :param compress_threshold: 和Producer一样，设置后超过这个长度的数据会被压缩；
+        :type compress_threshold: int
+        :param codec: 压缩算法名；
+        :type codec: str
         """
-        Thread.__init__(self, target=target, args=args)
-        self.args = args
-        self._consumer = consumer
-        self._log = logging.getLogger(self.getName())
+        self._host = host
+        self._port = port
+        self._user_name = user_name
+        self._passwd = passwd
+        self._task_queue_name = task_queue_name
+        self._batch_size = batch_size
+        self._linger = linger_ms / 1000
+        self._max_buffer_bytes = max_buffer_bytes
+        self._compress_threshold = compress_threshold
+        self._codec = codec
+        self._log = logging.getLogger('BatchProducer')
+
+        self._mingmq_conn = None
+        self._init_mingmq_conn()
+        self._mingmq_conn.declare_queue(self._task_queue_name)
 
-    def run(self) -> None:
-        # 线程执行之前，消费者使用的连接自增
-        with self._consumer.lock:
-            self._consumer.used_conn_num += 1
-            self._log.debug('消费者正在运行的任务数递增：%d', self._consumer.used_conn_num)
+        # 元素为(json字符串, Future, 放入时间)
+        self._buf = deque()
+        self._buf_bytes = 0
+        # 已经从缓冲区取出但服务器还没有确认的任务数
+        self._sending = 0
+        self._closed = False
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._sender = Thread(target=self._send_forever, name='BatchProducer', daemon=True)
+        self._sender.start()
 
-        try:
-            # 实际的回调函数执行
-            super().run()
-            # 确认任务
-            message_id = self.args[1]
-            msg = self._consumer.mingmq_pool.opera('ack_message', *(self._consumer.task_queue_name, message_id))
-            if msg and msg['status'] == SUCCESS:
-                self._log.debug('确认消息成功: %s, %s', self._consumer.task_queue_name, message_id)
+    def _init_mingmq_conn(self):
+        """初始化mingmq连接
+        """
+        if self._mingmq_conn:
+            self._mingmq_conn.close()
+        self._mingmq_conn = Client(self._host, self._port)
+        if self._mingmq_conn.login(self._user_name, self._passwd) != SUCCESS:
+            raise Exception('登录失败')
+
+    def send_task(self, task_data, timeout=None):
+        """把数据放入缓冲区
+
+        :param task_data: 数据，会被json序列化
+        :param timeout: 缓冲区满时最多等待的时间，None表示一直等待
+        :type timeout: float
+        :return: 服务器确认后完成的Future，结果为message_id
+        :rtype: concurrent.futures.Future
+        """
+        json_obj = json.dumps(task_data)
+        if self._compress_threshold is not None:
+            json_obj = encode(json_obj, self._codec, self._compress_threshold)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise Exception('生产者已经关闭')
+            if not self._not_full.wait_for(
+                    lambda: self._buf_bytes == 0 or self._buf_bytes + len(json_obj) <= self._max_buffer_bytes,
+                    timeout):
+                raise Exception('生产者缓冲区已满')
+
+            self._buf.append((json_obj, future, time.time()))
+            self._buf_bytes += len(json_obj)
+            if len(self._buf) >= self._batch_size or len(self._buf) == 1:
+                self._not_empty.notify()
+        return future
+
+    def _take_batch(self):
+        """等到攒够一批或者最早的任务等待超时，然后从缓冲区中取出一批
+        """
+        with self._lock:
+            while True:
+                if self._buf:
+                    wait = self._buf[0][2] + self._linger - time.time()
+                    if len(self._buf) >= self._batch_size or wait <= 0 or self._closed:
+                        break
+                    self._not_empty.wait(wait)
+                elif self._closed:
+                    return []
+                else:
+                    self._not_empty.wait()
+
+            batch, size = [], 0
+            while self._buf and len(batch) < self._batch_size:
+                # 保证一个请求不会超过服务器允许的最大长度，json再次转义后长度最多翻倍
+                if batch and size + len(self._buf[0][0]) > MAX_DATA_LENGTH // 4:
+                    break
+                item = self._buf.popleft()
+                batch.append(item)
+                size += len(item[0])
+
+            self._buf_bytes -= size
+            self._sending += len(batch)
+            self._not_full.notify_all()
+            return batch
+
+    def _send_forever(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+
+            result = None
+            message_datas = [item[0] for item in batch]
+            while True:
+                try:
+                    result = self._mingmq_conn.send_datas_to_queue(self._task_queue_name, message_datas)
+                except Exception:
+                    self._log.error(traceback.format_exc())
+                    break
+                wait = retry_after(result)
+                if wait is None:
+                    break
+                self._log.warning('服务器内存超过高水位，%s秒后重新发送%d个任务', wait, len(batch))
+                time.sleep(wait)
+
+            if result and result['status'] == SUCCESS:
+                for (_, future, _), message_id in zip(batch, result['json_obj']):
+                    future.set_result(message_id)
+                self._log.debug('批量发送数据到消息队列中成功: queue=%s, count=%d', self._task_queue_name, len(batch))
             else:
-                self._log.debug('确认消息失败: %s, %s', self._consumer.task_queue_name, message_id)
-        except:
-            self._consumer.log.error(traceback.format_exc())
+                for _, future, _ in batch:
+                    future.set_exception(Exception('发送任务到消息队列中失败！'))
+                if not self._mingmq_conn.is_connected():
+                    try:
+                        self._init_mingmq_conn()
+                    except Exception:
+                        self._log.error(traceback.format_exc())
+
+            with self._lock:
+                self._sending -= len(batch)
+                self._not_full.notify_all()
+
+    def flush(self, timeout=None):
+        """立刻发送缓冲区中的所有任务，并等待服务器确认
+
+        :return: 是否在timeout之前全部发送完毕
+        :rtype: bool
+        """
+        with self._lock:
+            # 把缓冲区中的任务都标记为已经等待超时，发送线程就不会再等linger_ms
+            self._buf = deque((json_obj, future, 0) for json_obj, future, _ in self._buf)
+            self._not_empty.notify()
+            return self._not_full.wait_for(lambda: not self._buf and self._sending == 0, timeout)
 
-        # 执行完毕后，消费者的连接递减
-        with self._consumer.lock:
-            self._consumer.used_conn_num -= 1
-            self._log.debug('消费者正在运行的任务数递减：%d', self._consumer.used_conn_num)
+    def release(self):
+        """发送完剩余的任务后关闭连接
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+        self._sender.join()
+        self._mingmq_conn.close()
 
 
 class Consumer(object):
     """适用于从队列中获取任务处理后将数据再放到另一个队列中存储的应用
+
+    回调函数在线程池中执行(CPU密集的回调可以使用进程池)，同时在执行和在本地
+    缓冲的任务数不会超过size + prefetch，任务执行成功后由确认线程批量确认。
     """
 
-    def __init__(self, host, port, user_name, passwd, size, task_queue_name, data_queue_name):
+    def __init__(self, host, port, user_name, passwd, size, task_queue_name, data_queue_name,
+                 prefetch=None, use_process_pool=False, ack_batch_size=100):
         """初始化消费者
 
         :param host: 服务器主机地址；
@@ -131,18 +321,27 @@ class Consumer(object):
         :type user_name: str
         :param passwd: 密码；
         :type passwd: str
-        :param size: 连接池大小；
+        :param size: 同时执行回调函数的线程数(或进程数)；
         :type size: int
         :param task_queue_name: 任务队列名
         :type task_queue_name: str
         :param data_queue_name: 存储队列名
         :type data_queue_name: str
+        :param prefetch: 本地缓冲的任务数，默认等于size；
+        :type prefetch: int
+        :param use_process_pool: 是否在进程池中执行回调函数，回调函数必须可以被pickle；
+        :type use_process_pool: bool
+        :param ack_batch_size: 一次最多确认的任务数；
+        :type ack_batch_size: int
         """
         self._host = host
         self._port = port
         self._user_name = user_name
         self._passwd = passwd
-        self._size = size + 1
+        self._size = size
+        self._prefetch = size if prefetch is None else prefetch
+        self._use_process_pool = use_process_pool
+        self._ack_batch_size = ack_batch_size
         self._task_queue_name = task_queue_name
         self._data_queue_name = data_queue_name
 
@@ -151,17 +350,20 @@ class Consumer(object):
 
         self._lock = Lock()
         self._used_conn_num = 0
+        # 执行中和缓冲中的任务数
+        self._slots = BoundedSemaphore(self._size + self._prefetch)
+        self._acks = deque()
+        self._ack_event = Event()
+        self._stopped = Event()
+        self._closing = False
 
         self._log = logging.getLogger('Consumer')
 
     @property
     def used_conn_num(self):
+        """正在执行和等待执行的任务数"""
         return self._used_conn_num
 
-    @used_conn_num.setter
-    def used_conn_num(self, used_conn_num):
-        self._used_conn_num = used_conn_num
-
     @property
     def lock(self):
         return self._lock
@@ -183,9 +385,9 @@ class Consumer(object):
         return self._log
 
     def _init_mingmq_pool(self):
-        """初始化mingmq连接池
+        """初始化mingmq连接池，获取任务和确认任务各用一个连接，其它的留给回调函数
         """
-        self._mingmq_pool = Pool(self._host, self._port, self._user_name, self._passwd, self._size)
+        self._mingmq_pool = Pool(self._host, self._port, self._user_name, self._passwd, self._size + 2)
 
     def _declare_queue(self):
         """声明队列名
@@ -193,6 +395,11 @@ class Consumer(object):
         self._mingmq_pool.opera('declare_queue', *(self._task_queue_name,))
         self._mingmq_pool.opera('declare_queue', *(self._data_queue_name,))
 
+    def _create_executor(self):
+        if self._use_process_pool:
+            return ProcessPoolExecutor(max_workers=self._size)
+        return ThreadPoolExecutor(max_workers=self._size, thread_name_prefix='ConsumerTask')
+
     def serv_forever(self, func):
         """从队列中获取任务
 
@@ -204,30 +411,102 @@ class Consumer(object):
         def callback(message_data, message_id):
             print(message_data, message_id)
         ```
+
+        调用stop()之后不再获取新的任务，等待执行中和缓冲中的任务结束，确认完所有
+        执行成功的任务后返回
         """
-        while True:
-            self._log.debug('正在运行的任务数：%d', self.used_conn_num)
+        ack_thread = Thread(target=self._ack_forever, name='ConsumerAck', daemon=True)
+        ack_thread.start()
 
-            if self.used_conn_num < self._size - 1:
-                try:
-                    mq_res: dict = self._mingmq_pool.opera('get_data_from_queue', *(self._task_queue_name,))
-                    if mq_res and mq_res['status'] == FAIL:
-                        raise Exception("任务队列中没有任务")
+        try:
+            with self._create_executor() as executor:
+                while not self._stopped.is_set():
+                    self._slots.acquire()
+
+                    # 队列为空或者被限速时由服务器挂起请求，有任务或者超时的时候再返回
+                    start = time.monotonic()
+                    mq_res: dict = self._mingmq_pool.opera('get_data_from_queue',
+                                                           *(self._task_queue_name, LONG_POLL_TIMEOUT))
                     if mq_res is None:
                         self._log.error("服务器内部错误")
                         sys.exit(1)
+
+                    if mq_res['status'] == RETRY:
+                        # 不支持长轮询的服务器在队列被限速时返回RETRY
+                        self._slots.release()
+                        time.sleep(retry_after(mq_res))
+                        continue
+
+                    if mq_res['status'] == FAIL:
+                        # 长轮询超时，立刻再发一个请求；队列不存在时服务器马上返回，等一个长轮询的时间
+                        self._slots.release()
+                        if time.monotonic() - start < LONG_POLL_TIMEOUT / 2:
+                            time.sleep(LONG_POLL_TIMEOUT)
+                        continue
+
                     self._log.debug('从消息队列中获取的消息为: %s', mq_res)
-                except Exception as e:
-                    self._log.debug('XX: 从消息队列中获取任务失败，错误信息: %s', str(e))
-                    continue
-                try:
-                    message_data = mq_res['json_obj'][0]['message_data']
+
+                    message_data = decode(mq_res['json_obj'][0]['message_data'])
                     message_id = mq_res['json_obj'][0]['message_id']
-                    ConsumerTaskThread(target=func, args=(message_data, message_id), consumer=self).start()
-                except Exception as e:
-                    self._log.debug("XX: 线程在执行过程中出现异常，错误信息为: %s", str(e))
+                    with self._lock:
+                        self._used_conn_num += 1
+
+                    try:
+                        future = executor.submit(func, message_data, message_id)
+                        future.add_done_callback(partial(self._task_done, message_id))
+                    except Exception as e:
+                        self._log.debug("XX: 提交任务失败，错误信息为: %s", str(e))
+                        self._release_slot()
+        finally:
+            # 执行中的任务都已经结束，确认剩下的任务后再返回
+            self._closing = True
+            self._ack_event.set()
+            ack_thread.join()
+
+    def stop(self):
+        """停止serv_forever，可以在其它线程或者回调函数中调用
+        """
+        self._stopped.set()
+
+    def _release_slot(self):
+        with self._lock:
+            self._used_conn_num -= 1
+        self._slots.release()
+
+    def _task_done(self, message_id, future):
+        try:
+            exc = future.exception()
+            if exc is None:
+                self._acks.append(message_id)
+                if len(self._acks) >= self._ack_batch_size:
+                    self._ack_event.set()
             else:
-                time.sleep(3)
+                self._log.error('任务执行失败，不确认: %s, %s', message_id, repr(exc))
+        finally:
+            self._release_slot()
+
+    def _ack_forever(self):
+        """每隔ACK_INTERVAL秒，或者积累了ack_batch_size个任务，就批量确认一次，
+        serv_forever退出时再确认一次剩下的任务
+        """
+        while True:
+            self._ack_event.wait(ACK_INTERVAL)
+            self._ack_event.clear()
+            closing = self._closing
+
+            while self._acks:
+                message_ids = []
+                while self._acks and len(message_ids) < self._ack_batch_size:
+                    message_ids.append(self._acks.popleft())
+
+                msg = self._mingmq_pool.opera('ack_messages', *(self._task_queue_name, message_ids))
+                if msg and msg['status'] == SUCCESS:
+                    self._log.debug('确认消息成功: %s, %d', self._task_queue_name, len(message_ids))
+                else:
+                    self._log.debug('确认消息失败: %s, %s', self._task_queue_name, repr(msg))
+
+            if closing:
+                return
 
     def _release_mingmq_pool(self):
         self._mingmq_pool.release()
@@ -237,9 +516,13 @@ class Pool(object):
     """一个多线程的连接池。提供了一些方法的调用，但是用户只需要关心
     opera这个方法就够了，其它都已经封装好了；
 
+    连接是按需创建的，最多创建size个，空闲超过idle_timeout秒的连接会被
+    关闭，只有空闲超过check_interval秒的连接在借出前才会发送ping检查，
+    所以大多数请求只需要一次网络往返。每个连接池有自己的锁，锁里面不会
+    做任何网络操作；
+
     类成员:
 
-    * ``_LOCK``: 连接池锁；
     * ``_logger``: 用于打印日志的对象；
 
     Command line example:
@@ -251,11 +534,10 @@ class Pool(object):
     >>> pool.release() # 关闭连接
 
     """
-    _LOCK = Lock()
-
     _logger = logging.getLogger('Pool')
 
-    def __init__(self, host, port, user_name, passwd, size):
+    def __init__(self, host, port, user_name, passwd, size, idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL, borrow_timeout=None):
         """主要的作用是初始化连接池，保存连接池的连接信息用于重连
         和重新初始化连接池；
 
@@ -269,6 +551,12 @@ class Pool(object):
         :type passwd: str
         :param size: 连接池大小；
         :type size: int
+        :param idle_timeout: 空闲连接的最长保留时间，单位秒；
+        :type idle_timeout: float
+        :param check_interval: 空闲超过这个时间的连接在借出前要先ping，单位秒；
+        :type check_interval: float
+        :param borrow_timeout: 连接都被借出时最多等待的时间，None表示一直等待；
+        :type borrow_timeout: float
         """
         self._host = host
         self._port = port
@@ -276,62 +564,105 @@ class Pool(object):
         self._passwd = passwd
 
         self._size = size
+        self._idle_timeout = idle_timeout
+        self._check_interval = check_interval
+        self._borrow_timeout = borrow_timeout
 
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        # 空闲连接，元素为(连接, 归还时间)，后进先出，让不常用的连接自然超时
         self._que = deque()
+        # 已经创建(包括借出)的连接数
+        self._created = 0
 
         self._init_pool()
 
     def _init_pool(self):
-        """初始化连接池，会创建Client对象，并且自动登陆，然后将登陆
-        后的Client存放到连接池中；
+        """先创建一个连接，服务器不可用时尽早抛出异常，其它连接按需创建；
+
+        """
+        with self._lock:
+            self._created += 1
+        self._que.append((self._create_conn(), time.time()))
+
+    def _create_conn(self):
+        """创建Client对象并且自动登陆，失败时会归还名额；
+
+        :return: client连接；
+        :rtype: Client
 
         """
-        for i in range(self._size):
+        try:
             cli = Client(self._host, self._port)
-            if cli.login(self._user_name, self._passwd) == SUCCESS:
-                self._que.append(cli)
-            else:
-                self._logger.debug('登录失败')
-
-    def get_conn(self):
-        """从连接池中获取一个连接，然后就可以用这个连接做自己想做的事
-        这个是线程安全的，因为也是必须线程安全。在获取后，会发送ping
-        消息给服务端，如果服务端响应了，证明这个连接是可用的，如果未
-        响应，说明这个连接失效了，或者服务器不可用了。如果连接池中没有
-        连接用了，会重新初始化连接，如果其中一个连接失效了，会抛出异常
-        ，但是不会重新初始化连接池。连接池空时会抛出连接池已空的异常(
-        ClientPoolEmpty)，另外，循环获取连接池中的连接，如果ping不通
-        ，就再循环，直到ping通就返回conn，如若连接池都空了，则初始化连
-        接池，如果失败就不管了；
+            if cli.login(self._user_name, self._passwd) != SUCCESS:
+                cli.close()
+                raise Exception('登录失败')
+            return cli
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _close_conn(self, conn):
+        try:
+            if conn: conn.close()
+        except Exception:
+            self._logger.error(traceback.format_exc())
+
+    def _discard(self, conn):
+        """关闭一个借出的连接并归还名额；
 
+        """
+        self._close_conn(conn)
+        with self._lock:
+            self._created -= 1
+            self._not_empty.notify()
+
+    def get_conn(self, timeout=None):
+        """从连接池中获取一个连接，这个是线程安全的。优先使用最近归还的空闲
+        连接，空闲太久的连接会被关闭，空闲超过check_interval的连接会先ping
+        一次；没有空闲连接时，如果还没有达到size就创建一个新连接，否则等待
+        其它线程归还，等待超时会抛出连接池已空的异常(ClientPoolEmpty)；
+
+        :param timeout: 等待的时间，默认使用borrow_timeout；
+        :type timeout: float
         :return: client连接；
         :rtype: Client
 
         """
-        with Pool._LOCK:
-            try:
-                if len(self._que) != 0:
-                    i = 0
-                    while i < len(self._que):
-                        try:
-                            conn = self._que.popleft()
-                            if conn.ping() is False:
-                                self._logger.debug("conn ping不通，或者为None: %s", repr(conn))
-                            else:
-                                return conn
-                        except Exception as e:
-                            self._logger.error(str(e))
-
-                        i += 1
-
-                    raise ClientPoolEmpty('连接池已空')
-                else:
-                    raise ClientPoolEmpty('连接池已空')
-            except ClientPoolEmpty as e:
-                self._logger.error(str(e))
+        if timeout is None:
+            timeout = self._borrow_timeout
+        deadline = None if timeout is None else time.time() + timeout
 
-                self._init_pool()
-                return self._que.popleft()
+        while True:
+            conn, last_used, expired = None, 0, []
+            with self._lock:
+                while True:
+                    now = time.time()
+                    expired.extend(self._evict_idle(now))
+                    if self._que:
+                        conn, last_used = self._que.pop()
+                        break
+                    if self._created < self._size:
+                        self._created += 1
+                        break
+
+                    remaining = None if deadline is None else deadline - now
+                    if remaining is not None and remaining <= 0:
+                        raise ClientPoolEmpty('连接池已空')
+                    self._not_empty.wait(remaining)
+
+            # 网络操作都在锁外面做
+            self._close_idle(expired)
+
+            if conn is None:
+                return self._create_conn()
+
+            if time.time() - last_used > self._check_interval and not conn.ping():
+                self._logger.debug("conn ping不通，或者为None: %s", repr(conn))
+                self._discard(conn)
+                continue
+
+            return conn
 
     def back_conn(self, conn):
         """将连接归还给连接池，这个操作是线程安全的；
@@ -340,21 +671,44 @@ class Pool(object):
         :type conn: Client
 
         """
-        with Pool._LOCK:
-            self._que.append(conn)
+        with self._lock:
+            now = time.time()
+            self._que.append((conn, now))
+            expired = self._evict_idle(now)
+            self._not_empty.notify()
 
-    def release(self):
-        """释放连接池中所有连接，这个操作是线程安全的；
+        self._close_idle(expired)
+
+    def _evict_idle(self, now):
+        """在锁中调用，从最早归还的一端取出空闲超时的连接，借出时从另一端取，
+        所以高峰过后多出来的连接也会超时关闭；
+
+        :return: 空闲超时的连接；
+        :rtype: list
 
         """
-        with Pool._LOCK:
-            for conn in self._que:
-                try:
-                    if conn: conn.close()
-                except Exception:
-                    self._logger.error(traceback.format_exc())
+        expired = []
+        while self._que and now - self._que[0][1] > self._idle_timeout:
+            expired.append(self._que.popleft()[0])
+            self._created -= 1
+        return expired
+
+    def _close_idle(self, conns):
+        for conn in conns:
+            self._logger.debug('关闭空闲超时的连接: %s', repr(conn))
+            self._close_conn(conn)
+
+    def release(self):
+        """释放连接池中所有空闲连接，这个操作是线程安全的；
 
+        """
+        with self._lock:
+            conns = [conn for conn, _ in self._que]
             self._que.clear()
+            self._created -= len(conns)
+
+        for conn in conns:
+            self._close_conn(conn)
 
     def opera(self, method_name, *args):
         """用来向服务器发送请求，如果没有返回数据，证明客户端与
@@ -379,10 +733,7 @@ class Pool(object):
             raise Exception('返回数据为False，或为None')
         except Exception:
             self._logger.error(traceback.format_exc())
-            try:
-                if conn: conn.close()
-            except Exception:
-                self._logger.error(traceback.format_exc())
+            if conn: self._discard(conn)
 
             conn = None
         finally:
@@ -395,7 +746,7 @@ class Pool(object):
         :rtype: list
 
         """
-        with Pool._LOCK: return [i for i in self._que]
+        with self._lock: return [conn for conn, _ in self._que]
 
 
 class Client(object):
@@ -406,9 +757,17 @@ class Client(object):
 
 
     def __init__(self, host, port):
-        self._sock = socket.socket()
+        """
+        :param host: str，服务器地址，unix://路径表示用unix domain socket连接，这时忽略port
+        :param port: int，服务器端口
+        """
         self._connected = False
-        self._sock.connect((host, port))
+        if host.startswith(UNIX_SCHEME):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(host[len(UNIX_SCHEME):])
+        else:
+            self._sock = socket.socket()
+            self._sock.connect((host, port))
         self._connected = True
 
     def is_connected(self):
@@ -517,11 +876,11 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
-    def declare_queue(self, queue_name):
+    def declare_queue(self, queue_name, arguments=None):
         """
-        声明队列
+        声明队列，arguments为{'type': 'stream', ...}时声明流队列
         """
-        req_declare_queue_msg = ReqDeclareQueueMessage(queue_name)
+        req_declare_queue_msg = ReqDeclareQueueMessage(queue_name, arguments)
         req_pkg = json.dumps(req_declare_queue_msg).encode()
         send_header = struct.pack('!i', len(req_pkg))
         self._send(send_header + req_pkg)
@@ -530,11 +889,97 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
-    def get_data_from_queue(self, queue_name):
+    def declare_exchange(self, exchange_name, exchange_type='direct'):
+        """
+        声明交换机，exchange_type为direct、fanout或者topic
+        """
+        req_pkg = json.dumps(ReqDeclareExchangeMessage(exchange_name, exchange_type)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def delete_exchange(self, exchange_name):
+        """
+        删除交换机
+        """
+        req_pkg = json.dumps(ReqDeleteExchangeMessage(exchange_name)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def bind_queue(self, exchange_name, queue_name, routing_key=''):
         """
-        从队列中获取数据
+        把队列绑定到交换机，topic交换机的routing_key中可以使用*和#
         """
-        req_get_data_from_queue_msg = ReqGetDataFromQueueMessage(queue_name)
+        req_pkg = json.dumps(ReqBindQueueMessage(exchange_name, queue_name, routing_key)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def unbind_queue(self, exchange_name, queue_name, routing_key=''):
+        """
+        解除队列和交换机的绑定
+        """
+        req_pkg = json.dumps(ReqUnbindQueueMessage(exchange_name, queue_name, routing_key)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def publish(self, exchange_name, routing_key, message_data):
+        """
+        向交换机发布任务，json_obj中是每个目标队列的queue_name和message_id
+        """
+        req_pkg = json.dumps(ReqPublishMessage(exchange_name, routing_key, message_data)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def read_from(self, queue_name, offset=None, max_count=100, consumer_group=None):
+        """
+        从流队列的offset开始读取任务，offset为None时从consumer_group提交的位置开始，
+        json_obj中是[{'offset': offset, 'timestamp': 时间戳, 'message_data': 数据}, ...]
+        """
+        req_pkg = json.dumps(ReqReadFromMessage(queue_name, offset, max_count, consumer_group)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def commit_offset(self, queue_name, consumer_group, offset):
+        """
+        提交消费组在流队列中下一次要读取的位置
+        """
+        req_pkg = json.dumps(ReqCommitOffsetMessage(queue_name, consumer_group, offset)).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def get_data_from_queue(self, queue_name, timeout=None):
+        """
+        从队列中获取数据，带timeout时队列为空或者被限速由服务器等待最多timeout秒，
+        有任务就立即返回
+        """
+        req_get_data_from_queue_msg = ReqGetDataFromQueueMessage(queue_name, timeout)
         req_pkg = json.dumps(req_get_data_from_queue_msg).encode()
         send_header = struct.pack('!i', len(req_pkg))
         self._send(send_header + req_pkg)
@@ -543,11 +988,12 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
-    def send_data_to_queue(self, queue_name: str, message_data: str):
+    def send_data_to_queue(self, queue_name: str, message_data: str, dedup_key: str = None, unique_key: str = None):
         """
-        向队列中发送数据
+        向队列中发送数据，带dedup_key时去重窗口内重复的数据不会再放入队列，可以放心重试；
+        唯一键队列中unique_key(默认为message_data)见过的数据不会再放入队列
         """
-        rsdfqm = ReqSendDataToQueueMessage(queue_name, message_data)
+        rsdfqm = ReqSendDataToQueueMessage(queue_name, message_data, dedup_key, unique_key)
         req_pkg = json.dumps(rsdfqm).encode()
         send_header = struct.pack('!i', len(req_pkg))
         self._send(send_header + req_pkg)
@@ -556,6 +1002,19 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
+    def send_datas_to_queue(self, queue_name: str, message_datas: list):
+        """
+        向队列中批量发送数据，json_obj中按顺序返回每条数据的message_id
+        """
+        rsdstqm = ReqSendDatasToQueueMessage(queue_name, message_datas)
+        req_pkg = json.dumps(rsdstqm).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
     def ack_message(self, queue_name: str, message_id: str):
         """
         消息确认
@@ -569,6 +1028,19 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
+    def ack_messages(self, queue_name: str, message_ids: list):
+        """
+        批量消息确认，json_obj中是确认失败的message_id
+        """
+        req_ack_msgs = ReqACKMessagesMessage(queue_name, message_ids)
+        req_pkg = json.dumps(req_ack_msgs).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
     def del_queue(self, queue_name):
         """
         删除队列
@@ -634,11 +1106,12 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
-    def restore_ack_message_id(self, message_id, queue_name):
+    def restore_ack_message_id(self, message_id, queue_name, message_data=None, pub_date=None):
         """
-        恢复ack message_id
+        恢复ack message_id，带上message_data和投递时间pub_date，服务器才能在超时后重发
         """
-        req_restore_ack_message_id_message = ReqRestoreAckMessageIDMessage(message_id, queue_name)
+        req_restore_ack_message_id_message = ReqRestoreAckMessageIDMessage(message_id, queue_name,
+                                                                           message_data, pub_date)
         req_pkg = json.dumps(req_restore_ack_message_id_message).encode()
         send_header = struct.pack('!i', len(req_pkg))
         self._send(send_header + req_pkg)
@@ -660,6 +1133,32 @@ class Client(object):
         recv_header = self._recv(4)
         return self._recv_surplus(recv_header)
 
+    def set_resend_interval(self, resend_interval):
+        """
+        修改重发未确认任务的时间间隔，单位秒
+        """
+        req_set_resend_interval_message = ReqSetResendIntervalMessage(resend_interval)
+        req_pkg = json.dumps(req_set_resend_interval_message).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
+    def get_resend_interval(self):
+        """
+        获取重发未确认任务的时间间隔
+        """
+        req_get_resend_interval_message = ReqGetResendIntervalMessage()
+        req_pkg = json.dumps(req_get_resend_interval_message).encode()
+        send_header = struct.pack('!i', len(req_pkg))
+        self._send(send_header + req_pkg)
+
+        # 接收数据
+        recv_header = self._recv(4)
+        return self._recv_surplus(recv_header)
+
     def ping(self):
         req_ping_message = ReqPingMessage()
         req_pkg = json.dumps(req_ping_message).encode()
@@ -0,0 +1,121 @@
+"""紧凑的二进制记录编码。
+
+日志文件(journal)、内存快照(snapshot)都使用这种编码，它不依赖pickle和json，
+每条记录的格式为::
+
+    | op(1字节) | payload长度(4字节) | payload |
+
+payload由若干个字段组成，每个字段前面都有1字节的类型标记：
+
+* ``s``: utf-8字符串，4字节长度 + 数据；
+* ``b``: 字节串，4字节长度 + 数据；
+* ``d``: 双精度浮点数，8字节；
+* ``q``: 有符号整数，8字节；
+* ``n``: None，没有数据；
+
+读取时如果最后一条记录不完整(比如进程在写日志的时候崩溃)，会直接停止读取，
+不会抛出异常。
+"""
+
+import struct
+
+_HEADER = struct.Struct('!BI')
+_LENGTH = struct.Struct('!I')
+_DOUBLE = struct.Struct('!d')
+_INT = struct.Struct('!q')
+
+_TAG_STR = 0x73  # s
+_TAG_BYTES = 0x62  # b
+_TAG_FLOAT = 0x64  # d
+_TAG_INT = 0x71  # q
+_TAG_NONE = 0x6e  # n
+
+HEADER_SIZE = _HEADER.size
+
+
+def encode_record(op, *fields):
+    """将一条记录编码为字节串；
+
+    :param op: 操作码，0-255；
+    :type op: int
+    :param fields: 字段，只支持str，bytes，float，int，None；
+    :return: 编码后的记录；
+    :rtype: bytes
+
+    """
+    payload = bytearray()
+    for field in fields:
+        if isinstance(field, str):
+            data = field.encode()
+            payload.append(_TAG_STR)
+            payload += _LENGTH.pack(len(data))
+            payload += data
+        elif isinstance(field, (bytes, bytearray, memoryview)):
+            payload.append(_TAG_BYTES)
+            payload += _LENGTH.pack(len(field))
+            payload += field
+        elif field is None:
+            payload.append(_TAG_NONE)
+        elif isinstance(field, float):
+            payload.append(_TAG_FLOAT)
+            payload += _DOUBLE.pack(field)
+        elif isinstance(field, int):
+            payload.append(_TAG_INT)
+            payload += _INT.pack(field)
+        else:
+            raise TypeError('不支持的字段类型: %s' % type(field))
+
+    return _HEADER.pack(op, len(payload)) + payload
+
+
+def decode_fields(buf, start, end):
+    """解码buf[start:end]中的所有字段；
+
+    :return: 字段元组；
+    :rtype: tuple
+
+    """
+    fields = []
+    pos = start
+    while pos < end:
+        tag = buf[pos]
+        pos += 1
+        if tag == _TAG_STR:
+            length, = _LENGTH.unpack_from(buf, pos)
+            pos += 4
+            fields.append(bytes(buf[pos:pos + length]).decode())
+            pos += length
+        elif tag == _TAG_BYTES:
+            length, = _LENGTH.unpack_from(buf, pos)
+            pos += 4
+            fields.append(bytes(buf[pos:pos + length]))
+            pos += length
+        elif tag == _TAG_NONE:
+            fields.append(None)
+        elif tag == _TAG_FLOAT:
+            fields.append(_DOUBLE.unpack_from(buf, pos)[0])
+            pos += 8
+        elif tag == _TAG_INT:
+            fields.append(_INT.unpack_from(buf, pos)[0])
+            pos += 8
+        else:
+            raise ValueError('错误的字段类型标记: %d' % tag)
+
+    return tuple(fields)
+
+
+def iter_records(buf, offset=0):
+    """遍历buf中的所有完整记录，buf可以是bytes，bytearray或者mmap；
+
+    :return: 生成器，每次返回(op, fields, 下一条记录的偏移量)；
+
+    """
+    size = len(buf)
+    while offset + HEADER_SIZE <= size:
+        op, length = _HEADER.unpack_from(buf, offset)
+        start = offset + HEADER_SIZE
+        end = start + length
+        if end > size:
+            break  # 最后一条记录不完整
+        yield op, decode_fields(buf, start, end), end
+        offset = end
@@ -2,14 +2,17 @@ import argparse
 import platform
 import logging
 
-from multiprocessing import Queue, Process, freeze_support, active_children
+from multiprocessing import Process, freeze_support, active_children
 import json
 import time
 
+from mingmq.channel import BatchChannel
+from mingmq.message import ACK_PROCESS_MESSAGE_FIELDS, COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS
 from mingmq.status import ServerStatus
 from mingmq.settings import CONFIG_FILE
 from mingmq.utils import check_config
-from mingmq.process import MQProcess, AckProcess, CompletelyPersistentProcess, NoAckProcess
+from mingmq.snapshot import has_checkpoint
+from mingmq.process import MQProcess, AckProcess, CompletelyPersistentProcess, WriteBehindThread
 
 
 LOGGER = logging.getLogger('Main')
@@ -54,7 +57,35 @@ def main(log_level=logging.DEBUG):
     parser.add_argument('--COMPLETELY_PERSISTENT_PROCESS_DB_FILE', type=str, default=completely_persistent_process_db_file,
                         help='输入服务器确认消息文件名')
 
-    parser.add_argument('--RESEND_INTERVAL', type=int, default=300, help='输入将未ack的任务重新推送到队列的时间间隔')
+    parser.add_argument('--RESEND_INTERVAL', type=int, default=300,
+                        help='输入将未ack的任务重新推送到队列的时间间隔，运行时可以通过SET_RESEND_INTERVAL命令修改')
+
+    parser.add_argument('--PERSISTENT_MODE', type=str, default='process', choices=('process', 'thread'),
+                        help='输入持久化方式：process为独立的持久化进程，thread为服务器进程中的异步写线程，默认，process')
+
+    parser.add_argument('--SNAPSHOT_DIR', type=str, default='',
+                        help='输入内存快照和日志的目录（仅linux下有效），为空则不写快照，重启时从sqlite恢复')
+    parser.add_argument('--SNAPSHOT_INTERVAL', type=int, default=60,
+                        help='输入写内存快照的时间间隔，默认，60')
+
+    parser.add_argument('--UNIX_SOCKET', type=str, default='',
+                        help='输入unix domain socket的路径，同一台机器上的客户端可以用unix://路径连接，为空则不监听')
+
+    parser.add_argument('--DEDUP_WINDOW_SIZE', type=int, default=10000,
+                        help='输入每个队列的去重窗口最多记录的dedup_key数，默认，10000')
+    parser.add_argument('--DEDUP_WINDOW_SECONDS', type=int, default=600,
+                        help='输入dedup_key在去重窗口中保留的秒数，默认，600')
+
+    parser.add_argument('--MEMORY_HIGH_WATERMARK', type=int, default=0,
+                        help='输入内存高水位(MB)，队列和未确认任务的字节数超过后暂停读取只发送任务的连接，'
+                             '发送命令返回RETRY，默认，0，不限制')
+    parser.add_argument('--MEMORY_LOW_WATERMARK', type=int, default=0,
+                        help='输入内存低水位(MB)，字节数降到低水位以下后恢复发送，默认，0，为高水位的80%%')
+
+    parser.add_argument('--IDLE_TIMEOUT', type=int, default=0,
+                        help='输入连接的空闲超时时间(秒)，超过后服务器断开连接，默认，0，不断开')
+    parser.add_argument('--TCP_KEEPALIVE', type=int, default=60,
+                        help='输入tcp连接空闲多少秒后开始发送保活探测，用于发现已经断开的客户端，默认，60，0为不开启')
 
     flags = parser.parse_args()
     try:
@@ -98,6 +129,16 @@ def _read_command_line(flags):
         bd['ACK_PROCESS_DB_FILE'] = flags.ACK_PROCESS_DB_FILE
         bd['COMPLETELY_PERSISTENT_PROCESS_DB_FILE'] = flags.COMPLETELY_PERSISTENT_PROCESS_DB_FILE
         bd['RESEND_INTERVAL'] = flags.RESEND_INTERVAL
+        bd['PERSISTENT_MODE'] = flags.PERSISTENT_MODE
+        bd['SNAPSHOT_DIR'] = flags.SNAPSHOT_DIR
+        bd['SNAPSHOT_INTERVAL'] = flags.SNAPSHOT_INTERVAL
+        bd['UNIX_SOCKET'] = flags.UNIX_SOCKET
+        bd['DEDUP_WINDOW_SIZE'] = flags.DEDUP_WINDOW_SIZE
+        bd['DEDUP_WINDOW_SECONDS'] = flags.DEDUP_WINDOW_SECONDS
+        bd['MEMORY_HIGH_WATERMARK'] = flags.MEMORY_HIGH_WATERMARK
+        bd['MEMORY_LOW_WATERMARK'] = flags.MEMORY_LOW_WATERMARK
+        bd['IDLE_TIMEOUT'] = flags.IDLE_TIMEOUT
+        bd['TCP_KEEPALIVE'] = flags.TCP_KEEPALIVE
 
         with open(CONFIG_FILE, 'w') as f:
             # ensure_ascii写中文, indent 格式化json
@@ -118,40 +159,54 @@ def _read_command_line(flags):
            bd['MAX_CONN'], bd['TIMEOUT'], CONFIG_FILE, bd['ACK_PROCESS_DB_FILE'],
            bd['COMPLETELY_PERSISTENT_PROCESS_DB_FILE'], bd['RESEND_INTERVAL']))
 
+    snapshot_dir = bd.get('SNAPSHOT_DIR', '')
+    # 必须在服务器启动之前判断，服务器启动时会创建新的日志文件
+    restore_from_checkpoint = has_checkpoint(snapshot_dir)
+
     server_status = ServerStatus(bd['HOST'], bd['PORT'], bd['MAX_CONN'],
-                                 bd['USER_NAME'], bd['PASSWD'], bd['TIMEOUT'])
+                                 bd['USER_NAME'], bd['PASSWD'], bd['TIMEOUT'],
+                                 snapshot_dir, bd.get('SNAPSHOT_INTERVAL', 60), bd['RESEND_INTERVAL'],
+                                 bd.get('UNIX_SOCKET', ''), bd.get('DEDUP_WINDOW_SIZE', 10000),
+                                 bd.get('DEDUP_WINDOW_SECONDS', 600),
+                                 bd.get('MEMORY_HIGH_WATERMARK', 0) * 1024 * 1024,
+                                 bd.get('MEMORY_LOW_WATERMARK', 0) * 1024 * 1024,
+                                 bd.get('IDLE_TIMEOUT', 0), bd.get('TCP_KEEPALIVE', 60))
 
-    completely_persistent_process_queue = Queue()
-    ack_process_queue = Queue()
+    completely_persistent_process_queue = BatchChannel(COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS)
+    ack_process_queue = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS)
 
     freeze_support() # 这行没有不能fork
 
-    mmserver = MQProcess(server_status, completely_persistent_process_queue, ack_process_queue)
-    mq_process = Process(target=mmserver.serv_forever, name='mq_process')
-    mq_process.start() # mq服务器第一启动
-
     ackp = AckProcess(bd['ACK_PROCESS_DB_FILE'], bd['HOST'], bd['PORT'],
                       bd['USER_NAME'], bd['PASSWD'], ack_process_queue)
-    ackp.load_send_db_memory() # 恢复数据到内存
-
-    ack_process = Process(target=ackp.serv_forever, name='ack_process')
 
     cpp = CompletelyPersistentProcess(bd['COMPLETELY_PERSISTENT_PROCESS_DB_FILE'],
                                       completely_persistent_process_queue,
                                       bd['HOST'], bd['PORT'],
                                       bd['USER_NAME'], bd['PASSWD'])
-    cpp.load_send_db_memory() # 恢复数据到内存
 
-    completely_persistent_process = Process(target=cpp.serv_forever, name='completely_persistent_process')
+    persistent_mode = bd.get('PERSISTENT_MODE', 'process')
+    if persistent_mode == 'thread':
+        # 持久化在服务器进程中的线程里完成，不需要进程间通信
+        wbt = WriteBehindThread(ackp, cpp, bd['ACK_PROCESS_DB_FILE'],
+                                bd['COMPLETELY_PERSISTENT_PROCESS_DB_FILE'])
+        mmserver = MQProcess(server_status, wbt.completely_persistent_sink(), wbt.ack_sink(), wbt)
+    else:
+        mmserver = MQProcess(server_status, completely_persistent_process_queue, ack_process_queue)
+
+    mq_process = Process(target=mmserver.serv_forever, name='mq_process')
+    mq_process.start() # mq服务器第一启动
 
-    ack_process.start()
-    completely_persistent_process.start()
+    if not restore_from_checkpoint: # 服务器已经从快照恢复了内存
+        ackp.load_send_db_memory() # 恢复数据到内存
+        cpp.load_send_db_memory() # 恢复数据到内存
 
-    noap = NoAckProcess(bd['ACK_PROCESS_DB_FILE'], bd['HOST'], bd['PORT'],
-                        bd['USER_NAME'], bd['PASSWD'])
+    if persistent_mode != 'thread':
+        ack_process = Process(target=ackp.serv_forever, name='ack_process')
+        completely_persistent_process = Process(target=cpp.serv_forever, name='completely_persistent_process')
 
-    no_ack_process = Process(target=noap.serv_forever, name='no_ack_process')
-    no_ack_process.start()
+        ack_process.start()
+        completely_persistent_process.start()
 
     while True:
         for p in active_children():
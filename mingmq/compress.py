@@ -0,0 +1,104 @@
+"""消息数据的透明压缩。
+
+服务器把message_data当作不透明的字符串保存和转发，所以压缩完全在客户端完成：
+生产者把超过阈值的数据压缩后编码成一个带标记的字符串，消费者收到后自动解压。
+服务器的内存、sqlite和日志中保存的都是压缩后的数据，不需要服务器做任何处理。
+
+压缩后的字符串格式为::
+
+    MARKER + 算法名 + ':' + base64(压缩后的数据)
+
+算法名有zlib(总是可用)、lz4(需要安装lz4)、zstd(需要安装zstandard)，还有
+raw，表示没有压缩，用于原始数据恰好以MARKER开头的情况。不以MARKER开头的
+字符串就是原始数据，所以老的生产者发送的数据不受影响。
+
+Command line example:
+
+>>> from mingmq.compress import encode, decode
+>>> data = encode('<html>' * 1000)
+>>> len(data) < 6000, decode(data) == '<html>' * 1000
+(True, True)
+
+"""
+
+import base64
+import zlib
+
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+MARKER = '\x1bmm:'
+# 超过这个长度的数据才会被压缩
+DEFAULT_THRESHOLD = 1024
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if _lz4 is not None:
+    CODECS['lz4'] = (_lz4.compress, _lz4.decompress)
+if _zstd is not None:
+    CODECS['zstd'] = (lambda data: _zstd.ZstdCompressor().compress(data),
+                      lambda data: _zstd.ZstdDecompressor().decompress(data))
+
+
+def best_codec():
+    """返回当前环境中可用的最好的压缩算法名；
+
+    :rtype: str
+    """
+    for codec in ('zstd', 'lz4', 'zlib'):
+        if codec in CODECS:
+            return codec
+
+
+def encode(message_data, codec=None, threshold=DEFAULT_THRESHOLD):
+    """压缩消息数据，数据太短或者压缩后没有变小时原样返回；
+
+    :param message_data: 消息数据；
+    :type message_data: str
+    :param codec: 压缩算法名，None表示使用best_codec()；
+    :type codec: str
+    :param threshold: 超过这个长度才压缩；
+    :type threshold: int
+    :return: 编码后的消息数据；
+    :rtype: str
+    """
+    if len(message_data) > threshold:
+        codec = codec or best_codec()
+        compress, _ = CODECS[codec]
+        data = base64.b64encode(compress(message_data.encode())).decode()
+        encoded = MARKER + codec + ':' + data
+        if len(encoded) < len(message_data):
+            return encoded
+
+    if message_data.startswith(MARKER):
+        return MARKER + 'raw:' + message_data
+    return message_data
+
+
+def decode(message_data):
+    """解压消息数据，没有压缩的数据原样返回；
+
+    :param message_data: 消息数据；
+    :type message_data: str
+    :return: 原始的消息数据；
+    :rtype: str
+    """
+    if not isinstance(message_data, str) or not message_data.startswith(MARKER):
+        return message_data
+
+    codec, _, data = message_data[len(MARKER):].partition(':')
+    if codec == 'raw':
+        return data
+    if codec not in CODECS:
+        raise ValueError('不支持的压缩算法: %s' % codec)
+
+    _, decompress = CODECS[codec]
+    return decompress(base64.b64decode(data)).decode()
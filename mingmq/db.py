@@ -1,13 +1,67 @@
 from sqlite3 import connect
+from contextlib import contextmanager
 import logging
 import traceback
 
 
-class AckProcessDB:
+class _ProcessDB:
+    """每个方法默认都会打开一个新的连接并且立即提交，在transaction()中
+    则共用同一个连接，在退出时一次性提交，用于持久化进程批量写入。
+
+    """
+    def __init__(self, db_file):
+        self._db_file = db_file
+        self._conn = None
+
+    @contextmanager
+    def transaction(self, conn=None):
+        """在同一个事务中执行多个方法；
+
+        :param conn: 外部的连接，传入时由调用者负责提交和关闭，用于跨数据库的事务；
+        :type conn: sqlite3.Connection
+
+        """
+        own = conn is None
+        if own:
+            conn = connect(self._db_file)
+        self._conn = conn
+        try:
+            yield
+            if own:
+                conn.commit()
+        except Exception:
+            if own:
+                conn.rollback()
+            raise
+        finally:
+            self._conn = None
+            if own:
+                conn.close()
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        return connect(self._db_file)
+
+    def _commit(self, conn):
+        if conn is not self._conn:
+            conn.commit()
+
+    def _rollback(self, conn):
+        # 事务中出错的语句已经被sqlite撤销了，不需要回滚整个批次
+        if conn is not self._conn:
+            conn.rollback()
+
+    def _close(self, conn):
+        if conn is not self._conn:
+            conn.close()
+
+
+class AckProcessDB(_ProcessDB):
     _logger = logging.getLogger('AckProcessDB')
     
     def __init__(self, db_file):
-        self._db_file = db_file
+        super().__init__(db_file)
 
         self.create_table()
 
@@ -15,7 +69,7 @@ class AckProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'create table if not exists ack_msg(' \
                   'message_id varchar(100) primary key, ' \
@@ -29,7 +83,7 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def insert_message_id_queue_name_message_data_pub_date(
             self,
@@ -41,63 +95,63 @@ class AckProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'insert into ack_msg(message_id, queue_name, message_data, pub_date) values(?, ?, ?, ?)'
             args = (message_id, queue_name, message_data, pub_date)
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def delete_by_message_id(self, message_id):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'delete from ack_msg where message_id = ?'
             args = (message_id, )
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
             return c.rowcount
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
             return 0
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def delete_by_queue_name(self, queue_name):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'delete from ack_msg where queue_name = ?'
             args = (queue_name, )
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def pagnation(self, pub_date=None):
         """
@@ -108,7 +162,7 @@ class AckProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select message_id, queue_name, message_data, pub_date from ack_msg ' \
                   'order by pub_date desc limit 100'
@@ -127,7 +181,7 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def pagnation_page(self, page):
         """
@@ -138,7 +192,7 @@ class AckProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select message_id, queue_name, message_data, pub_date from ack_msg ' \
                   'order by pub_date desc limit ?, 100'
@@ -153,7 +207,7 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def pagnation_page_no_msg_data(self, page):
         """
@@ -164,7 +218,7 @@ class AckProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select message_id, queue_name, pub_date from ack_msg ' \
                   'order by pub_date desc limit ?, 100'
@@ -179,13 +233,13 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def total_num(self):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select count(message_id) from ack_msg'
             c.execute(sql, )
@@ -197,13 +251,13 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def get_message_data_by_message_id(self, message_id):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select message_data from ack_msg where message_id = ?'
             args = (message_id, )
@@ -216,21 +270,21 @@ class AckProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
 
-class CompletelyPersistentProcessDB:
+class CompletelyPersistentProcessDB(_ProcessDB):
     _logger = logging.getLogger('CompletelyPersistentProcessDB')
 
     def __init__(self, db_file):
-        self._db_file = db_file
+        super().__init__(db_file)
         self.create_table()
 
     def create_table(self):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'create table if not exists send_msg(' \
                   'message_id varchar(100) primary key, ' \
@@ -244,7 +298,7 @@ class CompletelyPersistentProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def insert_message_id_queue_name_message_data_pub_date(
         self,
@@ -256,61 +310,61 @@ class CompletelyPersistentProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'insert into send_msg(message_id, queue_name, message_data, pub_date) values(?, ?, ?, ?)'
             args = (message_id, queue_name, message_data, pub_date)
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def delete_by_message_id(self, message_id):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'delete from send_msg where message_id = ?'
             args = (message_id, )
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def delete_by_queue_name(self, queue_name):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'delete from send_msg where queue_name = ?'
             args = (queue_name, )
             c.execute(sql, args)
             self._logger.debug('[%s][%s] 影响的行数: %s', repr(sql), repr(args)[:100], repr(c.rowcount))
-            conn.commit()
+            self._commit(conn)
         except Exception:
-            if conn: conn.rollback()
+            if conn: self._rollback(conn)
             self._logger.debug(traceback.format_exc())
         finally:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def pagnation_page(self, page):
         """
@@ -321,7 +375,7 @@ class CompletelyPersistentProcessDB:
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select message_id, queue_name, message_data, pub_date from send_msg ' \
                   'order by pub_date asc limit ?, 100'
@@ -336,13 +390,13 @@ class CompletelyPersistentProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
+                self._close(conn)
 
     def total_num(self):
         conn = None
         c = None
         try:
-            conn = connect(self._db_file)
+            conn = self._connect()
             c = conn.cursor()
             sql = 'select count(message_id) from send_msg'
             c.execute(sql, )
@@ -354,4 +408,4 @@ class CompletelyPersistentProcessDB:
             if c:
                 c.close()
             if conn:
-                conn.close()
\ No newline at end of file
+                self._close(conn)
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""交换机，按路由键把一条消息投递到多个队列。
+
+有三种交换机:
+
+- direct: 路由键和绑定键完全相同时投递；
+- fanout: 忽略路由键，投递到所有绑定的队列；
+- topic: 路由键和绑定键都是用'.'分隔的单词，绑定键中'*'匹配一个单词，'#'匹配零个或多个单词。
+
+topic交换机把所有绑定键编译成一棵按单词划分的字典树，路由时沿着路由键的单词向下
+走，耗时只和路由键的长度有关，和绑定的数量无关。
+
+交换机只负责计算目标队列，消息由服务器分别放入每个队列，所有队列共享同一个
+message_data字符串对象，不会复制消息体。
+
+Command line example:
+
+>>> exchange = Exchange('topic')
+>>> exchange.bind('q1', 'stock.*.nyse')
+True
+>>> exchange.bind('q2', 'stock.#')
+True
+>>> sorted(exchange.route('stock.ibm.nyse'))
+['q1', 'q2']
+
+"""
+
+import platform
+
+DIRECT = 'direct'
+FANOUT = 'fanout'
+TOPIC = 'topic'
+EXCHANGE_TYPES = (DIRECT, FANOUT, TOPIC)
+
+
+class _TrieNode:
+    __slots__ = ('children', 'queues')
+
+    def __init__(self):
+        self.children = dict()
+        # 以这个节点结尾的绑定，dict当作有序集合
+        self.queues = dict()
+
+
+class TopicTrie:
+    """topic交换机的绑定键字典树
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, binding_key, queue_name):
+        node = self._root
+        for word in binding_key.split('.'):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = _TrieNode()
+            node = child
+        node.queues[queue_name] = None
+
+    def remove(self, binding_key, queue_name):
+        path = [self._root]
+        words = binding_key.split('.')
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+
+        path[-1].queues.pop(queue_name, None)
+        # 删除没有用的节点
+        for i in range(len(words), 0, -1):
+            node = path[i]
+            if node.queues or node.children:
+                break
+            del path[i - 1].children[words[i - 1]]
+
+    def match(self, routing_key):
+        """
+        :param routing_key: str，路由键
+        :return: dict，匹配的队列名，当作有序集合
+        """
+        words = routing_key.split('.')
+        result = dict()
+        # 多个'#'时同一个节点可能从同一个位置走到多次，记录下来避免重复
+        self._match(self._root, words, 0, result, set())
+        return result
+
+    def _match(self, node, words, i, result, seen):
+        key = (id(node), i)
+        if key in seen:
+            return
+        seen.add(key)
+
+        children = node.children
+        if '#' in children:
+            # '#'可以匹配零个到剩下所有的单词
+            for j in range(i, len(words) + 1):
+                self._match(children['#'], words, j, result, seen)
+
+        if i == len(words):
+            result.update(node.queues)
+            return
+
+        child = children.get(words[i])
+        if child is not None:
+            self._match(child, words, i + 1, result, seen)
+        child = children.get('*')
+        if child is not None:
+            self._match(child, words, i + 1, result, seen)
+
+
+class Exchange:
+    """一个交换机和它的所有绑定
+    """
+
+    def __init__(self, exchange_type):
+        if exchange_type not in EXCHANGE_TYPES:
+            raise ValueError('不支持的交换机类型: %s' % exchange_type)
+        self._type = exchange_type
+        # (queue_name, routing_key) -> None，按绑定的顺序
+        self._bindings = dict()
+        self._direct = dict()
+        self._trie = TopicTrie()
+
+    def get_type(self):
+        return self._type
+
+    def get_bindings(self):
+        """
+        :return: list，[(queue_name, routing_key), ...]
+        """
+        return list(self._bindings)
+
+    def bind(self, queue_name, routing_key=''):
+        """
+        :return: boolean，True成功，False已经绑定过了
+        """
+        if (queue_name, routing_key) in self._bindings:
+            return False
+        self._bindings[(queue_name, routing_key)] = None
+
+        if self._type == DIRECT:
+            self._direct.setdefault(routing_key, dict())[queue_name] = None
+        elif self._type == TOPIC:
+            self._trie.add(routing_key, queue_name)
+        return True
+
+    def unbind(self, queue_name, routing_key=''):
+        """
+        :return: boolean，True成功，False没有这个绑定
+        """
+        if (queue_name, routing_key) not in self._bindings:
+            return False
+        del self._bindings[(queue_name, routing_key)]
+
+        if self._type == DIRECT:
+            queues = self._direct[routing_key]
+            del queues[queue_name]
+            if not queues:
+                del self._direct[routing_key]
+        elif self._type == TOPIC:
+            self._trie.remove(routing_key, queue_name)
+        return True
+
+    def remove_queue(self, queue_name):
+        """
+        删除一个队列的所有绑定，队列被删除时调用
+        """
+        for bound_queue_name, routing_key in self.get_bindings():
+            if bound_queue_name == queue_name:
+                self.unbind(queue_name, routing_key)
+
+    def route(self, routing_key):
+        """
+        :param routing_key: str，路由键
+        :return: list，目标队列名，每个队列只出现一次
+        """
+        if self._type == DIRECT:
+            return list(self._direct.get(routing_key, ()))
+        elif self._type == FANOUT:
+            return list(dict.fromkeys(queue_name for queue_name, _ in self._bindings))
+        return list(self._trie.match(routing_key))
+
+
+class ExchangeMemory:
+    """
+    交换机的内存模型
+    """
+
+    def __init__(self):
+        self._map = dict()
+
+    def get_self(self):
+        return self._map
+
+    def declare(self, exchange_name, exchange_type):
+        """
+        :return: boolean，True成功，False已经存在或者类型错误
+        """
+        if exchange_name in self._map or exchange_type not in EXCHANGE_TYPES:
+            return False
+        self._map[exchange_name] = Exchange(exchange_type)
+        return True
+
+    def delete(self, exchange_name):
+        if exchange_name in self._map:
+            del self._map[exchange_name]
+            return True
+        return False
+
+    def bind(self, exchange_name, queue_name, routing_key=''):
+        if exchange_name in self._map:
+            return self._map[exchange_name].bind(queue_name, routing_key)
+        return False
+
+    def unbind(self, exchange_name, queue_name, routing_key=''):
+        if exchange_name in self._map:
+            return self._map[exchange_name].unbind(queue_name, routing_key)
+        return False
+
+    def remove_queue(self, queue_name):
+        for exchange in self._map.values():
+            exchange.remove_queue(queue_name)
+
+    def route(self, exchange_name, routing_key):
+        """
+        :return: list，目标队列名，None表示没有这个交换机
+        """
+        if exchange_name in self._map:
+            return self._map[exchange_name].route(routing_key)
+        return None
+
+    def get_stat(self):
+        tmp = dict()
+        for k, v in self._map.items():
+            tmp[k] = [v.get_type(), len(v.get_bindings())]
+        return tmp
+
+
+if not platform.platform().startswith('Linux'):
+    from threading import Lock
+
+    _LOCK = Lock()
+
+
+class SyncExchangeMemory(ExchangeMemory):
+    """
+    交换机的内存模型，线程安全
+    """
+
+    def declare(self, exchange_name, exchange_type):
+        with _LOCK:
+            return super().declare(exchange_name, exchange_type)
+
+    def delete(self, exchange_name):
+        with _LOCK:
+            return super().delete(exchange_name)
+
+    def bind(self, exchange_name, queue_name, routing_key=''):
+        with _LOCK:
+            return super().bind(exchange_name, queue_name, routing_key)
+
+    def unbind(self, exchange_name, queue_name, routing_key=''):
+        with _LOCK:
+            return super().unbind(exchange_name, queue_name, routing_key)
+
+    def remove_queue(self, queue_name):
+        with _LOCK:
+            return super().remove_queue(queue_name)
+
+    def route(self, exchange_name, routing_key):
+        with _LOCK:
+            return super().route(exchange_name, routing_key)
+
+    def get_stat(self):
+        with _LOCK:
+            return super().get_stat()
@@ -2,61 +2,154 @@
 
 import json
 import logging
-import math
 import platform
 import socket
 import struct
 import time
 import traceback
-from multiprocessing import Queue
 
 if platform.platform().startswith('Linux'):
-    from mingmq.memory import QueueMemory, TaskAckMemory
+    from mingmq.memory import QueueMemory, TaskAckMemory, DedupMemory
+    from mingmq.exchange import ExchangeMemory
+    from mingmq.segment import StreamMemory
+    from mingmq.bloom import UniqueMemory
 else:
     from mingmq.memory import SyncQueueMemory as QueueMemory, SyncTaskAckMemory as TaskAckMemory
+    from mingmq.memory import SyncDedupMemory as DedupMemory
+    from mingmq.exchange import SyncExchangeMemory as ExchangeMemory
+    from mingmq.segment import SyncStreamMemory as StreamMemory
+    from mingmq.bloom import SyncUniqueMemory as UniqueMemory
 
 from mingmq.memory import StatMemory
 
-from mingmq.message import (ResMessage, SUCCESS, FAIL, MESSAGE_TYPE, Task,
-                            MAX_DATA_LENGTH, GET, SEND, ACK, PipeAckProcessGetMessage,
+from mingmq.channel import BatchChannel
+from mingmq.message import (ResMessage, SUCCESS, FAIL, RETRY, MESSAGE_TYPE, Task,
+                            MAX_DATA_LENGTH, GET, SEND, ACK, PipeAckProcessGetMessage, message_id_time, gen_message_id,
                             PipeAckProcessAckMessage, PipeDeleteQueueNoackMessage,
                             PipeDeleteAckMessageID, PipeCompletelyPersistentProcessSendMessage,
                             PipeCompletelyPersistentProcessGetMessage, PipeCompletelyPersistentProcessDeleteQueueMessage)
 from mingmq.utils import to_json, check_msg
+from mingmq.snapshot import Journal
+from mingmq.segment import check_arguments, QUEUE_TYPE_STREAM
 from mingmq.status import ServerStatus
+from mingmq.waiter import GetWaiters
 
 
-class Handler:
-    _logger = logging.getLogger('Handler')
-    
+# 每个可读事件最多读取的字节数，大的请求分多轮事件循环读完，不会占住事件循环
+RECV_BUDGET = 256 * 1024
+# 超过这个大小的请求由服务器推迟到这一轮的小请求之后处理
+LARGE_FRAME_BYTES = 1024 * 1024
+
+
+def _frame(res_msg):
+    res_pkg = json.dumps(res_msg).encode()
+    return struct.pack('!i', len(res_pkg)) + res_pkg
+
+
+# 不带数据的响应是固定的，在导入时就编码好，包括长度头
+_SUCCESS_FRAMES = {name: _frame(ResMessage(_type, SUCCESS, [])) for name, _type in MESSAGE_TYPE.items()}
+_FAIL_FRAMES = {name: _frame(ResMessage(_type, FAIL, [])) for name, _type in MESSAGE_TYPE.items()}
+# 队列为空时GET_DATA_FROM_QUEUE的响应
+_EMPTY_QUEUE_FRAME = _frame(ResMessage(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], FAIL, [None]))
+# 唯一键队列中已经见过unique_key时SEND_DATA_TO_QUEUE的响应，和dedup_key重复时一样是成功的，
+# 生产者不需要把它当作发送失败
+_DUPLICATE_FRAME = _frame(ResMessage(MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], SUCCESS,
+                                     [{'message_id': None, 'duplicate': True}]))
+
+# 往队列里放任务的命令，内存超过高水位时不执行，返回RETRY
+_PUBLISH_TYPES = ('SEND_DATA_TO_QUEUE', 'SEND_DATAS_TO_QUEUE', 'PUBLISH')
+# 从队列里取走任务的命令，内存超过高水位时照常执行，让内存降下来
+_CONSUME_TYPES = ('GET_DATA_FROM_QUEUE', 'ACK_MESSAGE', 'ACK_MESSAGES', 'READ_FROM', 'COMMIT_OFFSET')
+# retry_after为建议客户端等待的秒数
+_RETRY_FRAMES = {MESSAGE_TYPE[name]: _frame(ResMessage(MESSAGE_TYPE[name], RETRY, [{'retry_after': 1}]))
+                 for name in _PUBLISH_TYPES}
+_CONSUME_TYPE_VALUES = frozenset(MESSAGE_TYPE[name] for name in _CONSUME_TYPES)
+# 连接记录的未确认消息超过这个数时清理一次已经不在TaskAckMemory中的消息
+_PRUNE_INFLIGHT = 1024
+# 线程模式下长轮询检查空队列的间隔
+_POLL_INTERVAL = 0.05
+
+
+def _retry_frame(_type, retry_after):
+    return _frame(ResMessage(_type, RETRY, [{'retry_after': round(retry_after, 3)}]))
+
+
+class Broker:
+    """所有连接共享的服务器状态，每个连接只保存一个对它的引用
+    """
+    __slots__ = ('queue_memory', 'task_ack_memory', 'stat_memory', 'server_status',
+                 'completely_persistent_process_queue', 'ack_process_queue', 'journal',
+                 'exchange_memory', 'stream_memory', 'dedup_memory', 'unique_memory', 'waiters')
+
     def __init__(
             self,
-            sock: socket.socket,
-            addr: str,
             queue_memory: QueueMemory,
             task_ack_memory: TaskAckMemory,
             stat_memory: StatMemory,
             server_status: ServerStatus,
-            completely_persistent_process_queue: Queue,
-            ack_process_queue: Queue
+            completely_persistent_process_queue: BatchChannel,
+            ack_process_queue: BatchChannel,
+            journal: Journal = None,
+            exchange_memory: ExchangeMemory = None,
+            stream_memory: StreamMemory = None,
+            dedup_memory: DedupMemory = None,
+            unique_memory: UniqueMemory = None,
+            waiters: GetWaiters = None
     ):
+        self.queue_memory = queue_memory
+        self.task_ack_memory = task_ack_memory
+        self.stat_memory = stat_memory
+        self.server_status = server_status
+        self.completely_persistent_process_queue = completely_persistent_process_queue
+        self.ack_process_queue = ack_process_queue
+        self.journal = journal
+        self.exchange_memory = exchange_memory if exchange_memory is not None else ExchangeMemory()
+        self.stream_memory = stream_memory if stream_memory is not None else StreamMemory()
+        self.dedup_memory = dedup_memory if dedup_memory is not None else DedupMemory()
+        self.unique_memory = unique_memory if unique_memory is not None else UniqueMemory()
+        # 长轮询的GET请求，只有epoll模式使用，线程模式下每个连接在自己的线程中等待
+        self.waiters = waiters
+
+    def notify(self, queue_name):
+        """队列中放入了任务，唤醒等待这个队列的长轮询请求
+        """
+        if self.waiters is not None:
+            self.waiters.notify(queue_name)
+
+
+class Handler:
+    """一个客户端连接
+
+    大量空闲连接时每个连接的开销都很重要，所以使用__slots__，共享的状态都在Broker
+    中，空闲的连接不保存读缓冲区。
+    """
+    _logger = logging.getLogger('Handler')
+    __slots__ = ('_sock', '_addr', '_broker', '_logged_in', '_connected', '_buf', '_should_read', '_read_size',
+                 '_ok', '_published', '_consumed', 'last_active', '_inflight', '_prune_at')
+
+    def __init__(self, sock: socket.socket, addr: str, broker: Broker):
         self._sock = sock
         self._addr = addr
-        self._queue_memory = queue_memory
-        self._stat_memory = stat_memory
-        self._task_ack_memory = task_ack_memory
-        self._session_id = None
+        self._broker = broker
+        self._logged_in = False
         self._connected = True
-        self.server_status = server_status
-        self._completely_persistent_process_queue = completely_persistent_process_queue
-        self._ack_process_queue = ack_process_queue
 
-        self._buf: bytes = b''
+        # 读取请求体时才创建，bytearray追加是均摊O(1)的，大的请求分很多次读完时不会反复复制
+        self._buf = None
         self._should_read = 0
         self._read_size = 0
 
         self._ok = False
 
+        # 这个连接发送过/消费过任务，用于内存超过高水位时判断是否暂停读取
+        self._published = False
+        self._consumed = False
+        # 最后一次收到数据的时间(time.monotonic())，由服务器在读事件中更新，用于空闲超时
+        self.last_active = 0.0
+        # 投递给这个连接还没有确认的消息，message_id -> queue_name，第一次投递时才创建
+        self._inflight = None
+        self._prune_at = _PRUNE_INFLIGHT
+
 
     def is_connected(self):
         return self._connected
@@ -64,9 +157,74 @@ class Handler:
     def is_ok(self):
         return self._ok
 
+    def get_frame_size(self):
+        """
+        :return: int，正在读取或者已经读完的请求的大小
+        """
+        return self._read_size
+
+    def is_publish_only(self):
+        """
+        :return: boolean，只发送过任务、没有消费过任务的连接
+        """
+        return self._published and not self._consumed
+
     def fileno(self):
         return self._sock.fileno()
 
+    def requeue_unacked(self):
+        """连接断开时把投递给这个连接、还没有确认的消息立即放回队列的头部，不用等
+        RESEND_INTERVAL之后再重发，旧的message_id作废；
+
+        :return: int，放回队列的消息数
+        """
+        inflight = self._inflight
+        if not inflight:
+            return 0
+        self._inflight = None
+
+        broker = self._broker
+        count = 0
+        # 倒着放回头部，保持原来的顺序
+        for message_id, queue_name in reversed(list(inflight.items())):
+            entry = broker.task_ack_memory.pop_message(queue_name, message_id)
+            if entry is None:
+                continue  # 已经确认、超时重发或者队列被删除了
+            message_data = entry[0]
+            if broker.journal: broker.journal.ack(queue_name, message_id)
+            broker.ack_process_queue.put_nowait(PipeAckProcessAckMessage(message_id, queue_name))
+
+            if message_data is None:
+                self._logger.error('未确认的任务没有数据，无法放回队列: %s, %s', queue_name, message_id)
+                continue
+
+            task = Task(message_data)
+            if broker.queue_memory.put_front(queue_name, task):
+                if broker.journal: broker.journal.requeue(queue_name, task)
+                broker.stat_memory.set('redeliver_' + queue_name, 1)
+                broker.notify(queue_name)
+                broker.completely_persistent_process_queue.put_nowait(
+                    PipeCompletelyPersistentProcessSendMessage(queue_name, message_data, task['message_id']))
+                count += 1
+
+        if count:
+            self._logger.info('客户端[IP %s]断开，%d个未确认的任务放回队列头部。', repr(self._addr), count)
+        return count
+
+    def _track(self, queue_name, message_id):
+        inflight = self._inflight
+        if inflight is None:
+            inflight = self._inflight = dict()
+        inflight[message_id] = queue_name
+
+        if len(inflight) >= self._prune_at:
+            # 超时重发、被其它连接确认或者队列被删除的消息不会从这里删除，定期清理
+            has = self._broker.task_ack_memory.has
+            for mid, qname in list(inflight.items()):
+                if not has(qname, mid):
+                    del inflight[mid]
+            self._prune_at = max(_PRUNE_INFLIGHT, len(inflight) * 2)
+
     def close(self):
         self._sock.close()
         self._logger.debug('客户端[IP %s]已断开。', repr(self._addr))
@@ -75,17 +233,18 @@ class Handler:
         if self.is_connected() and self._ok is False:
             if self._should_read == 0:
                 try:
-                    self._header = self._recv(4)
-                    if self._header:
-                        self._read_size, = struct.unpack('!i', self._header)
+                    header = self._recv(4)
+                    if header:
+                        self._read_size, = struct.unpack('!i', header)
                         self._should_read = min(self._read_size, MAX_DATA_LENGTH)
+                        self._buf = bytearray()
                     else:
                         self._connected = False
                 except:
                     self._logger.error(traceback.format_exc())
                     self._connected = False
             else:
-                buf = self._recv(self._should_read)
+                buf = self._recv(min(self._should_read, RECV_BUDGET))
                 if buf:
                     self._buf += buf
                     self._should_read -= len(buf)
@@ -100,7 +259,7 @@ class Handler:
         if self.is_connected() and self._ok:
             self._deal_message(self._buf)
             self._ok = False
-            self._buf = b''
+            self._buf = None
 
     def handle_epoll_mode_read(self):
         self._handle_read()
@@ -112,18 +271,21 @@ class Handler:
         while self.is_connected():
             self._handle_read()
             self._handle_write()
+            # 线程模式下没有事件循环，每处理完一个请求就发送给持久化进程
+            self._broker.completely_persistent_process_queue.flush()
+            self._broker.ack_process_queue.flush()
 
     def _deal_message(self, buf):
         msg = to_json(buf)
 
         if msg is False:
-            res_msg = ResMessage(MESSAGE_TYPE['DATA_WRONG'], FAIL, [])
-            res_pkg = json.dumps(res_msg).encode()
-            self._send_data(res_pkg)
+            self._send_frame(_FAIL_FRAMES['DATA_WRONG'])
             self._connected = False
             return
 
-        self._logger.debug('客户端[IP %s]发来数据转换成JSON对象[%s]。', repr(self._addr), repr(msg)[:100])
+        if self._logger.isEnabledFor(logging.DEBUG):
+            # 大的请求repr一次要十几毫秒，不输出日志时不要计算
+            self._logger.debug('客户端[IP %s]发来数据转换成JSON对象[%s]。', repr(self._addr), repr(msg)[:100])
 
         if msg is not False:  # 如果msg为False则断开连接
             if check_msg(msg) is not False:
@@ -138,94 +300,114 @@ class Handler:
 
     def _dispatch_request(self, msg):
         _type = msg['type']
-        if _type == MESSAGE_TYPE['LOGOUT']:
-            self._logout(msg)
-        elif _type == MESSAGE_TYPE['DECLARE_QUEUE']:
-            self._declare_queue(msg)
-        elif _type == MESSAGE_TYPE['GET_DATA_FROM_QUEUE']:
-            self._get_data_from_queue(msg)
-        elif _type == MESSAGE_TYPE['SEND_DATA_TO_QUEUE']:
-            self._send_data_to_queue(msg)
-        elif _type == MESSAGE_TYPE['ACK_MESSAGE']:
-            self._ack_message(msg)
-        elif _type == MESSAGE_TYPE['GET_SPEED']:
-            self._get_speed(msg)
-        elif _type == MESSAGE_TYPE['GET_STAT']:
-            self._get_stat()
-        elif _type == MESSAGE_TYPE['DELETE_QUEUE']:
-            self._delete_queue(msg)
-        elif _type == MESSAGE_TYPE['CLEAR_QUEUE']:
-            self._clear_queue(msg)
-        elif _type == MESSAGE_TYPE['DELETE_ACK_MESSAGE_ID']:
-            self._delete_ack_message_id_queue_name(msg)
-        elif _type == MESSAGE_TYPE['RESTORE_ACK_MESSAGE_ID']:
-            self._restore_ack_message_id(msg)
-        elif _type == MESSAGE_TYPE['RESTORE_SEND_MESSAGE']:
-            self._restore_send_message(msg)
-        elif _type == MESSAGE_TYPE['PING']:
-            self._ping()
-        else:
+        method = self._DISPATCH[_type] if type(_type) is int and 0 <= _type < len(self._DISPATCH) else None
+        if method is None:
             self._not_found(msg)
+        elif _type in _RETRY_FRAMES:
+            self._published = True
+            if self._broker.server_status.is_memory_blocked():
+                self._send_frame(_RETRY_FRAMES[_type])
+                return
+            start = time.perf_counter()
+            method(self, msg)
+            self._broker.stat_memory.observe_service(self._DISPATCH_NAMES[_type], time.perf_counter() - start)
+        else:
+            if _type in _CONSUME_TYPE_VALUES:
+                self._consumed = True
+            start = time.perf_counter()
+            method(self, msg)
+            self._broker.stat_memory.observe_service(self._DISPATCH_NAMES[_type], time.perf_counter() - start)
+
+    def _ping(self, msg):
+        self._send_frame(_SUCCESS_FRAMES['PING'])
+
+    def _set_resend_interval(self, msg):
+        if self._data_wrong('_set_resend_interval', ('resend_interval',), msg) is not False:
+            resend_interval = msg['resend_interval']
+
+            if isinstance(resend_interval, int) and resend_interval > 0:
+                self._broker.server_status.set_resend_interval(resend_interval)
+                self._send_frame(_SUCCESS_FRAMES['SET_RESEND_INTERVAL'])
+            else:
+                self._send_frame(_FAIL_FRAMES['SET_RESEND_INTERVAL'])
 
-    def _ping(self):
-        res_msg = ResMessage(MESSAGE_TYPE['PING'], SUCCESS, [])
+    def _get_resend_interval(self, msg):
+        res_msg = ResMessage(MESSAGE_TYPE['GET_RESEND_INTERVAL'], SUCCESS, [{
+            'resend_interval': self._broker.server_status.get_resend_interval()
+        }])
         res_pkg = json.dumps(res_msg).encode()
         self._send_data(res_pkg)
 
     def _restore_send_message(self, msg):
         if self._data_wrong('_restore_ack_message_id', ('message_id', 'queue_name', 'message_data'), msg) is not False:
             queue_name = msg['queue_name']
-            # message_id = msg['message_id']
+            message_id = msg['message_id']
             message_data = msg['message_data']
 
-            task = Task(message_data)
+            task = Task(message_data, message_id)
 
-            if self._queue_memory.put(queue_name, task):
-                res_msg = ResMessage(MESSAGE_TYPE['RESTORE_SEND_MESSAGE'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+            if self._broker.queue_memory.put(queue_name, task):
+                if self._broker.journal: self._broker.journal.put(queue_name, task)
+                self._broker.notify(queue_name)
+
+                self._send_frame(_SUCCESS_FRAMES['RESTORE_SEND_MESSAGE'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['RESTORE_SEND_MESSAGE'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_FAIL_FRAMES['RESTORE_SEND_MESSAGE'])
 
     def _restore_ack_message_id(self, msg):
         if self._data_wrong('_restore_ack_message_id', ('message_id', 'queue_name'), msg) is not False:
             queue_name = msg['queue_name']
             message_id = msg['message_id']
+            message_data = msg.get('message_data')
+            delivered_at = msg.get('pub_date') or time.time()
 
-            if self._task_ack_memory.put(queue_name, message_id):
-                res_msg = ResMessage(MESSAGE_TYPE['RESTORE_ACK_MESSAGE_ID'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+            if self._broker.task_ack_memory.put(queue_name, message_id, message_data, delivered_at):
+                if self._broker.journal:
+                    self._broker.journal.inflight(queue_name, message_id, message_data, delivered_at)
+
+                self._send_frame(_SUCCESS_FRAMES['RESTORE_ACK_MESSAGE_ID'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['RESTORE_ACK_MESSAGE_ID'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_FAIL_FRAMES['RESTORE_ACK_MESSAGE_ID'])
 
     def _delete_ack_message_id_queue_name(self, msg):
         if self._data_wrong('_delete_ack_message_id', ('message_id', 'queue_name'), msg) is not False:
             queue_name = msg['queue_name']
             message_id = msg['message_id']
 
-            if self._task_ack_memory.get(queue_name, message_id):
+            if self._broker.task_ack_memory.get(queue_name, message_id):
+                if self._broker.journal: self._broker.journal.ack(queue_name, message_id)
 
                 pdam = PipeDeleteAckMessageID(queue_name, message_id)
-                self._ack_process_queue.put_nowait(pdam)
+                self._broker.ack_process_queue.put_nowait(pdam)
 
-                res_msg = ResMessage(MESSAGE_TYPE['DELETE_ACK_MESSAGE_ID'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_SUCCESS_FRAMES['DELETE_ACK_MESSAGE_ID'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['DELETE_ACK_MESSAGE_ID'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_FAIL_FRAMES['DELETE_ACK_MESSAGE_ID'])
+
+    def _get_stat(self, msg):
+        metrics = self._broker.stat_memory.get_metrics()
+        metrics['connections'] = self._broker.server_status.get_connections()
+        metrics['memory'] = {
+            'used_bytes': self._broker.queue_memory.get_total_bytes() + self._broker.task_ack_memory.get_total_bytes(),
+            'high_watermark': self._broker.server_status.get_memory_high_watermark(),
+            'low_watermark': self._broker.server_status.get_memory_low_watermark(),
+            'blocked': self._broker.server_status.is_memory_blocked(),
+            'paused_connections': self._broker.server_status.get_paused_connections()
+        }
+        metrics['channels'] = {
+            'completely_persistent': self._broker.completely_persistent_process_queue.get_stat(),
+            'ack': self._broker.ack_process_queue.get_stat()
+        }
 
-    def _get_stat(self):
         res_msg = ResMessage(MESSAGE_TYPE['GET_SPEED'], SUCCESS, [{
-            'queue_infor': self._queue_memory.get_stat(),
-            'speed_infor': self._stat_memory.get_stat(),
-            'task_ack_infor': self._task_ack_memory.get_stat()
+            'queue_infor': self._broker.queue_memory.get_stat(),
+            'speed_infor': self._broker.stat_memory.get_stat(),
+            'task_ack_infor': self._broker.task_ack_memory.get_stat(),
+            'exchange_infor': self._broker.exchange_memory.get_stat(),
+            'stream_infor': self._broker.stream_memory.get_stat(),
+            'dedup_infor': self._broker.dedup_memory.get_stat(),
+            'unique_infor': self._broker.unique_memory.get_stat(),
+            'metrics': metrics
         }])
         res_pkg = json.dumps(res_msg).encode()
         self._send_data(res_pkg)
@@ -238,9 +420,9 @@ class Handler:
             get_stat_var = 'get_' + queue_name
             ack_stat_var = 'ack_' + queue_name
 
-            send_speed = self._stat_memory.get(send_stat_var)
-            get_speed = self._stat_memory.get(get_stat_var)
-            ack_speed = self._stat_memory.get(ack_stat_var)
+            send_speed = self._broker.stat_memory.get_speed(send_stat_var)
+            get_speed = self._broker.stat_memory.get_speed(get_stat_var)
+            ack_speed = self._broker.stat_memory.get_speed(ack_stat_var)
 
             res_msg = ResMessage(MESSAGE_TYPE['GET_SPEED'], SUCCESS, [{
                 'send_speed': send_speed,
@@ -258,34 +440,55 @@ class Handler:
                 break
 
         if err > 0:
-            self._logger.error('%s, 参数错误 %s, 需要参数 %s', opera, msg[:100], args)
+            self._logger.error('%s, 参数错误 %s, 需要参数 %s', opera, repr(msg)[:100], args)
 
-            res_msg = ResMessage(MESSAGE_TYPE['DATA_WRONG'], FAIL, [])
-            res_pkg = json.dumps(res_msg).encode()
-            self._send_data(res_pkg)
+            self._send_frame(_FAIL_FRAMES['DATA_WRONG'])
             return False
         return True
 
+    def _ack(self, queue_name, message_id):
+        delivered_at = self._broker.task_ack_memory.pop(queue_name, message_id)
+        if delivered_at is not None:
+            self._broker.stat_memory.observe_latency('ack', queue_name, time.time() - delivered_at)
+            if self._broker.journal: self._broker.journal.ack(queue_name, message_id)
+
+            papam = PipeAckProcessAckMessage(message_id, queue_name)
+            self._broker.ack_process_queue.put_nowait(papam)
+            if self._inflight: self._inflight.pop(message_id, None)
+            return True
+        return False
+
     def _ack_message(self, msg):
         try:
             if self._data_wrong('_ack_message', ('queue_name', 'message_id'), msg) is not False:
                 queue_name = msg['queue_name']
                 message_id = msg['message_id']
-                if self._task_ack_memory.get(queue_name, message_id):
-                    papam = PipeAckProcessAckMessage(message_id, queue_name)
-                    self._ack_process_queue.put_nowait(papam)
+                if self._ack(queue_name, message_id):
+                    self._stat(ACK, queue_name)
+                    self._send_frame(_SUCCESS_FRAMES['ACK_MESSAGE'])
+                else:
+                    self._send_frame(_FAIL_FRAMES['ACK_MESSAGE'])
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _ack_messages(self, msg):
+        """批量确认消息，json_obj中返回确认失败的message_id"""
+        try:
+            if self._data_wrong('_ack_messages', ('queue_name', 'message_ids'), msg) is not False:
+                queue_name = msg['queue_name']
+                failed = [message_id for message_id in msg['message_ids']
+                          if not self._ack(queue_name, message_id)]
+
+                self._stat(ACK, queue_name, len(msg['message_ids']) - len(failed))
 
-                    res_msg = ResMessage(MESSAGE_TYPE['ACK_MESSAGE'], SUCCESS, [])
+                if failed:
+                    res_msg = ResMessage(MESSAGE_TYPE['ACK_MESSAGES'], FAIL, failed)
                     res_pkg = json.dumps(res_msg).encode()
                     self._send_data(res_pkg)
                 else:
-                    res_msg = ResMessage(MESSAGE_TYPE['ACK_MESSAGE'], FAIL, [])
-                    res_pkg = json.dumps(res_msg).encode()
-                    self._send_data(res_pkg)
+                    self._send_frame(_SUCCESS_FRAMES['ACK_MESSAGES'])
         except:
             self._logger.error(traceback.format_exc())
-        finally:
-            self._stat(ACK, queue_name)
 
     def _send_data_to_queue(self, msg):
         try:
@@ -293,57 +496,222 @@ class Handler:
                 queue_name = msg['queue_name']
                 message_data = msg['message_data']
 
-                if isinstance(message_data, str):
-                    task = Task(message_data)
-                    if self._queue_memory.put(queue_name, task):
-                        pcppsm = PipeCompletelyPersistentProcessSendMessage(queue_name, message_data, task['message_id'])
-                        self._completely_persistent_process_queue.put_nowait(pcppsm)
-
-                        res_msg = ResMessage(MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], SUCCESS, [])
-                        res_pkg = json.dumps(res_msg).encode()
-                        self._send_data(res_pkg)
-                    else:
-                        res_msg = ResMessage(MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], FAIL, [])
-                        res_pkg = json.dumps(res_msg).encode()
-                        self._send_data(res_pkg)
+                dedup_key = msg.get('dedup_key')
+                # 唯一键队列默认用任务字符串本身作为唯一键
+                unique_key = msg.get('unique_key')
+                if unique_key is None:
+                    unique_key = message_data
+
+                if not isinstance(message_data, str) or not isinstance(unique_key, str):
+                    self._send_frame(_FAIL_FRAMES['SEND_DATA_TO_QUEUE'])
+                elif dedup_key is not None:
+                    self._send_data_with_dedup_key(queue_name, message_data, dedup_key, unique_key)
+                elif self._is_duplicate(queue_name, unique_key):
+                    self._send_frame(_DUPLICATE_FRAME)
+                elif self._put(queue_name, Task(message_data)):
+                    self._stat(SEND, queue_name)
+                    self._send_frame(_SUCCESS_FRAMES['SEND_DATA_TO_QUEUE'])
                 else:
-                    res_msg = ResMessage(MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], FAIL, [])
+                    self._send_frame(_FAIL_FRAMES['SEND_DATA_TO_QUEUE'])
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _send_data_with_dedup_key(self, queue_name, message_data, dedup_key, unique_key):
+        """带dedup_key的任务，去重窗口中已经有这个dedup_key时不再放入队列，
+        json_obj中是[{'message_id': 第一次发送时的message_id, 'duplicate': 是否重复}]
+
+        """
+        if not isinstance(dedup_key, str) or not self._has_queue(queue_name):
+            self._send_frame(_FAIL_FRAMES['SEND_DATA_TO_QUEUE'])
+            return
+
+        task = Task(message_data)
+        message_id = self._broker.dedup_memory.put(queue_name, dedup_key, task['message_id'])
+        if message_id is None:
+            if self._is_duplicate(queue_name, unique_key):
+                self._broker.dedup_memory.remove(queue_name, dedup_key)
+                self._send_frame(_DUPLICATE_FRAME)
+                return
+            if not self._put(queue_name, task):
+                self._broker.dedup_memory.remove(queue_name, dedup_key)
+                self._send_frame(_FAIL_FRAMES['SEND_DATA_TO_QUEUE'])
+                return
+            self._stat(SEND, queue_name)
+
+        res_msg = ResMessage(MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], SUCCESS, [{
+            'message_id': message_id or task['message_id'],
+            'duplicate': message_id is not None
+        }])
+        self._send_data(json.dumps(res_msg).encode())
+
+    def _is_duplicate(self, queue_name, unique_key):
+        """唯一键队列中已经见过unique_key时返回True，不是唯一键队列时返回False
+
+        """
+        added = self._broker.unique_memory.add(queue_name, unique_key)
+        if added and self._broker.journal: self._broker.journal.unique_add(queue_name, unique_key)
+        return added is False
+
+    def _send_datas_to_queue(self, msg):
+        """批量推送任务，json_obj中按顺序返回每个任务的message_id，唯一键队列中
+        重复的任务为None"""
+        try:
+            if self._data_wrong('_send_datas_to_queue', ('queue_name', 'message_datas'), msg) is not False:
+                queue_name = msg['queue_name']
+                message_datas = msg['message_datas']
+
+                if isinstance(message_datas, list) and \
+                        all(isinstance(message_data, str) for message_data in message_datas) and \
+                        self._has_queue(queue_name):
+                    message_ids = []
+                    n = 0
+                    for message_data in message_datas:
+                        if self._is_duplicate(queue_name, message_data):
+                            message_ids.append(None)
+                            continue
+                        task = Task(message_data)
+                        self._put(queue_name, task)
+                        message_ids.append(task['message_id'])
+                        n += 1
+                    self._stat(SEND, queue_name, n)
+
+                    res_msg = ResMessage(MESSAGE_TYPE['SEND_DATAS_TO_QUEUE'], SUCCESS, message_ids)
                     res_pkg = json.dumps(res_msg).encode()
                     self._send_data(res_pkg)
+                else:
+                    self._send_frame(_FAIL_FRAMES['SEND_DATAS_TO_QUEUE'])
         except:
             self._logger.error(traceback.format_exc())
-        finally:
-            self._stat(SEND, queue_name)
 
     def _get_data_from_queue(self, msg):
+        """带timeout(秒)时，队列为空或者被限速就挂起这个请求，有任务或者超时的时候再
+        响应，见mingmq.waiter；不带timeout时被限速返回RETRY，retry_after为还需要
+        等待的秒数
+
+        """
         try:
             if self._data_wrong('_get_data_from_queue', ('queue_name',), msg) is not False:
                 queue_name = msg['queue_name']
-                task = self._queue_memory.get(queue_name)
+                timeout = msg.get('timeout')
+                if timeout is not None and (type(timeout) not in (int, float) or timeout < 0):
+                    self._send_frame(_FAIL_FRAMES['GET_DATA_FROM_QUEUE'])
+                    return
+
+                now = time.monotonic()
+                task, wait = self._broker.queue_memory.get_limited(queue_name, now)
+                if task is not None:
+                    self._deliver(queue_name, task)
+                elif timeout and queue_name in self._broker.queue_memory.get_self():
+                    if self._broker.waiters is not None:
+                        self._broker.waiters.add(self, queue_name, now + timeout, wait, now)
+                    else:
+                        self._poll_queue(queue_name, now + timeout, wait)
+                elif wait:
+                    self._send_frame(_retry_frame(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], wait))
+                else:
+                    self._send_frame(_EMPTY_QUEUE_FRAME)
+        except:
+            self._logger.error(traceback.format_exc())
 
-                if task is not None and \
-                        self._task_ack_memory.put(queue_name, task['message_id']):
+    def _poll_queue(self, queue_name, deadline, wait):
+        # 线程模式下没有事件循环，在这个连接自己的线程中等待
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                self._send_frame(_EMPTY_QUEUE_FRAME)
+                return
+            time.sleep(min(wait or _POLL_INTERVAL, deadline - now))
+            task, wait = self._broker.queue_memory.get_limited(queue_name)
+            if task is not None:
+                self._deliver(queue_name, task)
+                return
+
+    def deliver(self, queue_name, task):
+        """投递一个任务给等待中的长轮询请求，由mingmq.waiter调用
+        """
+        try:
+            self._deliver(queue_name, task)
+        except:
+            self._logger.error(traceback.format_exc())
 
-                    papgm = PipeAckProcessGetMessage(task['message_id'], queue_name, task['message_data'])
-                    self._ack_process_queue.put_nowait(papgm)
+    def wait_timeout(self, queue_name):
+        """长轮询请求超时，由mingmq.waiter调用
+        """
+        self._send_frame(_EMPTY_QUEUE_FRAME)
 
-                    pcppgm = PipeCompletelyPersistentProcessGetMessage(queue_name, task['message_id'])
-                    self._completely_persistent_process_queue.put_nowait(pcppgm)
+    def _deliver(self, queue_name, task):
+        delivered_at = time.time()
+        if self._broker.task_ack_memory.put(queue_name, task['message_id'], task['message_data'], delivered_at):
+            if self._broker.journal: self._broker.journal.get(queue_name, task['message_id'], delivered_at)
+            self._track(queue_name, task['message_id'])
 
-                    res_msg = ResMessage(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], SUCCESS, [task])
-                    res_pkg = json.dumps(res_msg).encode()
-                    self._send_data(res_pkg)
-                else:
-                    res_msg = ResMessage(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], FAIL, [task])
-                    res_pkg = json.dumps(res_msg).encode()
-                    self._send_data(res_pkg)
-        except:
-            self._logger.error(traceback.format_exc())
-        finally:
-            self._stat(GET, queue_name)
+            papgm = PipeAckProcessGetMessage(task['message_id'], queue_name, task['message_data'])
+            self._broker.ack_process_queue.put_nowait(papgm)
+
+            pcppgm = PipeCompletelyPersistentProcessGetMessage(queue_name, task['message_id'])
+            self._broker.completely_persistent_process_queue.put_nowait(pcppgm)
+
+            self._stat(GET, queue_name, 1, delivered_at)
+            enqueued_at = message_id_time(task['message_id'])
+            if enqueued_at is not None:
+                self._broker.stat_memory.observe_latency('deliver', queue_name, delivered_at - enqueued_at)
+
+            res_msg = ResMessage(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], SUCCESS, [task])
+        else:
+            res_msg = ResMessage(MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], FAIL, [task])
+        res_pkg = json.dumps(res_msg).encode()
+        self._send_data(res_pkg)
+
+    def _has_queue(self, queue_name):
+        return queue_name in self._broker.queue_memory.get_self() or queue_name in self._broker.stream_memory.get_self()
+
+    def _put(self, queue_name, task):
+        """把任务放入队列并持久化，流队列追加到日志中，日志本身就是持久化的
 
-    def _stat(self, action, queue_name):
-        stat_var = None
+        """
+        if self._broker.stream_memory.append(queue_name, task['message_data']) is not None:
+            return True
+
+        if self._broker.queue_memory.put(queue_name, task):
+            if self._broker.journal: self._broker.journal.put(queue_name, task)
+            self._broker.notify(queue_name)
+
+            pcppsm = PipeCompletelyPersistentProcessSendMessage(queue_name, task['message_data'], task['message_id'])
+            self._broker.completely_persistent_process_queue.put_nowait(pcppsm)
+            return True
+        return False
+
+    def _read_from(self, msg):
+        """从流队列中读取消息，offset为None时从consumer_group提交的offset开始读，
+        json_obj中是[{'offset': offset, 'timestamp': 时间戳, 'message_data': 数据}, ...]
+
+        """
+        if self._data_wrong('_read_from', ('queue_name', 'offset', 'max_count'), msg) is not False:
+            offset = msg['offset']
+            max_count = msg['max_count']
+            result = None
+            if (offset is None or type(offset) is int) and type(max_count) is int and max_count > 0:
+                result = self._broker.stream_memory.read(msg['queue_name'], offset, max_count, msg.get('consumer_group'))
+
+            if result is None:
+                self._send_frame(_FAIL_FRAMES['READ_FROM'])
+            else:
+                res_msg = ResMessage(MESSAGE_TYPE['READ_FROM'], SUCCESS, [
+                    {'offset': offset, 'timestamp': timestamp, 'message_data': message_data}
+                    for offset, timestamp, message_data in result])
+                res_pkg = json.dumps(res_msg).encode()
+                self._send_data(res_pkg)
+
+    def _commit_offset(self, msg):
+        if self._data_wrong('_commit_offset', ('queue_name', 'consumer_group', 'offset'), msg) is not False:
+            offset = msg['offset']
+            if type(offset) is int and isinstance(msg['consumer_group'], str) and \
+                    self._broker.stream_memory.commit_offset(msg['queue_name'], msg['consumer_group'], offset):
+                self._send_frame(_SUCCESS_FRAMES['COMMIT_OFFSET'])
+            else:
+                self._send_frame(_FAIL_FRAMES['COMMIT_OFFSET'])
+
+    def _stat(self, action, queue_name, n=1, now=None):
         if action == SEND:
             stat_var = 'send_' + queue_name
 
@@ -353,34 +721,62 @@ class Handler:
         elif action == ACK:
             stat_var = 'ack_' + queue_name
 
-        self._stat_memory.set(stat_var, 1)
-
-        now = time.time()
+        else:
+            return
 
-        last_time = self._stat_memory.get_last_time()
-        t = now - last_time
-        if t > 10:
-            n = self._stat_memory.get(stat_var)
-            if n is not None:
-                self._stat_memory.set_speed_per_second(stat_var, math.ceil(n / t))
-                self._stat_memory.set_last_time(now)
+        self._broker.stat_memory.set(stat_var, n, now)
 
     def _declare_queue(self, msg):
         if self._data_wrong('_declare_queue', ('queue_name',), msg) is not False:
             queue_name = msg['queue_name']
-            if self._queue_memory.decleare(queue_name) and \
-                    self._task_ack_memory.declare(queue_name) and \
-                    self._stat_memory.declare('send_' + queue_name) and \
-                    self._stat_memory.declare('get_' + queue_name) and \
-                    self._stat_memory.declare('ack_' + queue_name):
+            arguments = check_arguments(msg.get('arguments'))
+            if arguments is None or queue_name in self._broker.stream_memory.get_self():
+                self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
+
+            elif arguments['type'] == QUEUE_TYPE_STREAM:
+                if queue_name not in self._broker.queue_memory.get_self() and \
+                        self._broker.stream_memory.declare(queue_name, arguments) and \
+                        self._broker.stat_memory.declare_queue(queue_name):
+                    self._declare_unique(queue_name, arguments)
+                    self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
+                else:
+                    self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
 
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+            elif arguments['lazy']:
+                if self._broker.queue_memory.declare_lazy(queue_name, arguments['head_bytes']) and \
+                        self._broker.task_ack_memory.declare(queue_name) and \
+                        self._broker.stat_memory.declare_queue(queue_name):
+                    if self._broker.journal: self._broker.journal.declare_lazy(queue_name, arguments['head_bytes'])
+                    self._declare_delivery_rate(queue_name, arguments)
+                    self._declare_unique(queue_name, arguments)
+
+                    self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
+                else:
+                    self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
+
+            elif self._broker.queue_memory.decleare(queue_name) and \
+                    self._broker.task_ack_memory.declare(queue_name) and \
+                    self._broker.stat_memory.declare_queue(queue_name):
+                if self._broker.journal: self._broker.journal.declare(queue_name)
+                self._declare_delivery_rate(queue_name, arguments)
+                self._declare_unique(queue_name, arguments)
+
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
+
+    def _declare_delivery_rate(self, queue_name, arguments):
+        rate = arguments.get('max_delivery_rate')
+        if rate is not None and \
+                self._broker.queue_memory.set_delivery_rate(queue_name, rate, arguments['delivery_burst']):
+            if self._broker.journal:
+                self._broker.journal.set_delivery_rate(queue_name, rate, arguments['delivery_burst'])
+
+    def _declare_unique(self, queue_name, arguments):
+        if arguments['unique'] and \
+                self._broker.unique_memory.declare(queue_name, arguments['initial_capacity'], arguments['error_rate']):
+            if self._broker.journal:
+                self._broker.journal.declare_unique(queue_name, arguments['initial_capacity'], arguments['error_rate'])
 
     def _not_found(self, msg):
         res_msg = ResMessage(MESSAGE_TYPE['NOT_FOUND'], FAIL, [msg])
@@ -388,63 +784,144 @@ class Handler:
         self._send_data(res_pkg)
 
     def _delete_queue(self, msg):
-        if self._data_wrong('_declare_queue', ('queue_name',), msg) is not False:
+        if self._data_wrong('_delete_queue', ('queue_name',), msg) is not False:
             queue_name = msg['queue_name']
-            if self._queue_memory.delete(queue_name) and \
-                    self._task_ack_memory.delete(queue_name) and \
-                    self._stat_memory.delete('send_' + queue_name) and \
-                    self._stat_memory.delete('get_' + queue_name) and \
-                    self._stat_memory.delete('ack_' + queue_name):
+            if self._broker.stream_memory.delete(queue_name):
+                self._broker.stat_memory.delete_queue(queue_name)
+                self._broker.exchange_memory.remove_queue(queue_name)
+                self._broker.dedup_memory.delete(queue_name)
+                if self._broker.unique_memory.delete(queue_name) and self._broker.journal:
+                    self._broker.journal.delete(queue_name)
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
+
+            elif self._broker.queue_memory.delete(queue_name) and \
+                    self._broker.task_ack_memory.delete(queue_name) and \
+                    self._broker.stat_memory.delete_queue(queue_name):
+                self._broker.exchange_memory.remove_queue(queue_name)
+                self._broker.dedup_memory.delete(queue_name)
+                self._broker.unique_memory.delete(queue_name)
+                if self._broker.journal: self._broker.journal.delete(queue_name)
 
                 pcppdqm = PipeCompletelyPersistentProcessDeleteQueueMessage(queue_name)
-                self._completely_persistent_process_queue.put_nowait(pcppdqm)
+                self._broker.completely_persistent_process_queue.put_nowait(pcppdqm)
 
                 pdqnm = PipeDeleteQueueNoackMessage(queue_name)
-                self._ack_process_queue.put_nowait(pdqnm)
+                self._broker.ack_process_queue.put_nowait(pdqnm)
 
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
+            else:
+                self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
+
+    def _declare_exchange(self, msg):
+        if self._data_wrong('_declare_exchange', ('exchange_name', 'exchange_type'), msg) is not False:
+            exchange_name = msg['exchange_name']
+            exchange_type = msg['exchange_type']
+            if self._broker.exchange_memory.declare(exchange_name, exchange_type):
+                if self._broker.journal: self._broker.journal.declare_exchange(exchange_name, exchange_type)
+
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_EXCHANGE'])
+            else:
+                self._send_frame(_FAIL_FRAMES['DECLARE_EXCHANGE'])
+
+    def _delete_exchange(self, msg):
+        if self._data_wrong('_delete_exchange', ('exchange_name',), msg) is not False:
+            exchange_name = msg['exchange_name']
+            if self._broker.exchange_memory.delete(exchange_name):
+                if self._broker.journal: self._broker.journal.delete_exchange(exchange_name)
+
+                self._send_frame(_SUCCESS_FRAMES['DELETE_EXCHANGE'])
+            else:
+                self._send_frame(_FAIL_FRAMES['DELETE_EXCHANGE'])
+
+    def _bind_queue(self, msg):
+        if self._data_wrong('_bind_queue', ('exchange_name', 'queue_name', 'routing_key'), msg) is not False:
+            exchange_name = msg['exchange_name']
+            queue_name = msg['queue_name']
+            routing_key = msg['routing_key']
+            if self._has_queue(queue_name) and isinstance(routing_key, str) and \
+                    self._broker.exchange_memory.bind(exchange_name, queue_name, routing_key):
+                if self._broker.journal: self._broker.journal.bind(exchange_name, queue_name, routing_key)
+
+                self._send_frame(_SUCCESS_FRAMES['BIND_QUEUE'])
+            else:
+                self._send_frame(_FAIL_FRAMES['BIND_QUEUE'])
+
+    def _unbind_queue(self, msg):
+        if self._data_wrong('_unbind_queue', ('exchange_name', 'queue_name', 'routing_key'), msg) is not False:
+            exchange_name = msg['exchange_name']
+            queue_name = msg['queue_name']
+            routing_key = msg['routing_key']
+            if self._broker.exchange_memory.unbind(exchange_name, queue_name, routing_key):
+                if self._broker.journal: self._broker.journal.unbind(exchange_name, queue_name, routing_key)
+
+                self._send_frame(_SUCCESS_FRAMES['UNBIND_QUEUE'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], FAIL, [])
+                self._send_frame(_FAIL_FRAMES['UNBIND_QUEUE'])
+
+    def _publish(self, msg):
+        """向交换机发布任务，json_obj中返回每个目标队列的queue_name和message_id，
+        没有匹配的队列时为空列表
+
+        """
+        try:
+            if self._data_wrong('_publish', ('exchange_name', 'routing_key', 'message_data'), msg) is not False:
+                message_data = msg['message_data']
+                routing_key = msg['routing_key']
+                queue_names = None
+                if isinstance(message_data, str) and isinstance(routing_key, str):
+                    queue_names = self._broker.exchange_memory.route(msg['exchange_name'], routing_key)
+
+                if queue_names is None:
+                    self._send_frame(_FAIL_FRAMES['PUBLISH'])
+                    return
+
+                # 所有队列共享同一个message_data；message_id在数据库中是主键，所以每个队列一个
+                message_id = gen_message_id()
+                routed = []
+                for i, queue_name in enumerate(queue_names):
+                    task = Task(message_data, message_id if len(queue_names) == 1 else message_id + ':' + str(i))
+                    if not self._is_duplicate(queue_name, message_data) and self._put(queue_name, task):
+                        self._stat(SEND, queue_name)
+                        routed.append({'queue_name': queue_name, 'message_id': task['message_id']})
+
+                res_msg = ResMessage(MESSAGE_TYPE['PUBLISH'], SUCCESS, routed)
                 res_pkg = json.dumps(res_msg).encode()
                 self._send_data(res_pkg)
+        except:
+            self._logger.error(traceback.format_exc())
 
     def _clear_queue(self, msg):
         if self._data_wrong('_clear_queue', ('queue_name',), msg) is not False:
             queue_name = msg['queue_name']
-            if self._queue_memory.clear(queue_name) and \
-                    self._task_ack_memory.clear(queue_name):
+            if self._broker.stream_memory.clear(queue_name):
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
+
+            elif self._broker.queue_memory.clear(queue_name) and \
+                    self._broker.task_ack_memory.clear(queue_name):
+                if self._broker.journal: self._broker.journal.clear(queue_name)
 
                 pcppdqm = PipeCompletelyPersistentProcessDeleteQueueMessage(queue_name)
-                self._completely_persistent_process_queue.put_nowait(pcppdqm)
+                self._broker.completely_persistent_process_queue.put_nowait(pcppdqm)
 
                 pdqnm = PipeDeleteQueueNoackMessage(queue_name)
-                self._ack_process_queue.put_nowait(pdqnm)
+                self._broker.ack_process_queue.put_nowait(pdqnm)
 
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], SUCCESS, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_SUCCESS_FRAMES['DECLARE_QUEUE'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['DECLARE_QUEUE'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+                self._send_frame(_FAIL_FRAMES['DECLARE_QUEUE'])
 
     def _login(self, msg):
         if self._data_wrong('_login', ('user_name', 'passwd'), msg) is not False:
             user_name = msg['user_name']
             passwd = msg['passwd']
 
-            if self.server_status.get_user_name() != user_name or \
-                    self.server_status.get_passwd() != passwd:
-                res_msg = ResMessage(MESSAGE_TYPE['LOGIN'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+            if self._broker.server_status.get_user_name() != user_name or \
+                    self._broker.server_status.get_passwd() != passwd:
+                self._send_frame(_FAIL_FRAMES['LOGIN'])
                 self._connected = False
             else:
-                self._session_id = str(self) + ':' + repr(self._addr) + ':' + user_name + '/' + passwd
-                res_msg = ResMessage(MESSAGE_TYPE['LOGIN'], SUCCESS, [])
-                self._send_data(json.dumps(res_msg).encode())
+                self._logged_in = True
+                self._send_frame(_SUCCESS_FRAMES['LOGIN'])
         else:
             self._connected = False
 
@@ -453,41 +930,71 @@ class Handler:
         if self._data_wrong('_logout', ('user_name', 'passwd'), msg) is not False:
             user_name = msg['user_name']
             passwd = msg['passwd']
-            if self.server_status.get_user_name() != user_name or \
-                    self.server_status.get_passwd() != passwd:
-                res_msg = ResMessage(MESSAGE_TYPE['LOGOUT'], FAIL, [])
-                res_pkg = json.dumps(res_msg).encode()
-                self._send_data(res_pkg)
+            if self._broker.server_status.get_user_name() != user_name or \
+                    self._broker.server_status.get_passwd() != passwd:
+                self._send_frame(_FAIL_FRAMES['LOGOUT'])
             else:
-                res_msg = ResMessage(MESSAGE_TYPE['LOGOUT'], SUCCESS, [])
-                self._send_data(json.dumps(res_msg).encode())
+                self._send_frame(_SUCCESS_FRAMES['LOGOUT'])
 
                 self._connected = False
 
     def _has_loggin(self):
-        if self._session_id is not None: return True
+        if self._logged_in: return True
         return False
 
     def _send_data(self, data):
+        self._send_frame(struct.pack('!i', len(data)) + data)
+
+    def _send_frame(self, data_to_send):
+        """发送一个已经带有长度头的响应；
+
+        """
         try:
-            header = struct.pack('!i', len(data))
-            self._logger.debug('发送给客户端[%s]的消息为: %s', self._addr, str(header + data)[:100])
-            data_to_send = header + data
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, len(data_to_send))
+            self._logger.debug('发送给客户端[%s]的消息为: %s', self._addr, str(data_to_send[:100]))
             self._sock.sendall(data_to_send)
         except (BlockingIOError, ) as err:
             # 非阻塞模式下，send()发送数据时，如果发送缓冲区可用大小不足以支持
             # send() 写入全部数据，send()方法也会立马返回，
             # 并抛出 BlockingIOError: [Errno 11] Resource temporarily unavailable异常
             self._logger.error(err)
-            self._logger.debug('数据大小%d, 该socket对象发送缓冲区大小%d', len(header + data), self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+            self._logger.debug('数据大小%d, 该socket对象发送缓冲区大小%d', len(data_to_send), self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
 
     def _recv(self, size):
         try:
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
             return self._sock.recv(size)
         except (ConnectionResetError, OSError) as err:
             # OSError: [WinError 10038] 在一个非套接字上尝试了一个操作。
             # ConnectionResetError 远程主机主动断开了连接
             self._logger.error(err)
-            return None
\ No newline at end of file
+            return None
+
+    # 操作码到处理方法的映射，下标是MESSAGE_TYPE中的值，没有登记的操作码返回NOT_FOUND
+    _DISPATCH = [None] * (max(MESSAGE_TYPE.values()) + 1)
+    _DISPATCH_NAMES = [None] * len(_DISPATCH)
+    for _name, _method in (('LOGOUT', _logout),
+                           ('DECLARE_QUEUE', _declare_queue),
+                           ('GET_DATA_FROM_QUEUE', _get_data_from_queue),
+                           ('SEND_DATA_TO_QUEUE', _send_data_to_queue),
+                           ('SEND_DATAS_TO_QUEUE', _send_datas_to_queue),
+                           ('ACK_MESSAGE', _ack_message),
+                           ('ACK_MESSAGES', _ack_messages),
+                           ('GET_SPEED', _get_speed),
+                           ('GET_STAT', _get_stat),
+                           ('DELETE_QUEUE', _delete_queue),
+                           ('CLEAR_QUEUE', _clear_queue),
+                           ('DELETE_ACK_MESSAGE_ID', _delete_ack_message_id_queue_name),
+                           ('RESTORE_ACK_MESSAGE_ID', _restore_ack_message_id),
+                           ('RESTORE_SEND_MESSAGE', _restore_send_message),
+                           ('PING', _ping),
+                           ('SET_RESEND_INTERVAL', _set_resend_interval),
+                           ('GET_RESEND_INTERVAL', _get_resend_interval),
+                           ('DECLARE_EXCHANGE', _declare_exchange),
+                           ('DELETE_EXCHANGE', _delete_exchange),
+                           ('BIND_QUEUE', _bind_queue),
+                           ('UNBIND_QUEUE', _unbind_queue),
+                           ('PUBLISH', _publish),
+                           ('READ_FROM', _read_from),
+                           ('COMMIT_OFFSET', _commit_offset)):
+        _DISPATCH[MESSAGE_TYPE[_name]] = _method
+        _DISPATCH_NAMES[MESSAGE_TYPE[_name]] = _name
+    del _name, _method
@@ -0,0 +1,182 @@
+"""惰性队列(lazy queue)，把放不进内存的任务写到磁盘上的段文件中。
+
+普通队列的所有任务都在QueueMemory的Python对象里，积压50G的任务就需要50G以上的
+内存。惰性队列只在内存中保留队头head_bytes字节的任务，后面的任务追加到段文件中，
+内存里只保存每条记录在段文件中的位置(8字节)，队头被取走后再用mmap从段文件中
+按顺序读回来，所以不管积压多少任务，内存的占用都是固定的。
+
+段文件只是内存的延伸，不负责持久化，持久化仍然由sqlite、快照和日志完成；服务器
+启动时会删除上一次留下的段文件，恢复时重新写入。
+
+目录结构::
+
+    lazy_dir/
+        <队列名>/
+            00000000000000000000.seg
+            00000000000000000001.seg
+
+段文件使用mingmq.codec的记录编码，每条记录为(message_id, message_data)。
+"""
+
+import mmap
+import os
+import shutil
+from array import array
+from collections import deque
+from queue import Empty
+
+from mingmq.codec import encode_record, iter_records
+from mingmq.message import Task
+
+# 队头默认最多保留的任务字节数
+DEFAULT_HEAD_BYTES = 16 * 1024 * 1024
+# 单个段文件的默认大小
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+_OP_TASK = 0  # (message_id, message_data)
+_SEGMENT_SUFFIX = '.seg'
+
+
+class _SpillSegment:
+    """一个段文件，offsets是每条记录的起始位置
+    """
+    __slots__ = ('path', 'file', 'offsets', 'size', 'read_index', 'mmap')
+
+    def __init__(self, path):
+        self.path = path
+        # 不带缓冲，写快照的子进程读文件时不需要flush
+        self.file = open(path, 'w+b', buffering=0)
+        self.offsets = array('Q')
+        self.size = 0
+        self.read_index = 0
+        self.mmap = None
+
+    def append(self, record):
+        self.offsets.append(self.size)
+        self.file.write(record)
+        self.size += len(record)
+
+    def read(self, index):
+        if self.mmap is None or len(self.mmap) < self.size:
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        _, (message_id, message_data), _ = next(iter_records(self.mmap, self.offsets[index]))
+        return Task(message_data, message_id)
+
+    def remaining(self):
+        return len(self.offsets) - self.read_index
+
+    def remove(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LazyQueue:
+    """惰性队列，实现了QueueMemory用到的queue.Queue的接口
+    """
+
+    def __init__(self, directory, head_bytes=DEFAULT_HEAD_BYTES, segment_bytes=DEFAULT_SEGMENT_BYTES):
+        """初始化；
+
+        :param directory: 段文件的目录；
+        :type directory: str
+        :param head_bytes: 内存中最多保留的任务字节数；
+        :type head_bytes: int
+        :param segment_bytes: 单个段文件的最大字节数；
+        :type segment_bytes: int
+
+        """
+        self.head_bytes = head_bytes
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._head = deque()
+        self._head_size = 0
+        self._segments = deque()
+        self._spilled = 0
+        self._next_seq = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def queue(self):
+        """按顺序遍历所有任务，写快照时使用
+        """
+        yield from list(self._head)
+        for segment in list(self._segments):
+            for i in range(segment.read_index, len(segment.offsets)):
+                yield segment.read(i)
+
+    def qsize(self):
+        return len(self._head) + self._spilled
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def get_spilled(self):
+        return self._spilled
+
+    def get_head_bytes(self):
+        return self._head_size
+
+    def put_nowait(self, task):
+        # 已经有任务在磁盘上时，新的任务也必须写到磁盘上，才能保证先进先出
+        if not self._spilled and self._head_size + len(task['message_data']) <= self.head_bytes:
+            self._head.append(task)
+            self._head_size += len(task['message_data'])
+        else:
+            self._spill(task)
+
+    def put_front(self, task):
+        # 退回的任务总是放在内存中的队头，可能暂时超过head_bytes
+        self._head.appendleft(task)
+        self._head_size += len(task['message_data'])
+
+    def get_nowait(self):
+        if self._head:
+            task = self._head.popleft()
+            self._head_size -= len(task['message_data'])
+        elif self._spilled:
+            task = self._unspill()
+        else:
+            raise Empty
+
+        # 队头有空间了，从磁盘上读回一条
+        if self._spilled and self._head_size < self.head_bytes:
+            next_task = self._unspill()
+            self._head.append(next_task)
+            self._head_size += len(next_task['message_data'])
+        return task
+
+    def _spill(self, task):
+        if not self._segments or self._segments[-1].size >= self._segment_bytes:
+            path = os.path.join(self._directory, '%020d%s' % (self._next_seq, _SEGMENT_SUFFIX))
+            self._next_seq += 1
+            self._segments.append(_SpillSegment(path))
+        self._segments[-1].append(encode_record(_OP_TASK, task['message_id'], task['message_data']))
+        self._spilled += 1
+
+    def _unspill(self):
+        segment = self._segments[0]
+        task = segment.read(segment.read_index)
+        segment.read_index += 1
+        self._spilled -= 1
+        if not segment.remaining():
+            # 读完的段直接删除，正在写的段读完了下一次也会新建
+            self._segments.popleft()
+            segment.remove()
+        return task
+
+    def close(self):
+        """删除所有的段文件
+        """
+        while self._segments:
+            self._segments.popleft().remove()
+        self._spilled = 0
+        shutil.rmtree(self._directory, ignore_errors=True)
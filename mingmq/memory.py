@@ -81,11 +81,15 @@
 
 """
 
-import math
+import heapq
 import platform
+import shutil
+import tempfile
 import time
+import weakref
 from queue import Queue
-from mingmq.utils import get_size
+from mingmq.lazy import LazyQueue
+from mingmq.utils import queue_dir
 
 if not platform.platform().startswith('Linux'):
     from threading import Lock
@@ -93,17 +97,129 @@ if not platform.platform().startswith('Linux'):
     _LOCK = Lock()
 
 
+def _temp_lazy_dir(queue_memory):
+    # 没有指定目录时创建的临时目录，QueueMemory被回收或者进程退出时删除
+    lazy_dir = tempfile.mkdtemp(prefix='mingmq_lazy_')
+    weakref.finalize(queue_memory, shutil.rmtree, lazy_dir, True)
+    return lazy_dir
+
+
+class TokenBucket:
+    """
+    令牌桶，用于限制队列的投递速率；每秒补充rate个令牌，最多积攒capacity个
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity=1, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, now):
+        """
+        :return: float，还需要等待多少秒才有一个令牌，0表示现在就有
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """
+        取走一个令牌
+        :return: float，0表示成功，否则为还需要等待的秒数
+        """
+        wait = self.wait_time(now)
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+
 class QueueMemory:
     """
     队列的内存模型
     """
 
-    def __init__(self):
+    def __init__(self, lazy_dir=None):
+        """
+        :param lazy_dir: str，惰性队列的段文件目录，None则在第一次声明惰性队列时创建临时目录，回收时删除
+        """
         self._map = dict()
+        self._lazy_dir = lazy_dir
+        # 每个队列在内存中的任务字节数，惰性队列只算队头
+        self._bytes = dict()
+        self._total_bytes = 0
+        # 限制了投递速率的队列的令牌桶
+        self._buckets = dict()
 
     def get_self(self):
         return self._map
 
+    def _new_lazy_queue(self, queue_name, head_bytes):
+        if self._lazy_dir is None:
+            self._lazy_dir = _temp_lazy_dir(self)
+        # 队列名是目录名，'..'这样的名字会指向快照目录，删除或者清空队列时整个目录都会被删除
+        directory = queue_dir(self._lazy_dir, queue_name)
+        if directory is None:
+            return None
+        return LazyQueue(directory, head_bytes)
+
+    def _new_queue(self, queue_name):
+        old = self._map.get(queue_name)
+        if isinstance(old, LazyQueue):
+            old.close()
+            return self._new_lazy_queue(queue_name, old.head_bytes)
+        return Queue()
+
+    def _update_bytes(self, queue_name, queue, delta):
+        if isinstance(queue, LazyQueue):
+            delta = queue.get_head_bytes() - self._bytes[queue_name]
+        self._bytes[queue_name] += delta
+        self._total_bytes += delta
+
+    def _reset_bytes(self, queue_name):
+        self._total_bytes -= self._bytes.pop(queue_name, 0)
+
+    def get_bytes(self, queue_name):
+        return self._bytes.get(queue_name)
+
+    def get_total_bytes(self):
+        """
+        :return: int，所有队列在内存中的任务字节数
+        """
+        return self._total_bytes
+
+    def set_delivery_rate(self, queue_name, rate, burst=1):
+        """
+        限制队列的投递速率
+        :param queue_name: str，队列名称
+        :param rate: float，每秒最多投递的任务数，None则取消限制
+        :param burst: int，最多可以连续投递的任务数
+        :return: boolean，True成功，False失败
+        """
+        if queue_name not in self._map:
+            return False
+        if rate is None:
+            self._buckets.pop(queue_name, None)
+        else:
+            self._buckets[queue_name] = TokenBucket(rate, burst)
+        return True
+
+    def get_delivery_rate(self, queue_name):
+        """
+        :return: tuple，(rate, burst)，None表示没有限制
+        """
+        bucket = self._buckets.get(queue_name)
+        if bucket is None:
+            return None
+        return bucket.rate, bucket.capacity
+
     def decleare(self, queue_name):
         """
         声明一个队列
@@ -112,6 +228,23 @@ class QueueMemory:
         """
         if queue_name not in self._map:
             self._map[queue_name] = Queue()
+            self._bytes[queue_name] = 0
+            return True
+        return False
+
+    def declare_lazy(self, queue_name, head_bytes):
+        """
+        声明一个惰性队列，超过head_bytes的任务写到磁盘上
+        :param queue_name: str，队列名称
+        :param head_bytes: int，内存中最多保留的任务字节数
+        :return: boolean，True成功，False失败
+        """
+        if queue_name not in self._map:
+            queue = self._new_lazy_queue(queue_name, head_bytes)
+            if queue is None:
+                return False
+            self._map[queue_name] = queue
+            self._bytes[queue_name] = 0
             return True
         return False
 
@@ -122,8 +255,9 @@ class QueueMemory:
         :return: boolean，True成功，False失败
         """
         if queue_name in self._map:
-            del self._map[queue_name]
-            self._map[queue_name] = Queue()
+            self._map[queue_name] = self._new_queue(queue_name)
+            self._reset_bytes(queue_name)
+            self._bytes[queue_name] = 0
             return True
         return False
 
@@ -134,7 +268,11 @@ class QueueMemory:
         :return: boolean，True成功，False失败
         """
         if queue_name in self._map:
-            del self._map[queue_name]
+            queue = self._map.pop(queue_name)
+            self._reset_bytes(queue_name)
+            self._buckets.pop(queue_name, None)
+            if isinstance(queue, LazyQueue):
+                queue.close()
             return True
         return False
 
@@ -145,8 +283,27 @@ class QueueMemory:
         :param message: Task，消息
         :return: boolean，True成功，False失败
         """
-        if queue_name in self._map:
-            self._map[queue_name].put_nowait(message)
+        queue = self._map.get(queue_name)
+        if queue is not None:
+            queue.put_nowait(message)
+            self._update_bytes(queue_name, queue, len(message['message_data']))
+            return True
+        return False
+
+    def put_front(self, queue_name, message):
+        """
+        把任务放回队列的头部，用于连接断开时退回还没有确认的任务
+        :param queue_name: str，队列名
+        :param message: Task，消息
+        :return: boolean，True成功，False失败
+        """
+        queue = self._map.get(queue_name)
+        if queue is not None:
+            if isinstance(queue, LazyQueue):
+                queue.put_front(message)
+            else:
+                queue.queue.appendleft(message)
+            self._update_bytes(queue_name, queue, len(message['message_data']))
             return True
         return False
 
@@ -156,14 +313,39 @@ class QueueMemory:
         :param queue_name: str，队列名
         :return: str，None则表示没有获取到数据
         """
-        if queue_name in self._map and self._map[queue_name].qsize() != 0:
-            return self._map[queue_name].get_nowait()
+        queue = self._map.get(queue_name)
+        if queue is not None and queue.qsize() != 0:
+            message = queue.get_nowait()
+            self._update_bytes(queue_name, queue, -len(message['message_data']))
+            return message
         return None
 
+    def get_limited(self, queue_name, now=None):
+        """
+        按照投递速率从指定的队列中获取任务，只有取到任务时才消耗令牌
+        :param queue_name: str，队列名
+        :param now: float，time.monotonic()的时间
+        :return: tuple，(task, wait)，task为None时wait大于0表示被限速，需要等待wait秒
+        """
+        queue = self._map.get(queue_name)
+        if queue is None or queue.qsize() == 0:
+            return None, 0.0
+        bucket = self._buckets.get(queue_name)
+        if bucket is not None:
+            wait = bucket.take(time.monotonic() if now is None else now)
+            if wait:
+                return None, wait
+        message = queue.get_nowait()
+        self._update_bytes(queue_name, queue, -len(message['message_data']))
+        return message, 0.0
+
     def get_stat(self):
+        '''
+        :return: dict，{队列名: [任务数, 内存中的任务数据字节数], ...}，惰性队列只算队头
+        '''
         tmp = dict()
         for k, v in self._map.items():
-            tmp[k] = [v.qsize(), get_size(v)]
+            tmp[k] = [v.qsize(), self._bytes[k]]
 
         return tmp
 
@@ -172,11 +354,17 @@ class TaskAckMemory:
     """
     消息应答的内存模型
 
-    用于存放未应答的消息id
+    用于存放未应答的消息，每个队列是一个message_id到(message_data, 投递时间)的
+    dict，另外还有一个按投递时间排序的小顶堆，用于找出超时未确认的消息。堆中
+    已经确认的消息不会立即删除，而是在弹出时跳过。
     """
 
     def __init__(self):
         self._map = dict()
+        self._heap = []
+        # 每个队列未确认消息的字节数
+        self._bytes = dict()
+        self._total_bytes = 0
 
     def get_self(self):
         return self._map
@@ -187,7 +375,8 @@ class TaskAckMemory:
         :return: boolean，True成功，False失败
         """
         if set_name not in self._map:
-            self._map[set_name] = set()
+            self._map[set_name] = dict()
+            self._bytes[set_name] = 0
             return True
         return False
 
@@ -197,8 +386,9 @@ class TaskAckMemory:
         :return: boolean，True成功，False失败
         """
         if set_name in self._map:
-            del self._map[set_name]
-            self._map[set_name] = set()
+            self._total_bytes -= self._bytes[set_name]
+            self._bytes[set_name] = 0
+            self._map[set_name] = dict()
             return True
         return False
 
@@ -209,17 +399,40 @@ class TaskAckMemory:
         """
         if set_name in self._map:
             del self._map[set_name]
+            self._total_bytes -= self._bytes.pop(set_name, 0)
             return True
         return False
 
-    def put(self, queue_name, message_id):
+    def _update_bytes(self, queue_name, delta):
+        self._bytes[queue_name] += delta
+        self._total_bytes += delta
+
+    def get_bytes(self, queue_name):
+        return self._bytes.get(queue_name)
+
+    def get_total_bytes(self):
+        """
+        :return: int，所有未确认消息的字节数
+        """
+        return self._total_bytes
+
+    def put(self, queue_name, message_id, message_data=None, delivered_at=None):
         """
         :param queue_name: str，队列名
         :param message_id: str，消息id
+        :param message_data: str，消息数据，超时重发时使用
+        :param delivered_at: float，投递时间，None则为当前时间
         :return: bookean，True成功，False失败
         """
         if queue_name in self._map:
-            self._map[queue_name].add(message_id)
+            if delivered_at is None:
+                delivered_at = time.time()
+            inflight = self._map[queue_name]
+            if message_id in inflight:
+                self._update_bytes(queue_name, -len(inflight[message_id][0] or ''))
+            inflight[message_id] = (message_data, delivered_at)
+            self._update_bytes(queue_name, len(message_data or ''))
+            heapq.heappush(self._heap, (delivered_at, queue_name, message_id))
             return True
         return False
 
@@ -229,18 +442,64 @@ class TaskAckMemory:
         :param message_id: str，消息id
         :return: boolean，True成功 , False表示失败
         """
-        if queue_name in self._map and len(self._map[queue_name]) != 0:
-            try:
-                self._map[queue_name].remove(message_id)
-                return True
-            except KeyError:
-                return False
-        return False
+        return self._pop(queue_name, message_id) is not None
+
+    def pop(self, queue_name, message_id):
+        """
+        删除一个未确认的消息，并返回它的投递时间
+        :param queue_name: str，队列名称
+        :param message_id: str，消息id
+        :return: float，投递时间，None表示没有这个消息
+        """
+        entry = self._pop(queue_name, message_id)
+        return entry[1] if entry is not None else None
+
+    def pop_message(self, queue_name, message_id):
+        """
+        删除一个未确认的消息，并返回它的数据和投递时间
+        :param queue_name: str，队列名称
+        :param message_id: str，消息id
+        :return: tuple，(message_data, delivered_at)，None表示没有这个消息
+        """
+        return self._pop(queue_name, message_id)
+
+    def has(self, queue_name, message_id):
+        inflight = self._map.get(queue_name)
+        return inflight is not None and message_id in inflight
+
+    def _pop(self, queue_name, message_id):
+        inflight = self._map.get(queue_name)
+        if inflight:
+            entry = inflight.pop(message_id, None)
+            if entry is not None:
+                self._update_bytes(queue_name, -len(entry[0] or ''))
+                return entry
+        return None
+
+    def pop_expired(self, before):
+        """
+        弹出所有投递时间早于before并且还没有确认的消息
+        :param before: float，时间戳
+        :return: list，[(queue_name, message_id, message_data), ...]
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= before:
+            delivered_at, queue_name, message_id = heapq.heappop(self._heap)
+            inflight = self._map.get(queue_name)
+            if inflight is None or message_id not in inflight or inflight[message_id][1] != delivered_at:
+                continue  # 已经确认，或者被删除了
+            message_data, _ = inflight.pop(message_id)
+            self._update_bytes(queue_name, -len(message_data or ''))
+            expired.append((queue_name, message_id, message_data))
+        return expired
 
     def get_stat(self):
+        '''
+        :return: dict，{队列名: [未确认的消息数, 消息数据的字节数], ...}
+        '''
         tmp = dict()
         for k, v in self._map.items():
-            tmp[k] = [len(v), get_size(v)]
+            tmp[k] = [len(v), self._bytes[k]]
 
         return tmp
 
@@ -250,12 +509,81 @@ class SyncQueueMemory:
     队列的内存模型
     """
 
-    def __init__(self):
+    def __init__(self, lazy_dir=None):
+        """
+        :param lazy_dir: str，惰性队列的段文件目录，None则在第一次声明惰性队列时创建临时目录，回收时删除
+        """
         self._map = dict()
+        self._lazy_dir = lazy_dir
+        # 每个队列在内存中的任务字节数，惰性队列只算队头
+        self._bytes = dict()
+        self._total_bytes = 0
+        # 限制了投递速率的队列的令牌桶
+        self._buckets = dict()
 
     def get_self(self):
         return self._map
 
+    def _new_lazy_queue(self, queue_name, head_bytes):
+        if self._lazy_dir is None:
+            self._lazy_dir = _temp_lazy_dir(self)
+        # 队列名是目录名，'..'这样的名字会指向快照目录，删除或者清空队列时整个目录都会被删除
+        directory = queue_dir(self._lazy_dir, queue_name)
+        if directory is None:
+            return None
+        return LazyQueue(directory, head_bytes)
+
+    def _new_queue(self, queue_name):
+        old = self._map.get(queue_name)
+        if isinstance(old, LazyQueue):
+            old.close()
+            return self._new_lazy_queue(queue_name, old.head_bytes)
+        return Queue()
+
+    def _update_bytes(self, queue_name, queue, delta):
+        if isinstance(queue, LazyQueue):
+            delta = queue.get_head_bytes() - self._bytes[queue_name]
+        self._bytes[queue_name] += delta
+        self._total_bytes += delta
+
+    def _reset_bytes(self, queue_name):
+        self._total_bytes -= self._bytes.pop(queue_name, 0)
+
+    def get_bytes(self, queue_name):
+        return self._bytes.get(queue_name)
+
+    def get_total_bytes(self):
+        """
+        :return: int，所有队列在内存中的任务字节数
+        """
+        return self._total_bytes
+
+    def set_delivery_rate(self, queue_name, rate, burst=1):
+        """
+        限制队列的投递速率
+        :param queue_name: str，队列名称
+        :param rate: float，每秒最多投递的任务数，None则取消限制
+        :param burst: int，最多可以连续投递的任务数
+        :return: boolean，True成功，False失败
+        """
+        with _LOCK:
+            if queue_name not in self._map:
+                return False
+            if rate is None:
+                self._buckets.pop(queue_name, None)
+            else:
+                self._buckets[queue_name] = TokenBucket(rate, burst)
+            return True
+
+    def get_delivery_rate(self, queue_name):
+        """
+        :return: tuple，(rate, burst)，None表示没有限制
+        """
+        bucket = self._buckets.get(queue_name)
+        if bucket is None:
+            return None
+        return bucket.rate, bucket.capacity
+
     def decleare(self, queue_name):
         """
         声明一个队列
@@ -265,6 +593,24 @@ class SyncQueueMemory:
         with _LOCK:
             if queue_name not in self._map:
                 self._map[queue_name] = Queue()
+                self._bytes[queue_name] = 0
+                return True
+            return False
+
+    def declare_lazy(self, queue_name, head_bytes):
+        """
+        声明一个惰性队列，超过head_bytes的任务写到磁盘上
+        :param queue_name: str，队列名称
+        :param head_bytes: int，内存中最多保留的任务字节数
+        :return: boolean，True成功，False失败
+        """
+        with _LOCK:
+            if queue_name not in self._map:
+                queue = self._new_lazy_queue(queue_name, head_bytes)
+                if queue is None:
+                    return False
+                self._map[queue_name] = queue
+                self._bytes[queue_name] = 0
                 return True
             return False
 
@@ -276,8 +622,9 @@ class SyncQueueMemory:
         """
         with _LOCK:
             if queue_name in self._map:
-                del self._map[queue_name]
-                self._map[queue_name] = Queue()
+                self._map[queue_name] = self._new_queue(queue_name)
+                self._reset_bytes(queue_name)
+                self._bytes[queue_name] = 0
                 return True
             return False
 
@@ -289,7 +636,11 @@ class SyncQueueMemory:
         """
         with _LOCK:
             if queue_name in self._map:
-                del self._map[queue_name]
+                queue = self._map.pop(queue_name)
+                self._reset_bytes(queue_name)
+                self._buckets.pop(queue_name, None)
+                if isinstance(queue, LazyQueue):
+                    queue.close()
                 return True
             return False
 
@@ -301,8 +652,28 @@ class SyncQueueMemory:
         :return: boolean，True成功，False失败
         """
         with _LOCK:
-            if queue_name in self._map:
-                self._map[queue_name].put_nowait(message)
+            queue = self._map.get(queue_name)
+            if queue is not None:
+                queue.put_nowait(message)
+                self._update_bytes(queue_name, queue, len(message['message_data']))
+                return True
+            return False
+
+    def put_front(self, queue_name, message):
+        """
+        把任务放回队列的头部，用于连接断开时退回还没有确认的任务
+        :param queue_name: str，队列名
+        :param message: Task，消息
+        :return: boolean，True成功，False失败
+        """
+        with _LOCK:
+            queue = self._map.get(queue_name)
+            if queue is not None:
+                if isinstance(queue, LazyQueue):
+                    queue.put_front(message)
+                else:
+                    queue.queue.appendleft(message)
+                self._update_bytes(queue_name, queue, len(message['message_data']))
                 return True
             return False
 
@@ -313,150 +684,441 @@ class SyncQueueMemory:
         :return: str，None则表示没有获取到数据
         """
         with _LOCK:
-            if queue_name in self._map and self._map[queue_name].qsize() != 0:
-                return self._map[queue_name].get_nowait()
+            queue = self._map.get(queue_name)
+            if queue is not None and queue.qsize() != 0:
+                message = queue.get_nowait()
+                self._update_bytes(queue_name, queue, -len(message['message_data']))
+                return message
             return None
 
+    def get_limited(self, queue_name, now=None):
+        """
+        按照投递速率从指定的队列中获取任务，只有取到任务时才消耗令牌
+        :param queue_name: str，队列名
+        :param now: float，time.monotonic()的时间
+        :return: tuple，(task, wait)，task为None时wait大于0表示被限速，需要等待wait秒
+        """
+        with _LOCK:
+            queue = self._map.get(queue_name)
+            if queue is None or queue.qsize() == 0:
+                return None, 0.0
+            bucket = self._buckets.get(queue_name)
+            if bucket is not None:
+                wait = bucket.take(time.monotonic() if now is None else now)
+                if wait:
+                    return None, wait
+            message = queue.get_nowait()
+            self._update_bytes(queue_name, queue, -len(message['message_data']))
+            return message, 0.0
+
     def get_stat(self):
         with _LOCK:
             tmp = dict()
             for k, v in self._map.items():
-                tmp[k] = [v.qsize(), get_size(v)]
+                tmp[k] = [v.qsize(), self._bytes[k]]
 
             return tmp
 
 
-class SyncTaskAckMemory:
+class SyncTaskAckMemory(TaskAckMemory):
     """
-    队列消息应答的内存模型
+    队列消息应答的内存模型，线程安全
 
-    用于存放未应答的消息id
+    用于存放未应答的消息
     """
 
-    def __init__(self):
-        self._map = dict()
-
-    def get_self(self):
-        return self._map
-
     def declare(self, queue_name):
-        """
-        声明一个队列
-        :param queue_name: str，队列名
-        :return: boolean，True成功，False失败
-        """
         with _LOCK:
-            if queue_name not in self._map:
-                self._map[queue_name] = set()
-                return True
-            return False
+            return super().declare(queue_name)
 
-    def put(self, queue_name, message_id):
-        """
-        向指定队列中增加一条消息
-        :param queue_name: str，队列名
-        :param message_id: str，消息id
-        :return: boolean，True成功，False失败
-        """
+    def put(self, queue_name, message_id, message_data=None, delivered_at=None):
         with _LOCK:
-            if queue_name in self._map:
-                self._map[queue_name].add(message_id)
-                return True
-            return False
+            return super().put(queue_name, message_id, message_data, delivered_at)
 
     def get(self, queue_name, message_id):
-        """
-        从指定队列中获取一条消息id
-        :param queue_name: str，队列名称
-        :param message_id: str，消息id
-        :return: any，消息id , False表示失败
-        """
         with _LOCK:
-            if queue_name in self._map and len(self._map[queue_name]) != 0:
-                try:
-                    self._map[queue_name].remove(message_id)
-                    return True
-                except KeyError:
-                    return False
-            return False
+            return super().get(queue_name, message_id)
+
+    def pop(self, queue_name, message_id):
+        with _LOCK:
+            return super().pop(queue_name, message_id)
+
+    def pop_message(self, queue_name, message_id):
+        with _LOCK:
+            return super().pop_message(queue_name, message_id)
+
+    def has(self, queue_name, message_id):
+        with _LOCK:
+            return super().has(queue_name, message_id)
+
+    def pop_expired(self, before):
+        with _LOCK:
+            return super().pop_expired(before)
 
     def clear(self, queue_name):
-        """
-        :param queue_name: str，队列名称
-        :return: boolean，True成功，False失败
-        """
         with _LOCK:
-            if queue_name in self._map:
-                del self._map[queue_name]
-                self._map[queue_name] = set()
-                return True
-            return False
+            return super().clear(queue_name)
 
     def delete(self, queue_name):
+        with _LOCK:
+            return super().delete(queue_name)
+
+    def get_stat(self):
+        with _LOCK:
+            return super().get_stat()
+
+
+class DedupMemory:
+    """
+    发送任务时dedup_key的去重窗口
+
+    每个队列一个按插入顺序排列的dict，dedup_key -> (插入时间, message_id)，超过
+    max_size条或者早于max_age秒的记录从头部淘汰，查找和淘汰都是O(1)的。
+    """
+
+    def __init__(self, max_size=10000, max_age=600):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._map = dict()
+
+    def get_self(self):
+        return self._map
+
+    def _evict(self, window, now):
+        before = now - self._max_age
+        while window:
+            dedup_key = next(iter(window))
+            if len(window) <= self._max_size and window[dedup_key][0] >= before:
+                break
+            del window[dedup_key]
+
+    def put(self, queue_name, dedup_key, message_id, now=None):
         """
-        :param queue_name: str，队列名称
-        :return: boolean，True成功，False失败
+        记录dedup_key，已经在窗口中时返回第一次发送的message_id
+
+        :return: str，None表示不是重复的任务
         """
+        now = now or time.time()
+        window = self._map.get(queue_name)
+        if window is None:
+            window = self._map[queue_name] = dict()
+        else:
+            self._evict(window, now)
+
+        if dedup_key in window:
+            return window[dedup_key][1]
+        window[dedup_key] = (now, message_id)
+        if len(window) > self._max_size:
+            self._evict(window, now)
+        return None
+
+    def remove(self, queue_name, dedup_key):
+        window = self._map.get(queue_name)
+        if window is not None:
+            window.pop(dedup_key, None)
+
+    def delete(self, queue_name):
+        return self._map.pop(queue_name, None) is not None
+
+    def get_stat(self):
+        tmp = dict()
+        for k, v in self._map.items():
+            tmp[k] = len(v)
+        return tmp
+
+
+class SyncDedupMemory(DedupMemory):
+    """
+    发送任务时dedup_key的去重窗口，线程安全
+    """
+
+    def put(self, queue_name, dedup_key, message_id, now=None):
         with _LOCK:
-            if queue_name in self._map:
-                del self._map[queue_name]
-                return True
-            return False
+            return super().put(queue_name, dedup_key, message_id, now)
+
+    def remove(self, queue_name, dedup_key):
+        with _LOCK:
+            return super().remove(queue_name, dedup_key)
+
+    def delete(self, queue_name):
+        with _LOCK:
+            return super().delete(queue_name)
 
     def get_stat(self):
         with _LOCK:
-            tmp = dict()
-            for k, v in self._map.items():
-                tmp[k] = [len(v), get_size(v)]
+            return super().get_stat()
 
-            return tmp
 
+class RateWindow:
+    '''
+    滑动窗口计数器，按秒分桶，用来计算最近WINDOW秒的平均速度
 
-class StatMemory:
+    桶是一个固定长度的环，更新时只改一个桶，不分配内存
+    '''
+
+    WINDOW = 10
+
+    def __init__(self):
+        self._counts = [0] * RateWindow.WINDOW
+        self._seconds = [0] * RateWindow.WINDOW
+
+    def add(self, n, now):
+        second = int(now)
+        i = second % RateWindow.WINDOW
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += n
+
+    def rate(self, now):
+        '''
+        :return: float，最近WINDOW秒每秒的数量
+        '''
+        second = int(now)
+        total = 0
+        for i in range(RateWindow.WINDOW):
+            if second - self._seconds[i] < RateWindow.WINDOW:
+                total += self._counts[i]
+        return total / RateWindow.WINDOW
+
+
+class Histogram:
     '''
-    队列的send/get/ack速度统计
+    延迟直方图，以微秒为单位按2的幂分桶，第i个桶存放[2^(i-1), 2^i)微秒的样本，
+    最后一个桶存放所有更大的样本
+
+    更新时只做一次bit_length和一次下标加一，不分配内存
     '''
 
+    BUCKETS = 32
+
     def __init__(self):
-        self._map = dict()
-        self._speed = dict()
-        self._last_time = time.time()
+        self._buckets = [0] * Histogram.BUCKETS
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    @classmethod
+    def from_buckets(cls, buckets, total, max_seconds):
+        '''
+        用已有的桶创建直方图，例如从共享内存中读取的桶
+        :param buckets: list，每个桶的数量
+        :param total: float，样本的和，单位秒
+        :param max_seconds: float，最大的样本，单位秒
+        '''
+        histogram = cls()
+        histogram._buckets = list(buckets)
+        histogram._count = sum(buckets)
+        histogram._sum = total
+        histogram._max = max_seconds
+        return histogram
+
+    @staticmethod
+    def bucket(seconds):
+        '''
+        :return: int，样本所在的桶
+        '''
+        if seconds < 0:
+            return 0
+        i = int(seconds * 1000000).bit_length()
+        if i >= Histogram.BUCKETS:
+            return Histogram.BUCKETS - 1
+        return i
+
+    def observe(self, seconds):
+        '''
+        :param seconds: float，耗时，单位秒
+        '''
+        if seconds < 0:
+            seconds = 0.0
+        self._buckets[Histogram.bucket(seconds)] += 1
+        self._count += 1
+        self._sum += seconds
+        if seconds > self._max:
+            self._max = seconds
+
+    @staticmethod
+    def upper_bound(i):
+        '''
+        :return: float，第i个桶的上界，单位秒，最后一个桶为inf
+        '''
+        if i >= Histogram.BUCKETS - 1:
+            return float('inf')
+        return (1 << i) / 1000000
+
+    def get_count(self):
+        return self._count
+
+    def get_sum(self):
+        return self._sum
+
+    def get_buckets(self):
+        '''
+        :return: list，[(上界, 累计数量), ...]，prometheus风格
+        '''
+        buckets = []
+        cumulative = 0
+        for i, n in enumerate(self._buckets):
+            cumulative += n
+            buckets.append((Histogram.upper_bound(i), cumulative))
+        return buckets
+
+    def percentile(self, p):
+        '''
+        :param p: float，0到100
+        :return: float，样本所在桶的上界，单位秒，没有样本时为0
+        '''
+        if self._count == 0:
+            return 0.0
+        rank = self._count * p / 100
+        cumulative = 0
+        for i, n in enumerate(self._buckets):
+            cumulative += n
+            if cumulative >= rank and n:
+                return min(Histogram.upper_bound(i), self._max)
+        return self._max
 
     def get_stat(self):
-        if math.ceil((time.time() - self._last_time) / 10) > 2:
-            for k in self._speed.keys():
-                self._speed[k] = 0
-        return self._speed
+        '''
+        :return: dict，数量、平均值和分位数，单位毫秒；sum的单位为秒，buckets为每个桶的数量
+        '''
+        return {
+            'count': self._count,
+            'sum': self._sum,
+            'buckets': list(self._buckets),
+            'mean': self._sum / self._count * 1000 if self._count else 0.0,
+            'p50': self.percentile(50) * 1000,
+            'p90': self.percentile(90) * 1000,
+            'p99': self.percentile(99) * 1000,
+            'max': self._max * 1000
+        }
+
 
-    def set_speed_per_second(self, key, n):
-        if key in self._speed:
-            self._speed[key] = n
+class StatMemory:
+    '''
+    队列的统计
 
-    def set_last_time(self, ts):
-        self._last_time = ts
+    每个队列有publish(send)、deliver(get)、ack、redeliver、expire五种计数，
+    每种计数有累计值和最近RateWindow.WINDOW秒的速度；每个队列还有
+    入队到投递(deliver)、投递到确认(ack)两个延迟直方图；每个命令有一个
+    处理耗时直方图
+    '''
 
-    def get_last_time(self):
-        return self._last_time
+    ACTIONS = ('send', 'get', 'ack', 'redeliver', 'expire')
+    LATENCIES = ('deliver', 'ack')
+
+    def __init__(self):
+        self._map = dict()
+        self._rate = dict()
+        self._latency = dict()
+        self._service = dict()
+
+    def declare_queue(self, queue_name):
+        '''
+        声明一个队列的所有计数和延迟直方图
+        :return: boolean，True成功，False已经存在
+        '''
+        if queue_name in self._latency:
+            return False
+        for action in StatMemory.ACTIONS:
+            self.declare(action + '_' + queue_name)
+        self._latency[queue_name] = {kind: Histogram() for kind in StatMemory.LATENCIES}
+        return True
+
+    def delete_queue(self, queue_name):
+        '''
+        :return: boolean，True成功，False不存在
+        '''
+        if queue_name not in self._latency:
+            return False
+        for action in StatMemory.ACTIONS:
+            self.delete(action + '_' + queue_name)
+        del self._latency[queue_name]
+        return True
 
     def declare(self, key):
         if key not in self._map:
             self._map[key] = 0
-            self._speed[key] = 0
+            self._rate[key] = RateWindow()
             return True
         else:
             return False
 
-    def set(self, key, n):
-        if key in self._map:
+    def set(self, key, n, now=None):
+        '''
+        计数加n
+        :param key: str，例如send_队列名
+        :param n: int，数量
+        :param now: float，当前时间，None则为time.time()
+        '''
+        rate = self._rate.get(key)
+        if rate is not None:
             self._map[key] += n
+            rate.add(n, now or time.time())
 
     def get(self, key):
+        '''
+        :return: int，累计值
+        '''
         if key in self._map:
             return self._map[key]
 
+    def get_speed(self, key, now=None):
+        '''
+        :return: float，最近的每秒速度
+        '''
+        rate = self._rate.get(key)
+        if rate is not None:
+            return rate.rate(now or time.time())
+
     def delete(self, key):
         if key in self._map:
             del self._map[key]
+            del self._rate[key]
             return True
         else:
             return False
+
+    def observe_latency(self, kind, queue_name, seconds):
+        '''
+        :param kind: str，deliver为入队到投递的时间，ack为投递到确认的时间
+        :param seconds: float，耗时，单位秒
+        '''
+        histograms = self._latency.get(queue_name)
+        if histograms is not None:
+            histograms[kind].observe(seconds)
+
+    def observe_service(self, command, seconds):
+        '''
+        :param command: str，命令名，MESSAGE_TYPE的键
+        :param seconds: float，处理耗时，单位秒
+        '''
+        histogram = self._service.get(command)
+        if histogram is None:
+            histogram = self._service[command] = Histogram()
+        histogram.observe(seconds)
+
+    def get_latency(self):
+        return self._latency
+
+    def get_service(self):
+        return self._service
+
+    def get_stat(self):
+        '''
+        :return: dict，{send_队列名: 每秒速度, ...}
+        '''
+        now = time.time()
+        return {key: rate.rate(now) for key, rate in self._rate.items()}
+
+    def get_metrics(self):
+        '''
+        :return: dict，累计值、速度、延迟和命令耗时
+        '''
+        return {
+            'total': dict(self._map),
+            'speed': self.get_stat(),
+            'latency': {queue_name: {kind: histogram.get_stat() for kind, histogram in histograms.items()}
+                        for queue_name, histograms in self._latency.items()},
+            'service': {command: histogram.get_stat() for command, histogram in self._service.items()}
+        }
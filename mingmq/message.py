@@ -22,7 +22,18 @@ MESSAGE_TYPE = {
     'DELETE_ACK_MESSAGE_ID': 13, # 删除ack内存中指定的message_id内存
     'RESTORE_ACK_MESSAGE_ID': 14, # 从磁盘文件恢复ack message_id一般用于服务器重启时重新加载内存
     'RESTORE_SEND_MESSAGE': 15, # 恢复消费者未消费的任务
-    'PING': 16 # ping
+    'PING': 16, # ping
+    'SET_RESEND_INTERVAL': 17, # 修改重发未确认任务的时间间隔
+    'GET_RESEND_INTERVAL': 18, # 获取重发未确认任务的时间间隔
+    'ACK_MESSAGES': 19, # 批量确认消息
+    'SEND_DATAS_TO_QUEUE': 20, # 向队列批量推送任务
+    'DECLARE_EXCHANGE': 21, # 声明交换机
+    'DELETE_EXCHANGE': 22, # 删除交换机
+    'BIND_QUEUE': 23, # 把队列绑定到交换机
+    'UNBIND_QUEUE': 24, # 解除队列和交换机的绑定
+    'PUBLISH': 25, # 向交换机发布任务
+    'READ_FROM': 26, # 从流队列的指定位置读取任务
+    'COMMIT_OFFSET': 27, # 提交消费组在流队列中的位置
 }
 
 # 数据最大长度
@@ -32,6 +43,8 @@ MAX_DATA_LENGTH = 1024 * 1024 * 16 - 1
 SUCCESS = 1
 # 操作失败
 FAIL = 0
+# 服务器内存超过高水位，没有执行发送，稍后重试
+RETRY = 2
 
 GET = 0
 SEND = 1
@@ -47,16 +60,48 @@ class ReqPingMessage(dict):
         })
 
 
+class ReqSetResendIntervalMessage(dict):
+    """
+    修改重发未确认任务的时间间隔
+    """
+
+    def __init__(self, resend_interval):
+        self.type = MESSAGE_TYPE['SET_RESEND_INTERVAL']
+        self.resend_interval = resend_interval
+
+        super().__init__({
+            'type': self.type,
+            'resend_interval': self.resend_interval
+        })
+
+
+class ReqGetResendIntervalMessage(dict):
+    """
+    获取重发未确认任务的时间间隔
+    """
+
+    def __init__(self):
+        self.type = MESSAGE_TYPE['GET_RESEND_INTERVAL']
+
+        super().__init__({
+            'type': self.type
+        })
+
+
 class ReqRestoreAckMessageIDMessage(dict):
-    def __init__(self, message_id, queue_name):
+    def __init__(self, message_id, queue_name, message_data=None, pub_date=None):
         self.type = MESSAGE_TYPE['RESTORE_ACK_MESSAGE_ID']
         self.queue_name = queue_name
         self.message_id = message_id
+        self.message_data = message_data
+        self.pub_date = pub_date
 
         super().__init__({
             'type': self.type,
             'queue_name': self.queue_name,
-            'message_id': self.message_id
+            'message_id': self.message_id,
+            'message_data': self.message_data,
+            'pub_date': self.pub_date
         })
 
 
@@ -184,18 +229,22 @@ class ReqDeclareQueueMessage(dict):
     声明一个指定名称的队列
     """
 
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, arguments=None):
         """
         初始化
         :param queue_name: str，消息队列的名称
+        :param arguments: dict，队列的参数，例如{'type': 'stream', 'max_bytes': 1024}，None为普通队列
         """
         self.type = MESSAGE_TYPE['DECLARE_QUEUE']
         self.queue_name = queue_name
+        self.arguments = arguments
 
         super().__init__({
             'type': self.type,
             'queue_name': self.queue_name
         })
+        if arguments is not None:
+            self['arguments'] = arguments
 
 
 class ReqGetDataFromQueueMessage(dict):
@@ -203,18 +252,22 @@ class ReqGetDataFromQueueMessage(dict):
     从指定的队列中获取一条消息
     """
 
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, timeout=None):
         """
         初始化
         :param queue_name: str，消息队列的名称
+        :param timeout: float，队列为空或者被限速时服务器最多等待的秒数，None表示立即返回
         """
         self.type = MESSAGE_TYPE['GET_DATA_FROM_QUEUE']
         self.queue_name = queue_name
+        self.timeout = timeout
 
         super().__init__({
             'type': self.type,
             'queue_name': self.queue_name
         })
+        if timeout is not None:
+            self['timeout'] = timeout
 
 
 class ReqSendDataToQueueMessage(dict):
@@ -222,21 +275,29 @@ class ReqSendDataToQueueMessage(dict):
     向指定的队列推送任务
     """
 
-    def __init__(self, queue_name, message_data):
+    def __init__(self, queue_name, message_data, dedup_key=None, unique_key=None):
         """
         初始化
         :param queue_name: str，消息队列的名称
         :param message_data: str, 任务字符串
+        :param dedup_key: str，去重键，去重窗口内相同dedup_key的任务只放入队列一次
+        :param unique_key: str，唯一键队列中的唯一键，None则使用message_data
         """
         self.type = MESSAGE_TYPE['SEND_DATA_TO_QUEUE']
         self.queue_name = queue_name
         self.message_data = message_data
+        self.dedup_key = dedup_key
+        self.unique_key = unique_key
 
         super().__init__({
             'type': self.type,
             'queue_name': self.queue_name,
             'message_data': self.message_data
         })
+        if dedup_key is not None:
+            self['dedup_key'] = dedup_key
+        if unique_key is not None:
+            self['unique_key'] = unique_key
 
 
 class ReqRestoreSendMessage(dict):
@@ -259,17 +320,17 @@ class Task(dict):
 
     """
 
-    def __init__(self, message_data):
+    def __init__(self, message_data, message_id=None):
         """初始化；
 
-        :param message_id: 用于消息确认时对应的任务id，因为不可能去用任务字符串去当索引，因为任务数据可能是非常长的一个字符串，比如说任务数据可能是爬虫抓取的一个网页的所有源代码；
-        :type message_id: str
         :param message_data: 任务数据字符串；
         :type message_data: str
+        :param message_id: 用于消息确认时对应的任务id，因为不可能去用任务字符串去当索引，因为任务数据可能是非常长的一个字符串，比如说任务数据可能是爬虫抓取的一个网页的所有源代码；为None时自动生成；
+        :type message_id: str
 
         """
         super().__init__({
-            'message_id': gen_message_id(),
+            'message_id': message_id or gen_message_id(),
             'message_data': message_data
         })
 
@@ -303,6 +364,209 @@ class ReqACKMessage(dict):
         })
 
 
+class ReqACKMessagesMessage(dict):
+    """
+    批量确认同一个队列中的多条消息
+    """
+
+    def __init__(self, queue_name, message_ids):
+        """
+        初始化
+        :param queue_name: str，消息队列名称
+        :param message_ids: list，消息的id列表
+        """
+        self.type = MESSAGE_TYPE['ACK_MESSAGES']
+        self.queue_name = queue_name
+        self.message_ids = message_ids
+
+        super().__init__({
+            'type': self.type,
+            'queue_name': self.queue_name,
+            'message_ids': self.message_ids
+        })
+
+
+class ReqSendDatasToQueueMessage(dict):
+    """
+    向指定的队列批量推送任务
+    """
+
+    def __init__(self, queue_name, message_datas):
+        """
+        初始化
+        :param queue_name: str，消息队列的名称
+        :param message_datas: list, 任务字符串列表
+        """
+        self.type = MESSAGE_TYPE['SEND_DATAS_TO_QUEUE']
+        self.queue_name = queue_name
+        self.message_datas = message_datas
+
+        super().__init__({
+            'type': self.type,
+            'queue_name': self.queue_name,
+            'message_datas': self.message_datas
+        })
+
+
+class ReqDeclareExchangeMessage(dict):
+    """
+    声明交换机
+    """
+
+    def __init__(self, exchange_name, exchange_type):
+        """
+        初始化
+        :param exchange_name: str，交换机的名称
+        :param exchange_type: str，direct、fanout或者topic
+        """
+        self.type = MESSAGE_TYPE['DECLARE_EXCHANGE']
+        self.exchange_name = exchange_name
+        self.exchange_type = exchange_type
+
+        super().__init__({
+            'type': self.type,
+            'exchange_name': self.exchange_name,
+            'exchange_type': self.exchange_type
+        })
+
+
+class ReqDeleteExchangeMessage(dict):
+    """
+    删除交换机
+    """
+
+    def __init__(self, exchange_name):
+        self.type = MESSAGE_TYPE['DELETE_EXCHANGE']
+        self.exchange_name = exchange_name
+
+        super().__init__({
+            'type': self.type,
+            'exchange_name': self.exchange_name
+        })
+
+
+class ReqBindQueueMessage(dict):
+    """
+    把队列绑定到交换机
+    """
+
+    def __init__(self, exchange_name, queue_name, routing_key):
+        """
+        初始化
+        :param exchange_name: str，交换机的名称
+        :param queue_name: str，消息队列的名称
+        :param routing_key: str，绑定键，topic交换机中可以使用*和#
+        """
+        self.type = MESSAGE_TYPE['BIND_QUEUE']
+        self.exchange_name = exchange_name
+        self.queue_name = queue_name
+        self.routing_key = routing_key
+
+        super().__init__({
+            'type': self.type,
+            'exchange_name': self.exchange_name,
+            'queue_name': self.queue_name,
+            'routing_key': self.routing_key
+        })
+
+
+class ReqUnbindQueueMessage(dict):
+    """
+    解除队列和交换机的绑定
+    """
+
+    def __init__(self, exchange_name, queue_name, routing_key):
+        self.type = MESSAGE_TYPE['UNBIND_QUEUE']
+        self.exchange_name = exchange_name
+        self.queue_name = queue_name
+        self.routing_key = routing_key
+
+        super().__init__({
+            'type': self.type,
+            'exchange_name': self.exchange_name,
+            'queue_name': self.queue_name,
+            'routing_key': self.routing_key
+        })
+
+
+class ReqPublishMessage(dict):
+    """
+    向交换机发布任务
+    """
+
+    def __init__(self, exchange_name, routing_key, message_data):
+        """
+        初始化
+        :param exchange_name: str，交换机的名称
+        :param routing_key: str，路由键
+        :param message_data: str，任务字符串
+        """
+        self.type = MESSAGE_TYPE['PUBLISH']
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.message_data = message_data
+
+        super().__init__({
+            'type': self.type,
+            'exchange_name': self.exchange_name,
+            'routing_key': self.routing_key,
+            'message_data': self.message_data
+        })
+
+
+class ReqReadFromMessage(dict):
+    """
+    从流队列的指定位置读取任务
+    """
+
+    def __init__(self, queue_name, offset, max_count, consumer_group=None):
+        """
+        初始化
+        :param queue_name: str，流队列的名称
+        :param offset: int，开始读取的位置，None表示从消费组提交的位置开始
+        :param max_count: int，最多读取的任务数
+        :param consumer_group: str，消费组的名称
+        """
+        self.type = MESSAGE_TYPE['READ_FROM']
+        self.queue_name = queue_name
+        self.offset = offset
+        self.max_count = max_count
+        self.consumer_group = consumer_group
+
+        super().__init__({
+            'type': self.type,
+            'queue_name': self.queue_name,
+            'offset': self.offset,
+            'max_count': self.max_count,
+            'consumer_group': self.consumer_group
+        })
+
+
+class ReqCommitOffsetMessage(dict):
+    """
+    提交消费组在流队列中的位置
+    """
+
+    def __init__(self, queue_name, consumer_group, offset):
+        """
+        初始化
+        :param queue_name: str，流队列的名称
+        :param consumer_group: str，消费组的名称
+        :param offset: int，下一次要读取的位置
+        """
+        self.type = MESSAGE_TYPE['COMMIT_OFFSET']
+        self.queue_name = queue_name
+        self.consumer_group = consumer_group
+        self.offset = offset
+
+        super().__init__({
+            'type': self.type,
+            'queue_name': self.queue_name,
+            'consumer_group': self.consumer_group,
+            'offset': self.offset
+        })
+
+
 class ResMessage(dict):
     """
     响应消息
@@ -334,6 +598,15 @@ ACK_PROCESS_MESSAGE = {
     'DELETE_ACK_MESSAGE_ID': 4
 }
 
+# 确认消息进程每种消息的字段，用于mingmq.channel.BatchChannel编码
+ACK_PROCESS_MESSAGE_FIELDS = {
+    ACK_PROCESS_MESSAGE['GET']: ('message_id', 'queue_name', 'message_data', 'pub_date'),
+    ACK_PROCESS_MESSAGE['ACK']: ('message_id', 'queue_name', 'pub_date'),
+    ACK_PROCESS_MESSAGE['ACK_RETRY']: ('pub_date',),
+    ACK_PROCESS_MESSAGE['DELETE_QUEUE_NOACK']: ('queue_name',),
+    ACK_PROCESS_MESSAGE['DELETE_ACK_MESSAGE_ID']: ('queue_name', 'message_id'),
+}
+
 
 class PipeDeleteQueueNoackMessage(dict):
     """
@@ -417,6 +690,13 @@ COMPLETELY_PERSISTENT_PROCESS_MESSAGE = {
     'DELETE_QUEUE': 2, # 根据队列名删除
 }
 
+# 完全持久化进程每种消息的字段，用于mingmq.channel.BatchChannel编码
+COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS = {
+    COMPLETELY_PERSISTENT_PROCESS_MESSAGE['SEND']: ('queue_name', 'message_data', 'message_id', 'pub_date'),
+    COMPLETELY_PERSISTENT_PROCESS_MESSAGE['GET']: ('queue_name', 'message_id'),
+    COMPLETELY_PERSISTENT_PROCESS_MESSAGE['DELETE_QUEUE']: ('queue_name',),
+}
+
 
 class PipeCompletelyPersistentProcessSendMessage(dict):
     def __init__(self, queue_name, message_data, message_id):
@@ -455,4 +735,17 @@ class PipeCompletelyPersistentProcessDeleteQueueMessage(dict):
         super().__init__({
             'type': self.type,
             'queue_name': self.queue_name
-        })
\ No newline at end of file
+        })
+
+
+def message_id_time(message_id):
+    """
+    从gen_message_id生成的任务id中取出入队时间，不是这种格式的id返回None
+    """
+    if isinstance(message_id, str) and message_id.startswith('task_id:'):
+        try:
+            # 交换机投递到多个队列时，id后面还有':序号'
+            return float(message_id[8:].partition(':')[0])
+        except ValueError:
+            return None
+    return None
@@ -0,0 +1,155 @@
+"""把GET_STAT的结果转换成prometheus的文本格式。
+
+mmweb的/metrics接口调用GET_STAT后用render()生成响应，监控系统直接抓取即可，
+指标都以mingmq_开头，持久化的落后情况见mingmq_persistence_开头的指标::
+
+    # HELP mingmq_queue_messages 队列中的任务数
+    # TYPE mingmq_queue_messages gauge
+    mingmq_queue_messages{queue="q"} 3
+
+直方图的桶与mingmq.memory.Histogram一致，按微秒的2的幂划分，le的单位为秒。
+"""
+
+from mingmq.memory import Histogram, StatMemory
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+# (指标名, BatchChannel.get_stat()的键, 类型, 说明)，持久化在线程中时没有字节数
+_CHANNEL_METRICS = (
+    ('mingmq_ipc_records_total', 'records', 'counter', '发送给持久化进程的消息数'),
+    ('mingmq_ipc_sent_bytes_total', 'sent_bytes', 'counter', '发送给持久化进程的字节数'),
+    ('mingmq_ipc_buffered_bytes', 'buffered_bytes', 'gauge', '还在服务器缓冲区中没有发送给持久化进程的字节数'),
+    ('mingmq_persistence_committed_records_total', 'committed_records', 'counter', '持久化进程已经提交的消息数'),
+    ('mingmq_persistence_records_per_second', 'committed_per_second', 'gauge', '持久化进程最近每秒提交的消息数'),
+    ('mingmq_persistence_backlog_records', 'backlog_records', 'gauge', '还没有提交到sqlite的消息数'),
+    ('mingmq_persistence_oldest_unpersisted_seconds', 'oldest_unpersisted_age', 'gauge', '最早的没有提交的消息已经等待的秒数'),
+    ('mingmq_persistence_mean_batch_size', 'mean_batch_size', 'gauge', '平均每个事务提交的消息数'),
+    ('mingmq_persistence_last_batch_size', 'last_batch_size', 'gauge', '最近一个事务提交的消息数'),
+)
+
+# (指标名, GET_STAT中metrics['memory']的键, 说明)
+_MEMORY_METRICS = (
+    ('mingmq_memory_bytes', 'used_bytes', '队列和未确认任务占用的字节数'),
+    ('mingmq_memory_high_watermark_bytes', 'high_watermark', '内存高水位，0为不限制'),
+    ('mingmq_memory_low_watermark_bytes', 'low_watermark', '内存低水位'),
+    ('mingmq_memory_blocked', 'blocked', '1表示超过高水位，暂停接收任务'),
+    ('mingmq_paused_connections', 'paused_connections', '暂停读取的只发送任务的连接数'),
+)
+
+
+class _Writer:
+    def __init__(self):
+        self._lines = []
+
+    def family(self, name, _type, help_text):
+        self._lines.append('# HELP %s %s' % (name, help_text))
+        self._lines.append('# TYPE %s %s' % (name, _type))
+
+    def sample(self, name, labels, value):
+        self._lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+    def histogram(self, name, labels, stat):
+        cumulative = 0
+        for i, n in enumerate(stat['buckets']):
+            cumulative += n
+            self.sample(name + '_bucket', labels + [('le', _number(Histogram.upper_bound(i)))], cumulative)
+        self.sample(name + '_sum', labels, stat['sum'])
+        self.sample(name + '_count', labels, stat['count'])
+
+    def text(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+def render(stat):
+    """生成prometheus的文本格式；
+
+    :param stat: GET_STAT返回的json_obj[0]；
+    :type stat: dict
+    :return: 文本；
+    :rtype: str
+    """
+    writer = _Writer()
+    queue_infor = stat.get('queue_infor', {})
+    task_ack_infor = stat.get('task_ack_infor', {})
+    metrics = stat.get('metrics', {})
+
+    writer.family('mingmq_queue_messages', 'gauge', '队列中的任务数')
+    for queue_name, (count, _) in sorted(queue_infor.items()):
+        writer.sample('mingmq_queue_messages', [('queue', queue_name)], count)
+
+    writer.family('mingmq_queue_bytes', 'gauge', '队列中在内存里的任务数据字节数，惰性队列只算队头')
+    for queue_name, (_, size) in sorted(queue_infor.items()):
+        writer.sample('mingmq_queue_bytes', [('queue', queue_name)], size)
+
+    writer.family('mingmq_queue_unacked_messages', 'gauge', '已经投递还没有确认的任务数')
+    for queue_name, (count, _) in sorted(task_ack_infor.items()):
+        writer.sample('mingmq_queue_unacked_messages', [('queue', queue_name)], count)
+
+    writer.family('mingmq_queue_unacked_bytes', 'gauge', '已经投递还没有确认的任务数据字节数')
+    for queue_name, (_, size) in sorted(task_ack_infor.items()):
+        writer.sample('mingmq_queue_unacked_bytes', [('queue', queue_name)], size)
+
+    # 键的格式为 动作_队列名，动作见StatMemory.ACTIONS
+    writer.family('mingmq_queue_events_total', 'counter', '队列的send/get/ack/redeliver/expire累计次数')
+    for key, total in sorted(metrics.get('total', {}).items()):
+        action, _, queue_name = key.partition('_')
+        if action in StatMemory.ACTIONS:
+            writer.sample('mingmq_queue_events_total', [('queue', queue_name), ('action', action)], total)
+
+    writer.family('mingmq_queue_events_per_second', 'gauge', '队列最近的send/get/ack/redeliver/expire每秒次数')
+    for key, speed in sorted(metrics.get('speed', {}).items()):
+        action, _, queue_name = key.partition('_')
+        if action in StatMemory.ACTIONS:
+            writer.sample('mingmq_queue_events_per_second', [('queue', queue_name), ('action', action)], speed)
+
+    writer.family('mingmq_queue_latency_seconds', 'histogram', '入队到投递(deliver)和投递到确认(ack)的时间')
+    for queue_name, histograms in sorted(metrics.get('latency', {}).items()):
+        for stage, histogram in sorted(histograms.items()):
+            writer.histogram('mingmq_queue_latency_seconds', [('queue', queue_name), ('stage', stage)], histogram)
+
+    writer.family('mingmq_command_duration_seconds', 'histogram', '服务器处理每个命令的耗时')
+    for command, histogram in sorted(metrics.get('service', {}).items()):
+        writer.histogram('mingmq_command_duration_seconds', [('command', command)], histogram)
+
+    if 'connections' in metrics:
+        writer.family('mingmq_connections', 'gauge', '客户端连接数')
+        writer.sample('mingmq_connections', [], metrics['connections'])
+
+    memory = metrics.get('memory')
+    if memory:
+        for name, key, help_text in _MEMORY_METRICS:
+            writer.family(name, 'gauge', help_text)
+            writer.sample(name, [], int(memory[key]))
+
+    channels = metrics.get('channels', {})
+    for name, key, _type, help_text in _CHANNEL_METRICS:
+        writer.family(name, _type, help_text)
+        for channel, channel_stat in sorted(channels.items()):
+            if key in channel_stat:
+                writer.sample(name, [('channel', channel)], channel_stat[key])
+
+    writer.family('mingmq_persistence_commit_seconds', 'histogram', '持久化进程提交一个事务的耗时')
+    for channel, channel_stat in sorted(channels.items()):
+        if 'commit_latency' in channel_stat:
+            writer.histogram('mingmq_persistence_commit_seconds', [('channel', channel)], channel_stat['commit_latency'])
+
+    return writer.text()
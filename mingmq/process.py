@@ -5,18 +5,19 @@ import traceback
 import math
 import socket
 import time
-import json
 
-from multiprocessing import Queue
+from mingmq.channel import BatchChannel
+from mingmq.memory import Histogram, RateWindow
 from mingmq.db import AckProcessDB, CompletelyPersistentProcessDB
 from mingmq.message import ACK_PROCESS_MESSAGE, COMPLETELY_PERSISTENT_PROCESS_MESSAGE
 from mingmq.client import Client
-from mingmq.message import FAIL
+from mingmq.message import SUCCESS, FAIL
 from mingmq.server import Server
 from mingmq.client import Pool
-from threading import Thread
+from collections import deque
+from sqlite3 import connect
+from threading import Thread, Event
 from multiprocessing import Process
-from mingmq.settings import CONFIG_FILE
 
 
 class CompletelyPersistentProcess:
@@ -25,7 +26,7 @@ class CompletelyPersistentProcess:
     def __init__(
             self,
             completely_persistent_process_db_file,
-            completely_persistent_process_queue: Queue,
+            completely_persistent_process_queue: BatchChannel,
             client_host,
             client_port,
             client_user,
@@ -118,11 +119,27 @@ class CompletelyPersistentProcess:
         self._logger.debug('正在启动')
         while True:
             try:
-                msg = self._completely_persistent_process_queue.get()
-                self._dispatch(msg)
+                msgs = self._completely_persistent_process_queue.get_batch()
+                start = time.perf_counter()
+                try:
+                    self.apply(msgs)
+                finally:
+                    self._completely_persistent_process_queue.commit(len(msgs), time.perf_counter() - start)
             except Exception:
                 self._logger.error(traceback.format_exc())
 
+    def apply(self, msgs, conn=None):
+        """在一个事务中处理一批消息；
+
+        :param msgs: 消息列表；
+        :type msgs: list
+        :param conn: 外部的数据库连接，见CompletelyPersistentProcessDB.transaction；
+
+        """
+        with self._completely_persistent_process_db.transaction(conn):
+            for msg in msgs:
+                self._dispatch(msg)
+
     def _dispatch(self, msg):
         if 'type' not in msg:
             self._logger.error('错误_dispatch1：msg: %s', repr(msg)[:100])
@@ -189,14 +206,19 @@ class MQProcess:
     def __init__(
             self,
             server_status,
-            completely_persistent_process_queue: Queue,
-            ack_process_queue: Queue
+            completely_persistent_process_queue: BatchChannel,
+            ack_process_queue: BatchChannel,
+            write_behind_thread=None
     ):
         self._server_status = server_status
         self._completely_persistent_process_queue = completely_persistent_process_queue
         self._ack_process_queue = ack_process_queue
+        self._write_behind_thread = write_behind_thread
 
     def serv_forever(self):
+        if self._write_behind_thread:
+            self._write_behind_thread.start()
+
         self._server = Server(self._server_status,
                               self._completely_persistent_process_queue,
                               self._ack_process_queue)
@@ -217,7 +239,7 @@ class AckProcess:
             client_port,
             client_user,
             client_passwd,
-            ack_process_queue: Queue
+            ack_process_queue: BatchChannel
     ):
         self._ack_process_db = AckProcessDB(ack_process_db_file)
         self._ack_process_db.create_table()
@@ -277,7 +299,9 @@ class AckProcess:
                             message_id, queue_name, message_data, pub_date = row
                             if queue_name not in filter:
                                 pool.opera('declare_queue', *(queue_name,))
-                            t = Thread(target=pool.opera, args=(method_name, *(message_id, queue_name)))
+                                filter.append(queue_name)
+                            t = Thread(target=pool.opera, args=(method_name, *(message_id, queue_name,
+                                                                                message_data, pub_date)))
                             t.start()
                             ts.append(t)
 
@@ -313,11 +337,27 @@ class AckProcess:
         self.logger.debug('正在启动')
         while True:
             try:
-                msg = self._ack_process_queue.get()
-                self._dispatch(msg)
+                msgs = self._ack_process_queue.get_batch()
+                start = time.perf_counter()
+                try:
+                    self.apply(msgs)
+                finally:
+                    self._ack_process_queue.commit(len(msgs), time.perf_counter() - start)
             except Exception:
                 self.logger.error(traceback.format_exc())
 
+    def apply(self, msgs, conn=None):
+        """在一个事务中处理一批消息；
+
+        :param msgs: 消息列表；
+        :type msgs: list
+        :param conn: 外部的数据库连接，见AckProcessDB.transaction；
+
+        """
+        with self._ack_process_db.transaction(conn):
+            for msg in msgs:
+                self._dispatch(msg)
+
     def _dispatch(self, msg):
         if 'type' not in msg:
             self.logger.error('错误_dispatch1：msg: %s', repr(msg)[:100])
@@ -439,7 +479,7 @@ class AckProcess:
             res_msg = client.send_data_to_queue(queue_name, message_data)
             self.logger.debug('_ack_retry: 重新发送任务: %s, %s, 服务器返回:%s',
                               repr(queue_name), repr(message_data), repr(res_msg)[:100])
-            if res_msg['status'] == FAIL:  # 如果发送失败，重新放到数据库
+            if res_msg['status'] != SUCCESS:  # 如果发送失败或者服务器要求重试，重新放到数据库
                 return False
             return True
         except:
@@ -461,92 +501,149 @@ class AckProcess:
             return False
 
 
-class NoAckProcess:
-    """这个进程用于隔一段时间将未确认的任务重新推送到队列。
+class _WriteBehindSink:
+    """WriteBehindThread的入口，和BatchChannel的写端有相同的接口，所以
+    服务器不需要关心持久化是在进程中还是在线程中；
 
     """
-    logger = logging.getLogger('NoAckProcess')
+    def __init__(self, write_behind_thread, kind):
+        self._write_behind_thread = write_behind_thread
+        self._kind = kind
+
+    def put_nowait(self, msg):
+        self._write_behind_thread.put_nowait(self._kind, msg)
+
+    def flush(self):
+        self._write_behind_thread.flush()
+
+    def get_stat(self):
+        return self._write_behind_thread.get_stat()
+
+
+class WriteBehindThread:
+    """在服务器进程中异步写sqlite的线程，可以代替AckProcess和
+    CompletelyPersistentProcess两个进程。
+
+    消息不需要pickle，也不会被复制，只是把dict的引用放到deque中，deque的
+    append和popleft是线程安全的，不需要加锁。sqlite在执行语句时会释放GIL，
+    所以写数据库时不会阻塞事件循环。
+
+    两个数据库通过ATTACH在同一个连接中，每一批消息按照发生的顺序在同一个
+    事务中提交，所以确认消息不会比对应的获取消息先写到磁盘。
+    """
+    logger = logging.getLogger('WriteBehindThread')
+
+    ACK = 0
+    COMPLETELY_PERSISTENT = 1
 
     def __init__(
             self,
+            ack_process,
+            completely_persistent_process,
             ack_process_db_file,
-            client_host,
-            client_port,
-            client_user,
-            client_passwd
+            completely_persistent_process_db_file
     ):
-        self._ack_process_db: AckProcessDB = AckProcessDB(ack_process_db_file)
-        self._ack_process_db.create_table()
+        self._ack_process = ack_process
+        self._completely_persistent_process = completely_persistent_process
+        self._ack_process_db_file = ack_process_db_file
+        self._completely_persistent_process_db_file = completely_persistent_process_db_file
 
-        self._client_host = client_host
-        self._client_port = client_port
-        self._client_user = client_user
-        self._client_passwd = client_passwd
+        self._events = None
+        self._wakeup = None
 
-    def _read_resend_interval(self):
-        f = open(CONFIG_FILE, 'r')
-        config = json.load(f)
-        f.close()
-        return config['RESEND_INTERVAL']
+        self._records = 0
+        self._committed_records = 0
+        self._commits = 0
+        self._last_batch_size = 0
+        self._commit_latency = Histogram()
+        self._committed_rate = RateWindow()
 
-    def _sleep(self, resend_interval):
-        time.sleep(resend_interval)
+    def ack_sink(self):
+        return _WriteBehindSink(self, WriteBehindThread.ACK)
 
-    def _delete_row_ack_db(self, message_id):
-        return self._ack_process_db.delete_by_message_id(message_id)
+    def completely_persistent_sink(self):
+        return _WriteBehindSink(self, WriteBehindThread.COMPLETELY_PERSISTENT)
 
-    def _task(self, queue_name, message_data, message_id, pool):
-        conn: Client = None
-        try:
-            conn = pool.get_conn()
-
-            self.logger.debug('即将重新推送到队列的数据为: %s', (queue_name, message_data, message_id))
-            res = conn.send_data_to_queue(queue_name, message_data)
-            if res and res['status'] != FAIL:
-                self.logger.debug('重新很久未ack的数据推送到队列成功')
-                res = conn.ack_message(queue_name, message_id)
-                if res and res['status'] != FAIL:
-                    if self._delete_row_ack_db(message_id) < 0:
-                        self.logger.error('删除ack_db失败，message_id: %s', message_id)
-                else:
-                    self.logger.debug('消息重新推送陈宫，但是，统计内存中的未确认数没有递减成功')
-            else:
-                self.logger.debug('消息重新推送失败, %s，可能是因为mq内存刚刚启动，请等待一下下一次检查', res)
-        except:
-            self.logger.error(traceback.format_exc())
-        finally:
-            if conn: pool.back_conn(conn)
+    def start(self):
+        # 线程相关的对象在服务器进程中才创建，因为线程不能跨进程
+        self._events = deque()
+        self._wakeup = Event()
+        Thread(target=self.serv_forever, name='write_behind_thread', daemon=True).start()
+
+    def put_nowait(self, kind, msg):
+        self._events.append((time.time(), kind, msg))
+        self._records += 1
+
+    def flush(self):
+        if self._events:
+            self._wakeup.set()
 
     def serv_forever(self):
+        self.logger.debug('正在启动')
         while True:
-            resend_interval = self._read_resend_interval()
+            self._wakeup.wait()
+            self._wakeup.clear()
 
-            pool = None
-            rows_len = 0
-            try:
-                pool = Pool(self._client_host, self._client_port, self._client_user, self._client_passwd, 100)
-
-                current_timestamp = int(time.time())
-                by_pub_date = current_timestamp - resend_interval
-
-                tasks = []
-                rows = self._ack_process_db.pagnation(by_pub_date)
-                rows_len = len(rows)
-                for row in rows:
-                    message_id, queue_name, message_data, pub_date = row
-                    task = Thread(target=self._task,
-                                  args=(queue_name, message_data, message_id, pool))
-                    tasks.append(task)
-                    task.start()
-
-                for task in tasks:
-                    task.join()
-            except:
-                self.logger.error(traceback.format_exc())
-            finally:
-                if rows_len < 100:
-                    try:
-                        if pool: pool.release()
-                    except:
-                        self.logger.error(traceback.format_exc())
-                    self._sleep(resend_interval)
\ No newline at end of file
+            batch = []
+            while self._events:
+                batch.append(self._events.popleft()[1:])
+
+            if batch:
+                start = time.perf_counter()
+                try:
+                    self._write(batch)
+                except Exception:
+                    self.logger.error(traceback.format_exc())
+                finally:
+                    self._commit_latency.observe(time.perf_counter() - start)
+                    self._committed_records += len(batch)
+                    self._commits += 1
+                    self._last_batch_size = len(batch)
+                    self._committed_rate.add(len(batch), time.time())
+
+    def get_stat(self):
+        """和BatchChannel.get_stat()的字段相同，只是没有批次和字节数，两个入口
+        在同一个事务中提交，所以返回的是同一个统计；
+
+        :rtype: dict
+        """
+        now = time.time()
+        oldest = self._events[0][0] if self._events else now
+
+        return {
+            'records': self._records,
+            'committed_records': self._committed_records,
+            'committed_per_second': self._committed_rate.rate(now),
+            'backlog_records': self._records - self._committed_records,
+            'oldest_unpersisted_age': now - oldest,
+            'mean_batch_size': self._committed_records / self._commits if self._commits else 0.0,
+            'last_batch_size': self._last_batch_size,
+            'commit_latency': self._commit_latency.get_stat()
+        }
+
+    def _write(self, batch):
+        conn = connect(self._completely_persistent_process_db_file)
+        try:
+            conn.execute('attach database ? as ack', (self._ack_process_db_file,))
+
+            # 按顺序把连续的同类消息交给对应的处理对象
+            i = 0
+            while i < len(batch):
+                kind = batch[i][0]
+                j = i
+                while j < len(batch) and batch[j][0] == kind:
+                    j += 1
+
+                msgs = [msg for _, msg in batch[i:j]]
+                if kind == WriteBehindThread.ACK:
+                    self._ack_process.apply(msgs, conn)
+                else:
+                    self._completely_persistent_process.apply(msgs, conn)
+                i = j
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
@@ -0,0 +1,527 @@
+"""流队列(stream)，只追加的消息日志。
+
+普通队列的GET_DATA_FROM_QUEUE会把任务从队列中删除，所以多个互不相关的消费组
+没法读同一份数据。流队列把消息追加到日志中，每条消息有一个递增的offset，读取
+不会删除消息，每个消费组自己保存读到了哪里(offset)。
+
+日志由多个段(segment)组成，每个段在内存中是一个列表，在磁盘上是一个文件，文件名
+是段中第一条消息的offset。当前的段超过segment_bytes时创建新的段，总大小超过
+max_bytes或者最老的段超过max_age秒时，整段删除最老的段，正在写的段不会被删除。
+
+目录结构::
+
+    stream_dir/
+        <队列名>/
+            arguments.json          # 声明队列时的参数
+            00000000000000000000.seg
+            00000000000000001000.seg
+            offsets                 # 消费组提交的offset
+
+段文件和offsets文件使用mingmq.codec的记录编码，段文件中每条记录为
+(时间戳, message_data)，offsets中每条记录为(消费组, offset)，后面的覆盖前面的。
+没有stream_dir时流队列只保存在内存中。
+"""
+
+import bisect
+import json
+import logging
+import os
+import platform
+import shutil
+import time
+import traceback
+from urllib.parse import unquote
+
+from mingmq.bloom import DEFAULT_INITIAL_CAPACITY, DEFAULT_ERROR_RATE
+from mingmq.codec import encode_record, iter_records
+from mingmq.lazy import DEFAULT_HEAD_BYTES
+from mingmq.utils import queue_dir
+
+QUEUE_TYPE_CLASSIC = 'classic'
+QUEUE_TYPE_STREAM = 'stream'
+
+# 单个段的默认大小
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+
+_OP_ENTRY = 0  # (timestamp, message_data)
+_OP_OFFSET = 1  # (group, offset)
+
+_SEGMENT_SUFFIX = '.seg'
+_ARGUMENTS_FILE = 'arguments.json'
+_OFFSETS_FILE = 'offsets'
+
+
+class Segment:
+    """日志中的一个段
+    """
+
+    def __init__(self, base_offset, path=None):
+        self.base_offset = base_offset
+        self.path = path
+        self.entries = []  # [(timestamp, message_data), ...]
+        self.size = 0
+        self._file = None
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            buf = f.read()
+        for _, (timestamp, message_data), _ in iter_records(buf):
+            self.entries.append((timestamp, message_data))
+            self.size += len(message_data)
+
+    def append(self, timestamp, message_data):
+        self.entries.append((timestamp, message_data))
+        self.size += len(message_data)
+        if self.path:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(encode_record(_OP_ENTRY, timestamp, message_data))
+
+    def next_offset(self):
+        return self.base_offset + len(self.entries)
+
+    def last_timestamp(self):
+        return self.entries[-1][0] if self.entries else None
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class SegmentLog:
+    """由多个段组成的只追加日志
+    """
+    _logger = logging.getLogger('SegmentLog')
+
+    def __init__(self, directory=None, segment_bytes=DEFAULT_SEGMENT_BYTES, max_bytes=None, max_age=None):
+        """初始化；
+
+        :param directory: 段文件的目录，None则只保存在内存中；
+        :type directory: str
+        :param segment_bytes: 单个段的最大字节数；
+        :type segment_bytes: int
+        :param max_bytes: 日志的最大字节数，None表示不限制；
+        :type max_bytes: int
+        :param max_age: 消息最长保存的秒数，None表示不限制；
+        :type max_age: int
+
+        """
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._segments = []
+        self._base_offsets = []
+        self._size = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(_SEGMENT_SUFFIX):
+                    segment = Segment(int(name[:-len(_SEGMENT_SUFFIX)]), os.path.join(directory, name))
+                    segment.load()
+                    self._add_segment(segment)
+
+        if not self._segments:
+            self._roll(0)
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._base_offsets.append(segment.base_offset)
+        self._size += segment.size
+
+    def _roll(self, base_offset):
+        path = None
+        if self._directory:
+            path = os.path.join(self._directory, '%020d%s' % (base_offset, _SEGMENT_SUFFIX))
+            # 空的段也要有文件，重启后offset才能从这里继续
+            open(path, 'ab').close()
+        if self._segments:
+            self._segments[-1].close()
+        self._add_segment(Segment(base_offset, path))
+
+    def first_offset(self):
+        return self._segments[0].base_offset
+
+    def next_offset(self):
+        return self._segments[-1].next_offset()
+
+    def get_size(self):
+        return self._size
+
+    def get_segment_count(self):
+        return len(self._segments)
+
+    def append(self, message_data, now=None):
+        """
+        :param message_data: str，消息数据
+        :return: int，消息的offset
+        """
+        now = now or time.time()
+        segment = self._segments[-1]
+        if segment.size >= self._segment_bytes:
+            self._roll(segment.next_offset())
+            segment = self._segments[-1]
+            self.retain(now)
+
+        offset = segment.next_offset()
+        segment.append(now, message_data)
+        self._size += len(message_data)
+        if self._max_bytes is not None and self._size > self._max_bytes:
+            self.retain(now)
+        return offset
+
+    def read(self, offset, max_count):
+        """从offset开始读取最多max_count条消息，offset早于最老的消息时从最老的消息开始；
+
+        :return: list，[(offset, timestamp, message_data), ...]
+        """
+        offset = max(offset, self.first_offset())
+        i = bisect.bisect_right(self._base_offsets, offset) - 1
+        result = []
+        while i < len(self._segments) and len(result) < max_count:
+            segment = self._segments[i]
+            start = offset - segment.base_offset
+            for timestamp, message_data in segment.entries[start:start + max_count - len(result)]:
+                result.append((offset, timestamp, message_data))
+                offset += 1
+            i += 1
+        return result
+
+    def retain(self, now=None):
+        """按max_bytes和max_age删除最老的段，正在写的段不会被删除；
+
+        :return: int，删除的段数
+        """
+        now = now or time.time()
+        n = 0
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_big = self._max_bytes is not None and self._size > self._max_bytes
+            too_old = self._max_age is not None and \
+                oldest.last_timestamp() is not None and now - oldest.last_timestamp() > self._max_age
+            if not (too_big or too_old or not oldest.entries):
+                break
+            self._segments.pop(0)
+            self._base_offsets.pop(0)
+            self._size -= oldest.size
+            oldest.remove()
+            n += 1
+        return n
+
+    def truncate(self):
+        """删除所有的消息，offset继续递增
+        """
+        next_offset = self.next_offset()
+        for segment in self._segments:
+            segment.remove()
+        self._segments = []
+        self._base_offsets = []
+        self._size = 0
+        self._roll(next_offset)
+
+    def flush(self):
+        self._segments[-1].flush()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+
+class Stream:
+    """一个流队列，包括日志和每个消费组提交的offset
+    """
+
+    def __init__(self, arguments, directory=None):
+        self._arguments = arguments
+        self._directory = directory
+        self._log = SegmentLog(directory,
+                               arguments.get('segment_bytes') or DEFAULT_SEGMENT_BYTES,
+                               arguments.get('max_bytes'),
+                               arguments.get('max_age'))
+        self._offsets = dict()
+        self._offsets_file = None
+
+        if directory:
+            with open(os.path.join(directory, _ARGUMENTS_FILE), 'w') as f:
+                json.dump(arguments, f)
+            self._load_offsets()
+
+    def _load_offsets(self):
+        path = os.path.join(self._directory, _OFFSETS_FILE)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for _, (group, offset), _ in iter_records(f.read()):
+                    self._offsets[group] = offset
+
+        # 重写一遍，每个消费组只保留最后一条
+        with open(path + '.tmp', 'wb') as f:
+            for group, offset in self._offsets.items():
+                f.write(encode_record(_OP_OFFSET, group, offset))
+        os.rename(path + '.tmp', path)
+        self._offsets_file = open(path, 'ab')
+
+    def get_arguments(self):
+        return self._arguments
+
+    def get_log(self):
+        return self._log
+
+    def append(self, message_data):
+        return self._log.append(message_data)
+
+    def read(self, offset, max_count, group=None):
+        """offset为None时从消费组提交的offset开始读，没有提交过则从最老的消息开始
+        """
+        if offset is None:
+            offset = self._offsets.get(group, self._log.first_offset())
+        return self._log.read(offset, max_count)
+
+    def commit_offset(self, group, offset):
+        """
+        :param group: str，消费组
+        :param offset: int，下一次要读的offset
+        """
+        self._offsets[group] = offset
+        if self._offsets_file:
+            self._offsets_file.write(encode_record(_OP_OFFSET, group, offset))
+
+    def get_offset(self, group):
+        return self._offsets.get(group)
+
+    def get_stat(self):
+        return [self._log.first_offset(), self._log.next_offset(), self._log.get_size(),
+                self._log.get_segment_count(), dict(self._offsets)]
+
+    def flush(self):
+        self._log.flush()
+        if self._offsets_file:
+            self._offsets_file.flush()
+
+    def close(self):
+        self._log.close()
+        if self._offsets_file:
+            self._offsets_file.close()
+            self._offsets_file = None
+
+    def delete(self):
+        self.close()
+        if self._directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def check_arguments(arguments):
+    """检查DECLARE_QUEUE的arguments，返回补全了默认值的arguments，错误时返回None；
+
+    :param arguments: dict，None表示普通队列
+    :rtype: dict
+    """
+    if arguments is None:
+        arguments = dict()
+    if not isinstance(arguments, dict):
+        return None
+
+    arguments = dict(arguments)
+    queue_type = arguments.setdefault('type', QUEUE_TYPE_CLASSIC)
+    if queue_type not in (QUEUE_TYPE_CLASSIC, QUEUE_TYPE_STREAM):
+        return None
+
+    for key in ('segment_bytes', 'max_bytes', 'max_age'):
+        value = arguments.get(key)
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+            return None
+
+    # 惰性队列，见mingmq.lazy
+    if not isinstance(arguments.setdefault('lazy', False), bool):
+        return None
+    if arguments['lazy']:
+        head_bytes = arguments.setdefault('head_bytes', DEFAULT_HEAD_BYTES)
+        if queue_type == QUEUE_TYPE_STREAM or type(head_bytes) is not int or head_bytes < 0:
+            return None
+
+    # 唯一键队列，见mingmq.bloom
+    if not isinstance(arguments.setdefault('unique', False), bool):
+        return None
+    if arguments['unique']:
+        initial_capacity = arguments.setdefault('initial_capacity', DEFAULT_INITIAL_CAPACITY)
+        error_rate = arguments.setdefault('error_rate', DEFAULT_ERROR_RATE)
+        if type(initial_capacity) is not int or initial_capacity <= 0 or \
+                type(error_rate) not in (int, float) or not 0 < error_rate < 1:
+            return None
+
+    # 限制投递速率，见mingmq.memory.TokenBucket
+    max_delivery_rate = arguments.get('max_delivery_rate')
+    if max_delivery_rate is not None:
+        delivery_burst = arguments.setdefault('delivery_burst', 1)
+        if queue_type == QUEUE_TYPE_STREAM or type(max_delivery_rate) not in (int, float) or \
+                max_delivery_rate <= 0 or type(delivery_burst) is not int or delivery_burst < 1:
+            return None
+    return arguments
+
+
+class StreamMemory:
+    """
+    流队列的内存模型
+    """
+    _logger = logging.getLogger('StreamMemory')
+
+    def __init__(self, stream_dir=None):
+        """
+        :param stream_dir: str，流队列的根目录，None则只保存在内存中
+        """
+        self._stream_dir = stream_dir
+        self._map = dict()
+
+    def get_self(self):
+        return self._map
+
+    def _path(self, queue_name):
+        return queue_dir(self._stream_dir, queue_name)
+
+    def restore(self):
+        """
+        从stream_dir中恢复所有的流队列
+        :return: list，恢复的队列名
+        """
+        if not self._stream_dir or not os.path.isdir(self._stream_dir):
+            return []
+
+        for name in sorted(os.listdir(self._stream_dir)):
+            path = os.path.join(self._stream_dir, name)
+            try:
+                with open(os.path.join(path, _ARGUMENTS_FILE)) as f:
+                    arguments = json.load(f)
+                self._map[unquote(name)] = Stream(arguments, path)
+            except Exception:
+                self._logger.error('流队列%s恢复失败: %s', name, traceback.format_exc())
+        return list(self._map)
+
+    def declare(self, queue_name, arguments):
+        if queue_name in self._map:
+            return False
+        path = None
+        if self._stream_dir:
+            # 队列名是目录名，'..'这样的名字会指向快照目录，删除队列时整个目录都会被删除
+            path = self._path(queue_name)
+            if path is None:
+                return False
+        self._map[queue_name] = Stream(arguments, path)
+        return True
+
+    def delete(self, queue_name):
+        stream = self._map.pop(queue_name, None)
+        if stream is None:
+            return False
+        stream.delete()
+        return True
+
+    def clear(self, queue_name):
+        if queue_name in self._map:
+            self._map[queue_name].get_log().truncate()
+            return True
+        return False
+
+    def get(self, queue_name):
+        return self._map.get(queue_name)
+
+    def append(self, queue_name, message_data):
+        """
+        :return: int，消息的offset，None表示没有这个流队列
+        """
+        stream = self._map.get(queue_name)
+        if stream is not None:
+            return stream.append(message_data)
+        return None
+
+    def read(self, queue_name, offset, max_count, group=None):
+        stream = self._map.get(queue_name)
+        if stream is not None:
+            return stream.read(offset, max_count, group)
+        return None
+
+    def commit_offset(self, queue_name, group, offset):
+        stream = self._map.get(queue_name)
+        if stream is not None:
+            stream.commit_offset(group, offset)
+            return True
+        return False
+
+    def retain(self):
+        now = time.time()
+        for stream in self._map.values():
+            stream.get_log().retain(now)
+
+    def flush(self):
+        for stream in self._map.values():
+            stream.flush()
+
+    def close(self):
+        for stream in self._map.values():
+            stream.close()
+
+    def get_stat(self):
+        tmp = dict()
+        for k, v in self._map.items():
+            tmp[k] = v.get_stat()
+        return tmp
+
+
+if not platform.platform().startswith('Linux'):
+    from threading import Lock
+
+    _LOCK = Lock()
+
+
+class SyncStreamMemory(StreamMemory):
+    """
+    流队列的内存模型，线程安全
+    """
+
+    def declare(self, queue_name, arguments):
+        with _LOCK:
+            return super().declare(queue_name, arguments)
+
+    def delete(self, queue_name):
+        with _LOCK:
+            return super().delete(queue_name)
+
+    def clear(self, queue_name):
+        with _LOCK:
+            return super().clear(queue_name)
+
+    def append(self, queue_name, message_data):
+        with _LOCK:
+            return super().append(queue_name, message_data)
+
+    def read(self, queue_name, offset, max_count, group=None):
+        with _LOCK:
+            return super().read(queue_name, offset, max_count, group)
+
+    def commit_offset(self, queue_name, group, offset):
+        with _LOCK:
+            return super().commit_offset(queue_name, group, offset)
+
+    def retain(self):
+        with _LOCK:
+            return super().retain()
+
+    def flush(self):
+        with _LOCK:
+            return super().flush()
+
+    def get_stat(self):
+        with _LOCK:
+            return super().get_stat()
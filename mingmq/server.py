@@ -1,23 +1,56 @@
 """ 服务器 """
 
 import logging
+import os
 import platform
+import shutil
+import tempfile
+import time
 import traceback
 import socket
-from multiprocessing import Queue
+from collections import deque
 
 if platform.platform().startswith('Linux'):
     import select
-    from mingmq.memory import QueueMemory, TaskAckMemory
+    from mingmq.memory import QueueMemory, TaskAckMemory, DedupMemory
+    from mingmq.exchange import ExchangeMemory
+    from mingmq.segment import StreamMemory
+    from mingmq.bloom import UniqueMemory
 else:
     from threading import Thread
     from mingmq.memory import SyncQueueMemory as QueueMemory
     from mingmq.memory import SyncTaskAckMemory as TaskAckMemory
+    from mingmq.memory import SyncDedupMemory as DedupMemory
+    from mingmq.exchange import SyncExchangeMemory as ExchangeMemory
+    from mingmq.segment import SyncStreamMemory as StreamMemory
+    from mingmq.bloom import SyncUniqueMemory as UniqueMemory
 
 from mingmq.memory import StatMemory
 
-from mingmq.handler import Handler
+from mingmq.channel import BatchChannel
+from mingmq.handler import Handler, Broker, LARGE_FRAME_BYTES
+from mingmq.message import Task, PipeAckProcessAckMessage, PipeCompletelyPersistentProcessSendMessage
+from mingmq.snapshot import Checkpointer
 from mingmq.status import ServerStatus
+from mingmq.timer import TimingWheel
+from mingmq.waiter import GetWaiters
+
+# 一轮事件循环中最多处理的推迟请求的字节数
+_READY_BUDGET = 4 * 1024 * 1024
+# 一次可读事件中最多接受的新连接数
+_ACCEPT_BATCH = 1024
+
+
+def _set_keepalive(conn, seconds):
+    """开启tcp保活，连接空闲seconds秒后开始探测，连续3次没有响应内核就断开连接，
+    epoll会收到EPOLLERR和EPOLLHUP，不用等到下一次读写失败才发现客户端已经不在了。
+
+    """
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, seconds)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, seconds // 3))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
 
 
 class Server:
@@ -26,18 +59,69 @@ class Server:
     def __init__(
             self,
             server_status: ServerStatus,
-            completely_persistent_process_queue: Queue,
-            ack_process_queue: Queue
+            completely_persistent_process_queue: BatchChannel,
+            ack_process_queue: BatchChannel
     ):
         self._server_status = server_status
 
-        self._queue_memory = QueueMemory()
+        self._queue_memory = QueueMemory(self._init_lazy_dir())
         self._stat_memory = StatMemory()
         self._queue_ack_memory = TaskAckMemory()
+        self._exchange_memory = ExchangeMemory()
+        self._unique_memory = UniqueMemory()
+        self._dedup_memory = DedupMemory(server_status.get_dedup_window_size(),
+                                         server_status.get_dedup_window_seconds())
+        self._init_stream_memory()
 
         self._completely_persistent_process_queue = completely_persistent_process_queue
         self._ack_process_queue = ack_process_queue
 
+        self._checkpointer = None
+        self._journal = None
+        self._init_checkpointer()
+
+        # 所有连接共享的状态
+        self._broker = Broker(self._queue_memory, self._queue_ack_memory, self._stat_memory, server_status,
+                              completely_persistent_process_queue, ack_process_queue, self._journal,
+                              self._exchange_memory, self._stream_memory, self._dedup_memory, self._unique_memory)
+
+    def _init_lazy_dir(self):
+        # 惰性队列的段文件只是内存的延伸，上一次留下的直接删除，恢复时会重新写入；
+        # 没有快照目录时放在临时目录中按端口区分的固定位置，崩溃之后重启也会清理
+        snapshot_dir = self._server_status.get_snapshot_dir()
+        if snapshot_dir:
+            lazy_dir = os.path.join(snapshot_dir, 'lazy')
+        elif self._server_status.get_port():
+            lazy_dir = os.path.join(tempfile.gettempdir(), 'mingmq_lazy_%d' % self._server_status.get_port())
+        else:
+            return None
+        shutil.rmtree(lazy_dir, ignore_errors=True)
+        return lazy_dir
+
+    def _init_stream_memory(self):
+        # 流队列的段文件放在快照目录的streams子目录中，没有快照目录时只保存在内存中
+        snapshot_dir = self._server_status.get_snapshot_dir()
+        self._stream_memory = StreamMemory(os.path.join(snapshot_dir, 'streams') if snapshot_dir else None)
+        for queue_name in self._stream_memory.restore():
+            self._stat_memory.declare_queue(queue_name)
+
+    def _init_checkpointer(self):
+        snapshot_dir = self._server_status.get_snapshot_dir()
+        if not snapshot_dir:
+            return
+
+        if not platform.platform().startswith('Linux'):
+            self._logger.error('快照需要fork，只支持linux，已忽略快照目录: %s', snapshot_dir)
+            return
+
+        self._checkpointer = Checkpointer(snapshot_dir, self._server_status.get_snapshot_interval())
+        self._checkpointer.restore(self._queue_memory, self._queue_ack_memory, self._exchange_memory,
+                                   self._unique_memory)
+        self._journal = self._checkpointer.get_journal()
+
+        for queue_name in self._queue_memory.get_self():
+            self._stat_memory.declare_queue(queue_name)
+
     def get_memory(self):
         return self._queue_memory, self._queue_ack_memory
 
@@ -47,16 +131,42 @@ class Server:
         self._sock.bind((self._server_status.get_host(), self._server_status.get_port()))
         self._sock.listen(self._server_status.get_max_conn())
 
+        # 同一台机器上的客户端可以通过unix domain socket连接，不经过TCP协议栈
+        self._unix_sock = None
+        unix_socket = self._server_status.get_unix_socket()
+        if unix_socket:
+            if hasattr(socket, 'AF_UNIX'):
+                if os.path.exists(unix_socket):
+                    os.remove(unix_socket)
+                self._unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._unix_sock.bind(unix_socket)
+                self._unix_sock.listen(self._server_status.get_max_conn())
+            else:
+                self._logger.error('当前平台不支持unix domain socket，已忽略: %s', unix_socket)
+
+        # 监听socket的文件描述符对应socket
+        self._listeners = {self._sock.fileno(): self._sock}
+        if self._unix_sock:
+            self._listeners[self._unix_sock.fileno()] = self._unix_sock
+
         plat = platform.platform()
 
         if plat.startswith('Linux'):
-            self._sock.setblocking(False)
             self._timeout = self._server_status.get_timeout()
             self._epoll = select.epoll()
-            self._epoll.register(self._sock.fileno(), select.EPOLLIN)
             self._fd_to_handler = dict()  # 文件描述符对应socket
+            self._paused = set()  # 内存超过高水位时暂停读取的文件描述符
+            self._ready = deque()  # 已经读完、推迟处理的大请求，(fd, handler)
+            self._now = time.monotonic()  # 这一轮事件循环的时间
+            # 空闲超时的时间轮，key为文件描述符
+            self._wheel = TimingWheel(now=self._now) if self._server_status.get_idle_timeout() else None
+            # 长轮询的GET请求在事件循环中等待
+            self._waiters = self._broker.waiters = GetWaiters()
 
-            self._fd_to_handler[self._fileno()] = self
+            for fd, sock in self._listeners.items():
+                sock.setblocking(False)
+                self._epoll.register(fd, select.EPOLLIN)
+                self._fd_to_handler[fd] = self
 
     def serv_forever(self):
         if platform.platform().startswith('Linux'):
@@ -68,25 +178,200 @@ class Server:
         return self._sock.fileno()
 
     def _thread_mode(self):
+        self._thread_handlers = set()
+        Thread(target=self._redeliver_forever, name='redeliver_thread', daemon=True).start()
+        if self._unix_sock:
+            Thread(target=self._accept_forever, args=(self._unix_sock,), name='unix_accept_thread', daemon=True).start()
+
+        self._accept_forever(self._sock)
+
+    def _accept_forever(self, sock):
         while True:
-            client_sock, addr = self._sock.accept()
+            client_sock, addr = sock.accept()
+            try:
+                self._init_conn(sock, client_sock)
+                if self._server_status.get_idle_timeout():
+                    # 线程模式下用阻塞读的超时实现空闲超时，超时后读失败，连接断开
+                    client_sock.settimeout(self._server_status.get_idle_timeout())
+                handler = Handler(client_sock, addr, self._broker)
+                Thread(target=self._serve_thread, args=(handler,)).start()
+            except:
+                self._logger.error(traceback.format_exc())
+
+    def _serve_thread(self, handler):
+        self._thread_handlers.add(handler)
+        self._server_status.set_connections(len(self._thread_handlers))
+        try:
+            handler.handle_thread_mode_read()
+        finally:
             try:
-                handler = Handler(client_sock, addr, self._queue_memory,
-                                  self._queue_ack_memory, self._stat_memory,
-                                  self._server_status, self._completely_persistent_process_queue,
-                                  self._ack_process_queue)
-                Thread(target=handler.handle_thread_mode_read).start()
+                handler.requeue_unacked()
             except:
                 self._logger.error(traceback.format_exc())
+            self._thread_handlers.discard(handler)
+            self._server_status.set_connections(len(self._thread_handlers))
+            handler.close()
 
     def _epoll_mode(self):
         while True:
             self._logger.info("等待活动连接，还有%d个连接。", len(self._fd_to_handler))
-            events = self._epoll.poll(self._timeout)
-            if not events:
+            # 还有推迟处理的请求时不等待
+            events = self._epoll.poll(0 if self._ready else self._poll_timeout())
+            self._now = time.monotonic()
+            if events:
+                self._loop_events(events)
+            elif not self._ready:
                 self._logger.info("epoll超时无活动连接，重新轮询")
+            self._run_ready()
+            self._serve_waiters()
+            self._expire_idle()
+
+            self._redeliver_expired()
+            self._flush_channels()
+            self._flush_streams()
+            self._flow_control()
+
+            if self._checkpointer:
+                try:
+                    self._checkpointer.tick(self._queue_memory, self._queue_ack_memory, self._exchange_memory,
+                                            self._unique_memory)
+                except:
+                    self._logger.error(traceback.format_exc())
+
+    def _poll_timeout(self):
+        # 有长轮询的请求时最多等到下一个超时或者令牌桶补充令牌的时间，有连接时最多等到
+        # 时间轮中下一个连接的空闲超时
+        times = [self._waiters.next_time(), self._wheel.next_time() if self._wheel is not None else None]
+        times = [t for t in times if t is not None]
+        if not times:
+            return self._timeout
+        next_time = min(times)
+        wait = max(0.0, next_time - time.monotonic())
+        return wait if self._timeout < 0 else min(self._timeout, wait)
+
+    def _serve_waiters(self):
+        """把队列中的新任务投递给等待中的长轮询请求，响应超时的请求
+
+        """
+        try:
+            served = self._waiters.run(self._now, self._queue_memory)
+        except:
+            self._logger.error(traceback.format_exc())
+            return
+
+        for handler in served:
+            fd = handler.fileno()
+            if self._fd_to_handler.get(fd) is not handler:
+                continue
+            if handler.is_connected() is False:
+                self._close_event(fd)
             else:
-                self._loop_events(events)
+                self._resume_waiter(handler, fd)
+
+    def _park_waiter(self, fd):
+        """长轮询的请求挂起期间不读取这个连接后面的请求，否则响应的顺序会乱；
+        只监听EPOLLRDHUP，客户端断开时仍然能收到事件
+
+        """
+        try:
+            self._epoll.modify(fd, select.EPOLLRDHUP)
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _resume_waiter(self, handler, fd):
+        # 长轮询的请求已经响应，继续读取后面的请求
+        handler.last_active = self._now
+        try:
+            self._epoll.modify(fd, select.EPOLLIN)
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _redeliver_forever(self):
+        # 线程模式下没有事件循环，由这个线程定时重发
+        while True:
+            time.sleep(1)
+            self._redeliver_expired()
+            self._flush_channels()
+            self._flush_streams()
+            self._flow_control()
+
+    def _flow_control(self):
+        """队列和未确认任务的字节数超过高水位后，发送命令返回RETRY，epoll模式下还会暂停读取
+        只发送任务的连接；降到低水位以下后恢复。消费者的连接一直正常处理，内存才能降下来。
+
+        """
+        high_watermark = self._server_status.get_memory_high_watermark()
+        if not high_watermark:
+            return
+
+        try:
+            used = self._queue_memory.get_total_bytes() + self._queue_ack_memory.get_total_bytes()
+            if not self._server_status.is_memory_blocked():
+                if used >= high_watermark:
+                    self._server_status.set_memory_blocked(True)
+                    self._logger.warning('内存使用%d字节，超过高水位%d字节，暂停接收任务。', used, high_watermark)
+            elif used < self._server_status.get_memory_low_watermark():
+                self._server_status.set_memory_blocked(False)
+                self._logger.warning('内存使用%d字节，低于低水位%d字节，恢复接收任务。',
+                                     used, self._server_status.get_memory_low_watermark())
+                self._resume_paused()
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _resume_paused(self):
+        paused = getattr(self, '_paused', None)
+        while paused:
+            fd = paused.pop()
+            try:
+                self._epoll.modify(fd, select.EPOLLIN)
+            except:
+                self._logger.error(traceback.format_exc())
+        self._server_status.set_paused_connections(0)
+
+    def _flush_streams(self):
+        """删除流队列中超过保留大小或者时间的段，并把这一轮追加的数据写到文件中
+
+        """
+        try:
+            self._stream_memory.retain()
+            self._stream_memory.flush()
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _redeliver_expired(self):
+        """将超过RESEND_INTERVAL还没有确认的任务重新推送到队列尾部，旧的
+        message_id作废，持久化消息和这一轮的其它消息一起发送。
+
+        """
+        try:
+            before = time.time() - self._server_status.get_resend_interval()
+            for queue_name, message_id, message_data in self._queue_ack_memory.pop_expired(before):
+                self._stat_memory.set('expire_' + queue_name, 1)
+                if self._journal: self._journal.ack(queue_name, message_id)
+                self._ack_process_queue.put_nowait(PipeAckProcessAckMessage(message_id, queue_name))
+
+                if message_data is None:
+                    self._logger.error('未确认的任务没有数据，无法重发: %s, %s', queue_name, message_id)
+                    continue
+
+                task = Task(message_data)
+                if self._queue_memory.put(queue_name, task):
+                    if self._journal: self._journal.put(queue_name, task)
+                    self._stat_memory.set('redeliver_' + queue_name, 1)
+                    self._broker.notify(queue_name)
+                    self._completely_persistent_process_queue.put_nowait(
+                        PipeCompletelyPersistentProcessSendMessage(queue_name, message_data, task['message_id']))
+                    self._logger.debug('重发未确认的任务: %s, %s -> %s', queue_name, message_id, task['message_id'])
+        except:
+            self._logger.error(traceback.format_exc())
+
+    def _flush_channels(self):
+        # 这一轮事件循环产生的持久化消息一次性发送给持久化进程
+        try:
+            self._completely_persistent_process_queue.flush()
+            self._ack_process_queue.flush()
+        except:
+            self._logger.error(traceback.format_exc())
 
     def _loop_events(self, events):
         self._logger.info("有 %d个新事件，开始处理", len(events))
@@ -95,9 +380,9 @@ class Server:
 
             # 如果活动socket为当前服务器socket，表示有新连接
             if handler == self:
-                self._new_conn_comming()
-            # 关闭事件
-            elif event & select.EPOLLHUP:
+                self._new_conn_comming(self._listeners[fd])
+            # 关闭事件，挂起的长轮询请求只监听EPOLLRDHUP
+            elif event & (select.EPOLLHUP | select.EPOLLRDHUP):
                 self._close_event(fd)
             # 可读事件
             elif event & select.EPOLLIN:
@@ -109,26 +394,92 @@ class Server:
             elif event & select.EPOLLERR:
                 self._close_event(fd)
 
-    def _new_conn_comming(self):
-        try:
-            conn, addr = self._sock.accept()
-            self._logger.info("新连接：%s", addr)
-            conn.setblocking(False)  # 新连接socket设置为非阻塞
-            self._epoll.register(conn.fileno(), select.EPOLLIN)  # 注册新连接fd到待读事件集合
-            self._fd_to_handler[conn.fileno()] = Handler(conn, addr, self._queue_memory,
-                                                         self._queue_ack_memory, self._stat_memory,
-                                                         self._server_status, self._completely_persistent_process_queue,
-                                                         self._ack_process_queue)
-        except:  # 因为不知道会出现什么不可预知的问题。
-            self._logger.error(traceback.format_exc())
+    def _run_ready(self):
+        """处理推迟的大请求，每一轮最多处理_READY_BUDGET字节，至少处理一个，剩下的
+        留到下一轮，这样大请求不会让其它连接的小请求等太久。
+
+        """
+        budget = _READY_BUDGET
+        while self._ready and budget > 0:
+            fd, handler = self._ready.popleft()
+            if self._fd_to_handler.get(fd) is not handler:
+                continue  # 等待期间连接已经关闭了
+            budget -= handler.get_frame_size()
+            self._writeable_event(handler, fd)
+
+    def _expire_idle(self):
+        """断开空闲超过IDLE_TIMEOUT的连接。收到数据时只更新handler.last_active，
+        时间轮到期时再检查，还没有空闲够的重新放回时间轮。
+
+        """
+        if self._wheel is None:
+            return
+
+        idle_timeout = self._server_status.get_idle_timeout()
+        for fd in self._wheel.advance(self._now):
+            handler = self._fd_to_handler.get(fd)
+            if handler is None:
+                continue
+            deadline = handler.last_active + idle_timeout
+            if deadline > self._now:
+                self._wheel.add(fd, deadline)
+            elif fd in self._paused or handler.is_ok() or handler in self._waiters:
+                # 服务器暂停读取、推迟处理或者在长轮询中等待的连接不算空闲
+                self._wheel.add(fd, self._now + idle_timeout)
+            else:
+                self._logger.info('连接空闲超过%d秒，断开：%s', idle_timeout, fd)
+                self._close_event(fd)
+
+    def _init_conn(self, listener, conn):
+        if listener is self._sock and self._server_status.get_tcp_keepalive():
+            _set_keepalive(conn, self._server_status.get_tcp_keepalive())
+
+    def _new_conn_comming(self, sock):
+        # 一次唤醒接受所有等待中的连接，大量客户端同时重连时不用每个连接都走一轮事件循环
+        for _ in range(_ACCEPT_BATCH):
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                break
+            except:  # 文件描述符用完等，下一轮再试
+                self._logger.error(traceback.format_exc())
+                break
+
+            try:
+                self._logger.info("新连接：%s", addr)
+                conn.setblocking(False)  # 新连接socket设置为非阻塞
+                self._init_conn(sock, conn)
+                fd = conn.fileno()
+                handler = Handler(conn, addr, self._broker)
+                handler.last_active = self._now
+                self._epoll.register(fd, select.EPOLLIN)  # 注册新连接fd到待读事件集合
+                self._fd_to_handler[fd] = handler
+                if self._wheel is not None:
+                    self._wheel.add(fd, self._now + self._server_status.get_idle_timeout())
+            except:  # 因为不知道会出现什么不可预知的问题。
+                self._logger.error(traceback.format_exc())
+                conn.close()
+
+        self._server_status.set_connections(len(self._fd_to_handler) - len(self._listeners))
 
     def _close_event(self, fd):
         self._logger.info('client close, 还有%d个连接未释放。', len(self._fd_to_handler))
+        if fd in self._paused:
+            self._paused.discard(fd)
+            self._server_status.set_paused_connections(len(self._paused))
+        if self._wheel is not None:
+            self._wheel.remove(fd)
         try:
             self._epoll.unregister(fd)  # 在self._epoll中注销客户端的文件句柄
         except:
             self._logger.error(traceback.format_exc())
 
+        self._waiters.discard(self._fd_to_handler.get(fd))
+        try:
+            self._fd_to_handler[fd].requeue_unacked()  # 未确认的任务立即放回队列
+        except:
+            self._logger.error(traceback.format_exc())
+
         try:
             self._fd_to_handler[fd].close()  # 关闭客户端的文件句柄
         except:
@@ -139,7 +490,21 @@ class Server:
         except:
             self._logger.error(traceback.format_exc())
 
+        self._server_status.set_connections(len(self._fd_to_handler) - len(self._listeners))
+
     def _readable_event(self, handler: Handler, fd):
+        if self._server_status.is_memory_blocked() and handler.is_publish_only():
+            # 不读取，数据留在内核的接收缓冲区里，TCP的窗口会让发送方慢下来；
+            # 注册的事件为0时仍然会收到EPOLLHUP和EPOLLERR
+            try:
+                self._epoll.modify(fd, 0)
+                self._paused.add(fd)
+                self._server_status.set_paused_connections(len(self._paused))
+            except:
+                self._logger.error(traceback.format_exc())
+            return
+
+        handler.last_active = self._now
         try:
             handler.handle_epoll_mode_read()
         except:
@@ -150,12 +515,20 @@ class Server:
         try:
             if handler.is_connected() is False:
                 self._close_event(fd)
-            else:
-                self._epoll.modify(fd, select.EPOLLOUT)  # 修改句柄为可写事件
+            elif handler.is_ok():
+                if handler.get_frame_size() >= LARGE_FRAME_BYTES:
+                    # 大请求的解码和处理都慢，先不监听这个连接，等这一轮的小请求处理完再处理
+                    self._epoll.modify(fd, 0)
+                    self._ready.append((fd, handler))
+                else:
+                    # 小请求立即处理，不用等下一轮的可写事件，中间不会插进来一个大请求
+                    self._handle_request(handler, fd)
+            # 请求还没有读完时继续监听可读事件，水平触发下剩下的数据下一轮再读
         except:
             self._logger.error(traceback.format_exc())
 
-    def _writeable_event(self, handler: Handler, fd):
+    def _handle_request(self, handler: Handler, fd):
+        # 处理一个已经读完的请求并发送响应
         try:
             handler.handle_epoll_mode_write()
         except:
@@ -165,15 +538,30 @@ class Server:
 
         if handler.is_connected() is False:
             self._close_event(fd)
-        else:
+        elif handler in self._waiters:
+            self._park_waiter(fd)
+
+    def _writeable_event(self, handler: Handler, fd):
+        self._handle_request(handler, fd)
+        if self._fd_to_handler.get(fd) is handler and handler not in self._waiters:
             self._epoll.modify(fd, select.EPOLLIN)  # 修改文件句柄为读事件
 
     def close(self):
         try:
             if platform.platform().startswith('Linux'):
-                self._epoll.unregister(self._sock.fileno())  # 在epoll中注销服务器文件句柄
+                for fd in self._listeners:
+                    self._epoll.unregister(fd)  # 在epoll中注销服务器文件句柄
                 self._epoll.close()  # 关闭epoll
 
             self._sock.close()  # 关闭服务器socket
+
+            if self._unix_sock:
+                self._unix_sock.close()
+                os.remove(self._server_status.get_unix_socket())
+
+            if self._checkpointer:
+                self._checkpointer.close()
+
+            self._stream_memory.close()
         except:
             self._logger.error(traceback.format_exc())
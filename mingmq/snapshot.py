@@ -0,0 +1,441 @@
+"""内存快照和日志(journal)，用于服务器重启时快速恢复内存。
+
+从sqlite一行一行的恢复队列非常慢，所以服务器会定期把QueueMemory和
+TaskAckMemory的状态写成一个紧凑的二进制快照，两次快照之间的所有修改都追加
+到日志文件中。重启时只需要用mmap读取最新的快照，再重放快照之后的日志即可。
+
+快照是在fork出来的子进程中写的，利用了写时复制，所以不会阻塞epoll事件循环。
+
+目录结构::
+
+    snapshot_dir/
+        snapshot.<seq>   # 第seq个日志开始时的内存状态
+        journal.<seq>    # 快照seq之后的修改
+
+快照和日志使用的都是mingmq.codec的记录编码，快照文件以MAGIC开头，以OP_END
+结尾，没有OP_END的快照说明没有写完，不会被使用。
+"""
+
+import logging
+import mmap
+import os
+import time
+import traceback
+
+from mingmq.codec import encode_record, iter_records
+from mingmq.lazy import LazyQueue
+from mingmq.message import Task
+
+MAGIC = b'MMSNAP1\n'
+
+# 日志和快照共用的操作码
+OP_DECLARE = 0  # (queue_name,)
+OP_DELETE = 1  # (queue_name,)
+OP_CLEAR = 2  # (queue_name,)
+OP_PUT = 3  # (queue_name, message_id, message_data)
+OP_GET = 4  # (queue_name, message_id, delivered_at)
+OP_ACK = 5  # (queue_name, message_id)
+OP_INFLIGHT = 6  # (queue_name, message_id, message_data, delivered_at)
+OP_DECLARE_EXCHANGE = 7  # (exchange_name, exchange_type)
+OP_DELETE_EXCHANGE = 8  # (exchange_name,)
+OP_BIND = 9  # (exchange_name, queue_name, routing_key)
+OP_UNBIND = 10  # (exchange_name, queue_name, routing_key)
+OP_DECLARE_UNIQUE = 11  # (queue_name, initial_capacity, error_rate)
+OP_UNIQUE_ADD = 12  # (queue_name, unique_key)，只出现在日志中
+OP_UNIQUE_FILTER = 13  # (queue_name, capacity, error_rate, count, bits)，只出现在快照中
+OP_DECLARE_LAZY = 14  # (queue_name, head_bytes)
+OP_REQUEUE = 15  # (queue_name, message_id, message_data)，放回队列头部，只出现在日志中
+OP_DELIVERY_RATE = 16  # (queue_name, rate, burst)
+OP_END = 255  # (记录数,)
+
+_SNAPSHOT_PREFIX = 'snapshot.'
+_JOURNAL_PREFIX = 'journal.'
+
+
+def _list_seqs(snapshot_dir, prefix):
+    seqs = []
+    for name in os.listdir(snapshot_dir):
+        if name.startswith(prefix):
+            try:
+                seqs.append(int(name[len(prefix):]))
+            except ValueError:
+                pass
+    return sorted(seqs)
+
+
+def has_checkpoint(snapshot_dir):
+    """判断目录中是否有可以用来恢复的快照或者日志；
+
+    :param snapshot_dir: 快照目录；
+    :type snapshot_dir: str
+    :rtype: bool
+
+    """
+    if not snapshot_dir or not os.path.isdir(snapshot_dir):
+        return False
+    return bool(_list_seqs(snapshot_dir, _SNAPSHOT_PREFIX) or _list_seqs(snapshot_dir, _JOURNAL_PREFIX))
+
+
+def apply_record(op, fields, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+    """将一条日志记录应用到内存中，没有exchange_memory、unique_memory时忽略交换机、
+    唯一键的记录；
+
+    """
+    if op == OP_DECLARE:
+        queue_name, = fields
+        queue_memory.decleare(queue_name)
+        task_ack_memory.declare(queue_name)
+    elif op == OP_DECLARE_LAZY:
+        queue_name, head_bytes = fields
+        queue_memory.declare_lazy(queue_name, head_bytes)
+        task_ack_memory.declare(queue_name)
+    elif op == OP_DELIVERY_RATE:
+        queue_name, rate, burst = fields
+        queue_memory.set_delivery_rate(queue_name, rate, burst)
+    elif op == OP_DELETE:
+        queue_name, = fields
+        queue_memory.delete(queue_name)
+        task_ack_memory.delete(queue_name)
+        if exchange_memory is not None: exchange_memory.remove_queue(queue_name)
+        if unique_memory is not None: unique_memory.delete(queue_name)
+    elif op == OP_CLEAR:
+        queue_name, = fields
+        queue_memory.clear(queue_name)
+        task_ack_memory.clear(queue_name)
+    elif op == OP_PUT:
+        queue_name, message_id, message_data = fields
+        queue_memory.put(queue_name, Task(message_data, message_id))
+    elif op == OP_REQUEUE:
+        queue_name, message_id, message_data = fields
+        queue_memory.put_front(queue_name, Task(message_data, message_id))
+    elif op == OP_GET:
+        queue_name, message_id, delivered_at = fields
+        task = queue_memory.get(queue_name)
+        task_ack_memory.put(queue_name, message_id, task['message_data'] if task else None, delivered_at)
+    elif op == OP_ACK:
+        queue_name, message_id = fields
+        task_ack_memory.get(queue_name, message_id)
+    elif op == OP_INFLIGHT:
+        queue_name, message_id, message_data, delivered_at = fields
+        task_ack_memory.put(queue_name, message_id, message_data, delivered_at)
+    elif op in (OP_DECLARE_EXCHANGE, OP_DELETE_EXCHANGE, OP_BIND, OP_UNBIND):
+        if exchange_memory is None:
+            return
+        if op == OP_DECLARE_EXCHANGE:
+            exchange_memory.declare(*fields)
+        elif op == OP_DELETE_EXCHANGE:
+            exchange_memory.delete(*fields)
+        elif op == OP_BIND:
+            exchange_memory.bind(*fields)
+        else:
+            exchange_memory.unbind(*fields)
+    elif op in (OP_DECLARE_UNIQUE, OP_UNIQUE_ADD, OP_UNIQUE_FILTER):
+        if unique_memory is None:
+            return
+        if op == OP_DECLARE_UNIQUE:
+            unique_memory.declare(*fields)
+        elif op == OP_UNIQUE_ADD:
+            unique_memory.add(*fields)
+        else:
+            queue_name, capacity, error_rate, count, bits = fields
+            unique_memory.get_self()[queue_name].load_filter(capacity, error_rate, count, bits)
+    else:
+        raise ValueError('错误的日志操作码: %d' % op)
+
+
+class Journal:
+    """日志文件，记录两次快照之间对内存的所有修改。
+
+    写入是带缓冲的，由服务器在每一轮事件循环结束时调用flush()。
+    """
+    _logger = logging.getLogger('Journal')
+
+    def __init__(self, snapshot_dir, seq):
+        self._snapshot_dir = snapshot_dir
+        self._seq = seq
+        self._file = open(self._path(seq), 'ab')
+
+    def _path(self, seq):
+        return os.path.join(self._snapshot_dir, _JOURNAL_PREFIX + str(seq))
+
+    def get_seq(self):
+        return self._seq
+
+    def rotate(self):
+        """关闭当前的日志文件，打开下一个序号的日志文件；
+
+        :return: 新日志的序号；
+        :rtype: int
+
+        """
+        self._file.flush()
+        self._file.close()
+        self._seq += 1
+        self._file = open(self._path(self._seq), 'ab')
+        return self._seq
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.flush()
+        self._file.close()
+
+    def declare(self, queue_name):
+        self._file.write(encode_record(OP_DECLARE, queue_name))
+
+    def declare_lazy(self, queue_name, head_bytes):
+        self._file.write(encode_record(OP_DECLARE_LAZY, queue_name, head_bytes))
+
+    def set_delivery_rate(self, queue_name, rate, burst):
+        self._file.write(encode_record(OP_DELIVERY_RATE, queue_name, rate, burst))
+
+    def delete(self, queue_name):
+        self._file.write(encode_record(OP_DELETE, queue_name))
+
+    def clear(self, queue_name):
+        self._file.write(encode_record(OP_CLEAR, queue_name))
+
+    def put(self, queue_name, task):
+        self._file.write(encode_record(OP_PUT, queue_name, task['message_id'], task['message_data']))
+
+    def requeue(self, queue_name, task):
+        self._file.write(encode_record(OP_REQUEUE, queue_name, task['message_id'], task['message_data']))
+
+    def get(self, queue_name, message_id, delivered_at):
+        self._file.write(encode_record(OP_GET, queue_name, message_id, delivered_at))
+
+    def ack(self, queue_name, message_id):
+        self._file.write(encode_record(OP_ACK, queue_name, message_id))
+
+    def inflight(self, queue_name, message_id, message_data, delivered_at):
+        self._file.write(encode_record(OP_INFLIGHT, queue_name, message_id, message_data, delivered_at))
+
+    def declare_exchange(self, exchange_name, exchange_type):
+        self._file.write(encode_record(OP_DECLARE_EXCHANGE, exchange_name, exchange_type))
+
+    def delete_exchange(self, exchange_name):
+        self._file.write(encode_record(OP_DELETE_EXCHANGE, exchange_name))
+
+    def bind(self, exchange_name, queue_name, routing_key):
+        self._file.write(encode_record(OP_BIND, exchange_name, queue_name, routing_key))
+
+    def unbind(self, exchange_name, queue_name, routing_key):
+        self._file.write(encode_record(OP_UNBIND, exchange_name, queue_name, routing_key))
+
+    def declare_unique(self, queue_name, initial_capacity, error_rate):
+        self._file.write(encode_record(OP_DECLARE_UNIQUE, queue_name, initial_capacity, error_rate))
+
+    def unique_add(self, queue_name, unique_key):
+        self._file.write(encode_record(OP_UNIQUE_ADD, queue_name, unique_key))
+
+
+class Checkpointer:
+    """负责恢复内存、定期写快照，以及清理旧的快照和日志。
+    """
+    _logger = logging.getLogger('Checkpointer')
+
+    def __init__(self, snapshot_dir, interval):
+        """初始化；
+
+        :param snapshot_dir: 快照目录；
+        :type snapshot_dir: str
+        :param interval: 两次快照之间的间隔，单位秒；
+        :type interval: int
+
+        """
+        self._snapshot_dir = snapshot_dir
+        self._interval = interval
+        self._journal = None
+        self._child_pid = None
+        self._child_seq = None
+        self._last_time = time.time()
+
+        os.makedirs(self._snapshot_dir, exist_ok=True)
+
+    def get_journal(self):
+        return self._journal
+
+    def restore(self, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        """从最新的完整快照和之后的日志中恢复内存，然后打开一个新的日志；
+
+        :return: 恢复的记录数；
+        :rtype: int
+
+        """
+        start = time.time()
+        n = 0
+
+        snapshot_seq = None
+        for seq in reversed(_list_seqs(self._snapshot_dir, _SNAPSHOT_PREFIX)):
+            try:
+                n = self._load_snapshot(seq, queue_memory, task_ack_memory, exchange_memory, unique_memory)
+                snapshot_seq = seq
+                break
+            except Exception:
+                self._logger.error('快照%d不可用: %s', seq, traceback.format_exc())
+                queue_memory.get_self().clear()
+                task_ack_memory.get_self().clear()
+                task_ack_memory.pop_expired(float('inf'))  # 清空超时堆
+                if exchange_memory is not None: exchange_memory.get_self().clear()
+                if unique_memory is not None: unique_memory.get_self().clear()
+                n = 0
+
+        journal_seqs = _list_seqs(self._snapshot_dir, _JOURNAL_PREFIX)
+        for seq in journal_seqs:
+            if snapshot_seq is not None and seq < snapshot_seq:
+                continue
+            n += self._replay_journal(seq, queue_memory, task_ack_memory, exchange_memory, unique_memory)
+
+        last_seq = max(journal_seqs + [snapshot_seq or 0])
+        self._journal = Journal(self._snapshot_dir, last_seq + 1)
+
+        self._logger.info('从快照%s和%d个日志中恢复了%d条记录，耗时%.3f秒。', repr(snapshot_seq),
+                          len(journal_seqs), n, time.time() - start)
+        return n
+
+    def _map_file(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_snapshot(self, seq, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        buf = self._map_file(os.path.join(self._snapshot_dir, _SNAPSHOT_PREFIX + str(seq)))
+        try:
+            if buf[:len(MAGIC)] != MAGIC:
+                raise ValueError('快照文件头错误')
+
+            n = 0
+            for op, fields, _ in iter_records(buf, len(MAGIC)):
+                if op == OP_END:
+                    if fields[0] != n:
+                        raise ValueError('快照记录数不一致')
+                    return n
+                apply_record(op, fields, queue_memory, task_ack_memory, exchange_memory, unique_memory)
+                n += 1
+
+            raise ValueError('快照没有写完')
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+    def _replay_journal(self, seq, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        buf = self._map_file(os.path.join(self._snapshot_dir, _JOURNAL_PREFIX + str(seq)))
+        n = 0
+        try:
+            for op, fields, _ in iter_records(buf):
+                apply_record(op, fields, queue_memory, task_ack_memory, exchange_memory, unique_memory)
+                n += 1
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+        return n
+
+    def tick(self, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        """由事件循环在每一轮结束时调用，刷新日志，回收写快照的子进程，
+        到了时间就开始写新的快照；
+
+        """
+        self._journal.flush()
+        self._reap_child()
+
+        if self._child_pid is None and time.time() - self._last_time >= self._interval:
+            self.checkpoint(queue_memory, task_ack_memory, exchange_memory, unique_memory)
+
+    def checkpoint(self, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        """切换日志，然后fork一个子进程把当前的内存写成快照；
+
+        """
+        self._last_time = time.time()
+        seq = self._journal.rotate()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._write_snapshot(seq, queue_memory, task_ack_memory, exchange_memory, unique_memory)
+                code = 0
+            except BaseException:
+                self._logger.error(traceback.format_exc())
+            finally:
+                os._exit(code)
+
+        self._child_pid = pid
+        self._child_seq = seq
+        self._logger.debug('子进程%d正在写快照%d。', pid, seq)
+
+    def _write_snapshot(self, seq, queue_memory, task_ack_memory, exchange_memory=None, unique_memory=None):
+        path = os.path.join(self._snapshot_dir, _SNAPSHOT_PREFIX + str(seq))
+        tmp_path = path + '.tmp'
+        n = 0
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            for queue_name, queue in queue_memory.get_self().items():
+                if isinstance(queue, LazyQueue):
+                    f.write(encode_record(OP_DECLARE_LAZY, queue_name, queue.head_bytes))
+                else:
+                    f.write(encode_record(OP_DECLARE, queue_name))
+                n += 1
+                delivery_rate = queue_memory.get_delivery_rate(queue_name)
+                if delivery_rate is not None:
+                    f.write(encode_record(OP_DELIVERY_RATE, queue_name, *delivery_rate))
+                    n += 1
+                for task in queue.queue:
+                    f.write(encode_record(OP_PUT, queue_name, task['message_id'], task['message_data']))
+                    n += 1
+            for queue_name, inflight in task_ack_memory.get_self().items():
+                for message_id, (message_data, delivered_at) in inflight.items():
+                    f.write(encode_record(OP_INFLIGHT, queue_name, message_id, message_data, delivered_at))
+                    n += 1
+            if exchange_memory is not None:
+                for exchange_name, exchange in exchange_memory.get_self().items():
+                    f.write(encode_record(OP_DECLARE_EXCHANGE, exchange_name, exchange.get_type()))
+                    n += 1
+                    for queue_name, routing_key in exchange.get_bindings():
+                        f.write(encode_record(OP_BIND, exchange_name, queue_name, routing_key))
+                        n += 1
+            if unique_memory is not None:
+                for queue_name, bloom_filter in unique_memory.get_self().items():
+                    f.write(encode_record(OP_DECLARE_UNIQUE, queue_name,
+                                          bloom_filter.initial_capacity, bloom_filter.error_rate))
+                    n += 1
+                    for sub_filter in bloom_filter.filters:
+                        f.write(encode_record(OP_UNIQUE_FILTER, queue_name, sub_filter.capacity,
+                                              sub_filter.error_rate, sub_filter.count, bytes(sub_filter.bits)))
+                        n += 1
+            f.write(encode_record(OP_END, n))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _reap_child(self):
+        if self._child_pid is None:
+            return
+
+        pid, status = os.waitpid(self._child_pid, os.WNOHANG)
+        if pid == 0:
+            return
+
+        seq = self._child_seq
+        self._child_pid = None
+        self._child_seq = None
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            self._logger.info('快照%d写入完成。', seq)
+            self._remove_before(seq)
+        else:
+            self._logger.error('快照%d写入失败，状态码: %d', seq, status)
+
+    def _remove_before(self, seq):
+        for prefix in (_SNAPSHOT_PREFIX, _JOURNAL_PREFIX):
+            for old_seq in _list_seqs(self._snapshot_dir, prefix):
+                if old_seq < seq:
+                    try:
+                        os.remove(os.path.join(self._snapshot_dir, prefix + str(old_seq)))
+                    except OSError:
+                        self._logger.error(traceback.format_exc())
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
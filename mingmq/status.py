@@ -1,11 +1,30 @@
 class ServerStatus:
-    def __init__(self, host, port, max_conn, user_name, passwd, timeout):
+    def __init__(self, host, port, max_conn, user_name, passwd, timeout,
+                 snapshot_dir=None, snapshot_interval=60, resend_interval=300, unix_socket=None,
+                 dedup_window_size=10000, dedup_window_seconds=600,
+                 memory_high_watermark=0, memory_low_watermark=0, idle_timeout=0, tcp_keepalive=60):
         self._host = host
         self._port = port
         self._user_name = user_name
         self._passwd = passwd
         self._max_conn = max_conn
         self._timeout = timeout
+        self._snapshot_dir = snapshot_dir
+        self._snapshot_interval = snapshot_interval
+        self._resend_interval = resend_interval
+        self._unix_socket = unix_socket
+        self._dedup_window_size = dedup_window_size
+        self._dedup_window_seconds = dedup_window_seconds
+        # 内存高水位和低水位，单位字节，0表示不限制，低水位默认为高水位的80%
+        self._memory_high_watermark = memory_high_watermark
+        self._memory_low_watermark = memory_low_watermark or memory_high_watermark * 4 // 5
+        self._memory_blocked = False
+        # 空闲超过idle_timeout秒的连接由服务器断开，0表示不断开
+        self._idle_timeout = idle_timeout
+        # tcp连接空闲tcp_keepalive秒后由内核发送探测，发现已经断开的客户端，0表示不开启
+        self._tcp_keepalive = tcp_keepalive
+        self._paused_connections = 0
+        self._connections = 0
 
     def get_host(self):
         return self._host
@@ -24,3 +43,54 @@ class ServerStatus:
 
     def get_timeout(self):
         return self._timeout
+
+    def get_snapshot_dir(self):
+        return self._snapshot_dir
+
+    def get_snapshot_interval(self):
+        return self._snapshot_interval
+
+    def get_resend_interval(self):
+        return self._resend_interval
+
+    def set_resend_interval(self, resend_interval):
+        self._resend_interval = resend_interval
+
+    def get_unix_socket(self):
+        return self._unix_socket
+
+    def get_dedup_window_size(self):
+        return self._dedup_window_size
+
+    def get_dedup_window_seconds(self):
+        return self._dedup_window_seconds
+
+    def get_memory_high_watermark(self):
+        return self._memory_high_watermark
+
+    def get_memory_low_watermark(self):
+        return self._memory_low_watermark
+
+    def get_idle_timeout(self):
+        return self._idle_timeout
+
+    def get_tcp_keepalive(self):
+        return self._tcp_keepalive
+
+    def is_memory_blocked(self):
+        return self._memory_blocked
+
+    def set_memory_blocked(self, memory_blocked):
+        self._memory_blocked = memory_blocked
+
+    def get_paused_connections(self):
+        return self._paused_connections
+
+    def set_paused_connections(self, paused_connections):
+        self._paused_connections = paused_connections
+
+    def get_connections(self):
+        return self._connections
+
+    def set_connections(self, connections):
+        self._connections = connections
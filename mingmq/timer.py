@@ -0,0 +1,110 @@
+"""哈希时间轮(hashed timing wheel)，用于连接的空闲超时。
+
+十万个连接每个都用堆或者排序的结构记录超时时间，每次收到数据都要调整一次，
+代价是O(log n)。时间轮把时间按tick分成槽，添加和删除都是O(1)的，每个tick只检查
+到期的那一个槽，超过一圈的超时记录下到期的tick，转到时还没到期就跳过。
+
+连接收到数据时不需要移动它在时间轮中的位置，只要更新最后活动的时间，到期时再
+检查一次，还没有空闲够就重新放回时间轮，所以忙碌的连接几乎没有额外的开销。
+
+Command line example:
+
+>>> wheel = TimingWheel(tick=1, slots=8, now=0)
+>>> wheel.add('a', 3)
+>>> wheel.add('b', 20)
+>>> wheel.next_time()
+3
+>>> wheel.advance(5)
+['a']
+>>> wheel.advance(20)
+['b']
+
+"""
+
+
+class TimingWheel:
+    """时间轮，key是任意可哈希的对象，每个key只能在时间轮中出现一次
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=0.0):
+        """初始化；
+
+        :param tick: 每个槽的时间长度，单位秒；
+        :type tick: float
+        :param slots: 槽的个数；
+        :type slots: int
+        :param now: 当前时间；
+        :type now: float
+
+        """
+        self._tick = tick
+        self._slots = [set() for _ in range(slots)]
+        # key -> 到期的tick
+        self._deadlines = dict()
+        self._current = int(now // tick)
+        # 最近一个有到期key的tick，None表示需要重新计算
+        self._next = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def add(self, key, deadline):
+        """添加或者重新设置key的到期时间，最早在下一个tick到期
+        """
+        self.remove(key)
+        tick = max(int(deadline // self._tick), self._current + 1)
+        self._deadlines[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+        if self._next is not None and tick < self._next:
+            self._next = tick
+
+    def remove(self, key):
+        tick = self._deadlines.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].discard(key)
+            if tick == self._next:
+                self._next = None
+
+    def next_time(self):
+        """
+        :return: float，最近一个有key到期的tick的时间，None表示时间轮是空的
+        """
+        if not self._deadlines:
+            return None
+        if self._next is None:
+            n = len(self._slots)
+            for tick in range(self._current + 1, self._current + 1 + n):
+                if any(self._deadlines[key] == tick for key in self._slots[tick % n]):
+                    self._next = tick
+                    break
+            else:
+                # 一圈之内没有到期的key
+                self._next = min(self._deadlines.values())
+        return self._next * self._tick
+
+    def advance(self, now):
+        """转到now，返回所有已经到期的key，到期的key从时间轮中删除
+
+        :return: list
+        """
+        target = int(now // self._tick)
+        if target <= self._current:
+            return []
+
+        expired = []
+        n = len(self._slots)
+        # 超过一圈没有转动时每个槽只需要看一次
+        for tick in range(self._current + 1, self._current + 1 + min(target - self._current, n)):
+            slot = self._slots[tick % n]
+            if slot:
+                for key in [key for key in slot if self._deadlines[key] <= target]:
+                    slot.discard(key)
+                    del self._deadlines[key]
+                    expired.append(key)
+        self._current = target
+        if self._next is not None and self._next <= target:
+            self._next = None
+        return expired
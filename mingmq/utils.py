@@ -9,6 +9,7 @@ import os
 from io import StringIO
 import sys
 import inspect
+from urllib.parse import quote
 
 from mingmq.message import MESSAGE_TYPE
 
@@ -118,6 +119,21 @@ def check_config(flags):
     return 417
 
 
+def queue_dir(root, queue_name):
+    """
+    队列在root下的目录，队列名中的特殊字符都被转义，不会出现路径分隔符
+    :param root: str，根目录
+    :param queue_name: str，队列名
+    :return: str，队列名为空、为'.'或'..'，或者目录不在root下时返回None
+    """
+    if not isinstance(queue_name, str) or queue_name in ('', '.', '..'):
+        return None
+    path = os.path.join(root, quote(queue_name, safe=''))
+    if os.path.dirname(os.path.realpath(path)) != os.path.realpath(root):
+        return None
+    return path
+
+
 def get_size(obj, seen=None):
     """
     获取对象的内存占用大小，单位字节。
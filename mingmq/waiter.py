@@ -0,0 +1,155 @@
+"""长轮询(long-poll)的GET_DATA_FROM_QUEUE请求。
+
+带timeout的GET_DATA_FROM_QUEUE在队列为空或者被限速时不立即返回，连接挂在这里，
+有新任务放入队列、限速的令牌桶补充了令牌或者超时的时候再响应，消费者不需要在客户端
+sleep之后重试。协议是一问一答的，挂起期间服务器不读取这个连接后面的请求，响应之后
+再继续读取，所以每个连接同时只有一个等待的请求。
+
+epoll模式下所有的等待都在事件循环中处理：
+
+- 放入任务时调用notify把队列标记为就绪；
+- 被限速的队列按照令牌桶的等待时间登记一个定时器，到时再标记为就绪，每个队列最多
+  一个定时器，不会忙等；
+- 每一轮事件循环调用run，按先来后到把就绪队列的任务投递给等待的连接；
+- next_time是最近的定时器的时间，用来缩短epoll的等待时间。
+
+Command line example:
+
+>>> from mingmq.memory import QueueMemory
+>>> from mingmq.message import Task
+>>> class Conn:
+...     def deliver(self, queue_name, task): print('deliver', task['message_data'])
+...     def wait_timeout(self, queue_name): print('timeout')
+>>> queue_memory = QueueMemory()
+>>> queue_memory.decleare('q')
+True
+>>> waiters = GetWaiters()
+>>> waiters.add(Conn(), 'q', 10, now=0)
+>>> _ = queue_memory.put('q', Task('hello'))
+>>> waiters.notify('q')
+>>> _ = waiters.run(1, queue_memory)
+deliver hello
+
+"""
+
+import heapq
+from collections import deque
+
+
+class GetWaiters:
+    """等待任务的连接，连接需要实现deliver(queue_name, task)和wait_timeout(queue_name)
+    """
+
+    def __init__(self):
+        # queue_name -> deque([[conn, queue_name], ...])，conn为None表示已经取消
+        self._queues = dict()
+        # conn -> 等待的记录，每个连接同时只能等待一个请求
+        self._waiting = dict()
+        # (时间, 序号, queue_name, 等待的记录)，记录为None的是令牌桶的定时器
+        self._timers = []
+        self._seq = 0
+        # 有新任务或者令牌、需要在这一轮投递的队列
+        self._ready = set()
+        # 已经登记了令牌桶定时器的队列
+        self._throttled = set()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, conn):
+        return conn in self._waiting
+
+    def _push_timer(self, at, queue_name, entry):
+        self._seq += 1
+        heapq.heappush(self._timers, (at, self._seq, queue_name, entry))
+
+    def add(self, conn, queue_name, deadline, wait=0.0, now=0.0):
+        """登记一个等待的连接；
+
+        :param deadline: 超时的时间，time.monotonic()；
+        :type deadline: float
+        :param wait: 队列被限速时还需要等待的秒数；
+        :type wait: float
+
+        """
+        self.discard(conn)
+        entry = [conn, queue_name]
+        self._waiting[conn] = entry
+        self._queues.setdefault(queue_name, deque()).append(entry)
+        self._push_timer(deadline, queue_name, entry)
+        if wait:
+            self._throttle(queue_name, now + wait)
+
+    def discard(self, conn):
+        """取消连接的等待，连接关闭时调用
+        """
+        entry = self._waiting.pop(conn, None)
+        if entry is not None:
+            entry[0] = None
+
+    def notify(self, queue_name):
+        """队列中放入了任务
+        """
+        if queue_name in self._queues:
+            self._ready.add(queue_name)
+
+    def _throttle(self, queue_name, at):
+        if queue_name not in self._throttled:
+            self._throttled.add(queue_name)
+            self._push_timer(at, queue_name, None)
+
+    def next_time(self):
+        """
+        :return: float，最近一次需要调用run的时间，None表示没有等待的连接
+        """
+        if self._ready:
+            return 0.0
+        while self._timers and self._timers[0][3] is not None and self._timers[0][3][0] is None:
+            heapq.heappop(self._timers)  # 已经取消的等待
+        return self._timers[0][0] if self._timers else None
+
+    def run(self, now, queue_memory):
+        """处理到期的定时器，并把就绪队列中的任务投递给等待的连接；
+
+        :param queue_memory: QueueMemory，用get_limited取任务；
+        :return: list，这一轮响应过的连接
+
+        """
+        served = []
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            _, _, queue_name, entry = heapq.heappop(timers)
+            if entry is None:
+                self._throttled.discard(queue_name)
+                self.notify(queue_name)
+            elif entry[0] is not None:
+                conn = entry[0]
+                self.discard(conn)
+                conn.wait_timeout(queue_name)
+                served.append(conn)
+
+        ready, self._ready = self._ready, set()
+        for queue_name in ready:
+            waiting = self._queues.get(queue_name)
+            while waiting:
+                conn = waiting[0][0]
+                if conn is None:
+                    waiting.popleft()
+                    continue
+                task, wait = queue_memory.get_limited(queue_name, now)
+                if task is None:
+                    if wait:
+                        self._throttle(queue_name, now + wait)
+                    break
+                waiting.popleft()
+                self.discard(conn)
+                conn.deliver(queue_name, task)
+                served.append(conn)
+            if not waiting:
+                self._queues.pop(queue_name, None)
+
+        # 取消的等待留在各个队列里，等到队列下一次就绪或者很多时再清理
+        if len(self._queues) > 2 * len(self._waiting) + 64:
+            for queue_name in [k for k, v in self._queues.items() if all(e[0] is None for e in v)]:
+                del self._queues[queue_name]
+        return served
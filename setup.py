@@ -22,5 +22,6 @@ setup(
     [console_scripts]
     mmserver = mingmq.command:main
     mmweb = mingmq.api:main
+    mmbench = mingmq.bench:main
     """
 )
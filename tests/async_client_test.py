@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from unittest import TestCase
+
+from mingmq.async_client import AsyncClient, AsyncProducer, AsyncConsumer
+from mingmq.message import SUCCESS
+
+logging.basicConfig(level=logging.ERROR)
+
+from .settings import *
+
+
+async def pipeline(queue_name, n):
+    """
+    在同一个连接上流水线发送和获取
+    """
+    client = AsyncClient(IP, PORT)
+    await client.connect()
+    await client.login(USER, PASSWD)
+    await client.declare_queue(queue_name)
+    await client.clear_queue(queue_name)
+
+    results = await asyncio.gather(*[client.send_data_to_queue(queue_name, str(i)) for i in range(n)])
+    assert all(result['status'] == SUCCESS for result in results)
+
+    results = await asyncio.gather(*[client.get_data_from_queue(queue_name) for _ in range(n)])
+    message_datas = [result['json_obj'][0]['message_data'] for result in results]
+    message_ids = [result['json_obj'][0]['message_id'] for result in results]
+
+    result = await client.ack_messages(queue_name, message_ids)
+    await client.close()
+    return message_datas, result
+
+
+async def produce_consume(queue_name, n):
+    async with AsyncProducer(IP, PORT, USER, PASSWD, queue_name) as producer:
+        await producer.send_tasks(list(range(n)))
+
+    got = []
+    async with AsyncConsumer(IP, PORT, USER, PASSWD, queue_name, prefetch=20) as consumer:
+        async for message_data, message_id in consumer:
+            got.append(message_data)
+            consumer.ack(message_id)
+            if len(got) == n:
+                break
+    return got
+
+
+class AsyncClientTest(TestCase):
+    def test_pipeline(self):
+        message_datas, result = asyncio.run(pipeline('async_pipeline', 100))
+        self.assertEqual(message_datas, [str(i) for i in range(100)])
+        self.assertEqual(result['status'], SUCCESS)
+
+    def test_produce_consume(self):
+        got = asyncio.run(produce_consume('async_produce_consume', 100))
+        self.assertEqual(sorted(got, key=int), [str(i) for i in range(100)])
@@ -0,0 +1,43 @@
+import logging
+from unittest import TestCase
+
+from mingmq.client import BatchProducer, Client
+
+logging.basicConfig(level=logging.ERROR)
+
+from .settings import *
+
+
+class BatchProducerTest(TestCase):
+    def test_send_tasks(self):
+        queue_name = 'batch_producer'
+        producer = BatchProducer(IP, PORT, USER, PASSWD, queue_name, batch_size=100, linger_ms=5)
+        client = Client(IP, PORT)
+        client.login(USER, PASSWD)
+        client.clear_queue(queue_name)
+
+        futures = [producer.send_task(i) for i in range(1000)]
+        self.assertTrue(producer.flush(10))
+        message_ids = [future.result() for future in futures]
+        self.assertEqual(len(set(message_ids)), 1000)
+
+        for i in range(1000):
+            msg = client.get_data_from_queue(queue_name)
+            self.assertEqual(msg['json_obj'][0]['message_data'], str(i))
+            self.assertEqual(msg['json_obj'][0]['message_id'], message_ids[i])
+
+        producer.release()
+        client.close()
+
+    def test_linger(self):
+        producer = BatchProducer(IP, PORT, USER, PASSWD, 'batch_producer', batch_size=100, linger_ms=20)
+        future = producer.send_task('hello')
+        self.assertIsNotNone(future.result(5))
+        producer.release()
+
+    def test_buffer_budget(self):
+        producer = BatchProducer(IP, PORT, USER, PASSWD, 'batch_producer', batch_size=10, linger_ms=1,
+                                 max_buffer_bytes=100)
+        futures = [producer.send_task('x' * 40) for _ in range(100)]
+        producer.release()
+        self.assertTrue(all(future.done() for future in futures))
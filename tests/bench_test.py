@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from mingmq.bench import percentiles, handler_footprint
+
+
+class PercentilesTest(TestCase):
+    def test_percentiles(self):
+        result = percentiles([i / 1000 for i in range(1, 1001)])
+        self.assertEqual(result['p50'], 501)
+        self.assertEqual(result['p99'], 991)
+        self.assertEqual(result['max'], 1000)
+        self.assertEqual(result['mean'], 500.5)
+
+    def test_empty(self):
+        self.assertEqual(percentiles([]), {})
+
+
+class HandlerFootprintTest(TestCase):
+    def test_footprint(self):
+        # 空闲连接的开销应该在几百字节
+        self.assertLess(handler_footprint(50), 400)
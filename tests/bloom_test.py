@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+from mingmq.bloom import BloomFilter, ScalableBloomFilter, UniqueMemory
+
+
+class BloomFilterTest(TestCase):
+    def test_error_rate(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add('in-%d' % i)
+        self.assertTrue(all('in-%d' % i in bloom_filter for i in range(1000)))
+        false_positives = sum('out-%d' % i in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertTrue(bloom_filter.is_full())
+
+
+class ScalableBloomFilterTest(TestCase):
+    def test_grow(self):
+        bloom_filter = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        self.assertTrue(bloom_filter.add('a'))
+        self.assertFalse(bloom_filter.add('a'))
+
+        added = sum(bloom_filter.add('url-%d' % i) for i in range(5000))
+        # 误判的键不会被加入
+        self.assertGreater(added, 4900)
+        self.assertGreater(len(bloom_filter.filters), 1)
+        self.assertEqual(bloom_filter.get_count(), added + 1)
+        self.assertTrue(all('url-%d' % i in bloom_filter for i in range(5000)))
+        false_positives = sum('other-%d' % i in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_load_filter(self):
+        bloom_filter = ScalableBloomFilter(initial_capacity=10, error_rate=0.01)
+        for i in range(30):
+            bloom_filter.add(str(i))
+
+        restored = ScalableBloomFilter(initial_capacity=10, error_rate=0.01)
+        for f in bloom_filter.filters:
+            restored.load_filter(f.capacity, f.error_rate, f.count, bytes(f.bits))
+        self.assertFalse(any(restored.add(str(i)) for i in range(30)))
+        self.assertTrue(restored.add('30'))
+
+
+class UniqueMemoryTest(TestCase):
+    def test_add(self):
+        memory = UniqueMemory()
+        self.assertIsNone(memory.add('q', 'a'))
+        self.assertTrue(memory.declare('q', 100, 0.01))
+        self.assertFalse(memory.declare('q', 100, 0.01))
+        self.assertTrue(memory.add('q', 'a'))
+        self.assertFalse(memory.add('q', 'a'))
+        self.assertEqual(memory.get_stat()['q'][0], 1)
+        self.assertTrue(memory.delete('q'))
+        self.assertIsNone(memory.add('q', 'a'))
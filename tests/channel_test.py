@@ -0,0 +1,72 @@
+import time
+from unittest import TestCase
+
+from mingmq.channel import BatchChannel
+from mingmq.message import (ACK_PROCESS_MESSAGE_FIELDS, PipeAckProcessGetMessage,
+                            PipeAckProcessAckMessage, PipeDeleteQueueNoackMessage)
+
+
+class BatchChannelTest(TestCase):
+    def test_batch(self):
+        channel = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS)
+        msgs = [PipeAckProcessGetMessage('task_id:1', 'q', '数据'),
+                PipeAckProcessAckMessage('task_id:1', 'q'),
+                PipeDeleteQueueNoackMessage('q')]
+        for msg in msgs:
+            channel.put_nowait(msg)
+        channel.flush()
+        channel.put_nowait(msgs[0])
+        channel.flush()
+        channel.join()
+
+        self.assertEqual(channel.get_batch(), [dict(msg) for msg in msgs + msgs[:1]])
+
+    def test_flush_does_not_block(self):
+        channel = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS)
+        # 持久化进程没有读取，管道的缓冲区很快就满了，flush不能阻塞
+        start = time.time()
+        for _ in range(20):
+            channel.put_nowait(PipeDeleteQueueNoackMessage('q' * 64 * 1024))
+            channel.flush()
+        self.assertLess(time.time() - start, 1)
+        self.assertGreater(channel.get_stat()['buffered_bytes'], 0)
+
+        msgs = []
+        while len(msgs) < 20:
+            msgs += channel.get_batch()
+        self.assertTrue(channel.join(5))
+        stat = channel.get_stat()
+        self.assertEqual(stat['buffered_bytes'], 0)
+        self.assertEqual(stat['batches'], 20)
+        self.assertGreater(stat['sent_bytes'], 20 * 64 * 1024)
+
+    def test_flush_when_full(self):
+        channel = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS, max_batch_bytes=1)
+        channel.put_nowait(PipeDeleteQueueNoackMessage('q'))
+
+        self.assertEqual(channel.get_batch(), [dict(PipeDeleteQueueNoackMessage('q'))])
+
+    def test_commit_stat(self):
+        channel = BatchChannel(ACK_PROCESS_MESSAGE_FIELDS)
+        channel.put_nowait(PipeDeleteQueueNoackMessage('q'))
+        channel.put_nowait(PipeDeleteQueueNoackMessage('q'))
+        channel.flush()
+        channel.put_nowait(PipeDeleteQueueNoackMessage('q'))
+
+        stat = channel.get_stat()
+        self.assertEqual(stat['backlog_batches'], 1)
+        self.assertEqual(stat['backlog_records'], 3)
+        self.assertGreaterEqual(stat['oldest_unpersisted_age'], 0)
+
+        channel.commit(len(channel.get_batch()), 0.002)
+        channel.flush()
+        channel.commit(len(channel.get_batch()), 0.001)
+
+        stat = channel.get_stat()
+        self.assertEqual(stat['committed_batches'], 2)
+        self.assertEqual(stat['committed_records'], 3)
+        self.assertEqual(stat['backlog_records'], 0)
+        self.assertEqual(stat['oldest_unpersisted_age'], 0)
+        self.assertEqual(stat['mean_batch_size'], 1.5)
+        self.assertEqual(stat['last_batch_size'], 1)
+        self.assertEqual(stat['commit_latency']['count'], 2)
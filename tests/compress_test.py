@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from mingmq.compress import encode, decode, MARKER, CODECS
+
+
+class CompressTest(TestCase):
+    def test_round_trip(self):
+        data = '<html>你好</html>' * 1000
+        for codec in CODECS:
+            encoded = encode(data, codec)
+            self.assertTrue(encoded.startswith(MARKER + codec + ':'))
+            self.assertLess(len(encoded), len(data) / 5)
+            self.assertEqual(decode(encoded), data)
+
+    def test_short_data(self):
+        self.assertEqual(encode('hello'), 'hello')
+        self.assertEqual(decode('hello'), 'hello')
+
+    def test_marker_in_data(self):
+        data = MARKER + 'zlib:not base64'
+        self.assertEqual(decode(encode(data)), data)
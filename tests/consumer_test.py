@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from mingmq.async_client import AsyncConsumer
+from mingmq.client import Consumer
+from mingmq.message import MESSAGE_TYPE, SUCCESS, FAIL
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class Stop(Exception):
+    pass
+
+
+def _task(message_id):
+    return {'type': MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], 'status': SUCCESS,
+            'json_obj': [{'message_id': message_id, 'message_data': message_id}]}
+
+
+_EMPTY = {'type': MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], 'status': FAIL, 'json_obj': [None]}
+
+
+class FakePool:
+    """模拟服务器的连接池，带timeout的请求在队列为空时等待timeout秒；记录每一批确认的任务，
+    以及已经取出还没有执行完的任务数，取完max_gets次后停止消费者
+    """
+
+    def __init__(self, host, port, user_name, passwd, size):
+        self.lock = Lock()
+        self.tasks = deque()
+        self.timeouts = []
+        self.acks = []
+        self.max_gets = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def opera(self, method_name, *args):
+        return getattr(self, method_name)(*args)
+
+    def declare_queue(self, queue_name):
+        return {'status': SUCCESS}
+
+    def ack_messages(self, queue_name, message_ids):
+        with self.lock:
+            self.acks.append(list(message_ids))
+        return {'status': SUCCESS}
+
+    def get_data_from_queue(self, queue_name, timeout=None):
+        with self.lock:
+            if self.max_gets is not None and len(self.timeouts) >= self.max_gets:
+                raise Stop()
+            self.timeouts.append(timeout)
+            if self.tasks:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                return _task(self.tasks.popleft())
+        if timeout:
+            Event().wait(timeout)
+        return _EMPTY
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def acked(self):
+        with self.lock:
+            return [message_id for batch in self.acks for message_id in batch]
+
+
+def _wait(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+@patch('mingmq.client.Pool', FakePool)
+@patch('mingmq.client.LONG_POLL_TIMEOUT', 0.01)
+class ConsumerTest(TestCase):
+    def _serve(self, consumer, func):
+        thread = Thread(target=consumer.serv_forever, args=(func,), daemon=True)
+        thread.start()
+        return thread
+
+    def _stop(self, consumer, thread):
+        consumer.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_long_poll(self):
+        consumer = Consumer('', 0, '', '', 2, 'q', 'd')
+        pool = consumer.mingmq_pool
+        pool.tasks.extend(['a', 'b'])
+        pool.max_gets = 10
+        done = []
+
+        # 队列为空时由服务器等待，客户端不再sleep
+        with patch('mingmq.client.time.sleep') as sleep:
+            with self.assertRaises(Stop):
+                consumer.serv_forever(lambda message_data, message_id: done.append(message_id))
+        sleep.assert_not_called()
+        self.assertEqual(pool.timeouts, [0.01] * pool.max_gets)
+        self.assertEqual(sorted(done), ['a', 'b'])
+        self.assertEqual(sorted(pool.acked()), ['a', 'b'])
+
+    def test_prefetch(self):
+        consumer = Consumer('', 0, '', '', 2, 'q', 'd', prefetch=1)
+        pool = consumer.mingmq_pool
+        message_ids = ['m%02d' % i for i in range(12)]
+        pool.tasks.extend(message_ids)
+
+        def func(message_data, message_id):
+            time.sleep(0.02)
+            pool.done()
+
+        thread = self._serve(consumer, func)
+        self.assertTrue(_wait(lambda: len(pool.acked()) == len(message_ids)))
+        self._stop(consumer, thread)
+        # 执行中和缓冲中的任务数不超过size + prefetch
+        self.assertEqual(pool.max_in_flight, 3)
+        self.assertEqual(sorted(pool.acked()), message_ids)
+
+    @patch('mingmq.client.ACK_INTERVAL', 60)
+    def test_ack_batch(self):
+        consumer = Consumer('', 0, '', '', 4, 'q', 'd', ack_batch_size=3)
+        pool = consumer.mingmq_pool
+        message_ids = ['m%02d' % i for i in range(10)]
+        pool.tasks.extend(message_ids)
+
+        # 确认的间隔很长，只有攒够ack_batch_size个任务才确认
+        thread = self._serve(consumer, lambda message_data, message_id: None)
+        self.assertTrue(_wait(lambda: len(pool.acked()) >= 9))
+        self._stop(consumer, thread)
+        self.assertTrue(all(0 < len(batch) <= 3 for batch in pool.acks))
+        self.assertIn(3, [len(batch) for batch in pool.acks])
+        self.assertEqual(sorted(pool.acked()), message_ids)
+
+    @patch('mingmq.client.ACK_INTERVAL', 60)
+    def test_flush_acks_on_stop(self):
+        consumer = Consumer('', 0, '', '', 2, 'q', 'd')
+        pool = consumer.mingmq_pool
+        message_ids = ['m%02d' % i for i in range(5)]
+        pool.tasks.extend(message_ids)
+        done = []
+
+        thread = self._serve(consumer, lambda message_data, message_id: done.append(message_id))
+        self.assertTrue(_wait(lambda: len(done) == len(message_ids)))
+        time.sleep(0.05)
+        # 没有攒够一批，也没有到确认的间隔，停止时确认剩下的任务
+        self.assertEqual(pool.acks, [])
+        self._stop(consumer, thread)
+        self.assertEqual(sorted(pool.acked()), message_ids)
+
+
+class FakeAsyncPool:
+    """两个连接池共用的队列，记录每个池收到的timeout
+    """
+    tasks = deque()
+    added = None
+
+    def __init__(self, host, port, user_name, passwd, size):
+        self.timeouts = []
+
+    async def init(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def opera(self, method_name, *args):
+        return await getattr(self, method_name)(*args)
+
+    async def declare_queue(self, queue_name):
+        return {'status': SUCCESS}
+
+    async def ack_messages(self, queue_name, message_ids):
+        return {'status': SUCCESS}
+
+    async def get_data_from_queue(self, queue_name, timeout=None):
+        self.timeouts.append(timeout)
+        if timeout and not FakeAsyncPool.tasks:
+            try:
+                await asyncio.wait_for(FakeAsyncPool.added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if FakeAsyncPool.tasks:
+            return _task(FakeAsyncPool.tasks.popleft())
+        return _EMPTY
+
+
+@patch('mingmq.async_client.AsyncPool', FakeAsyncPool)
+class AsyncConsumerTest(TestCase):
+    def test_long_poll(self):
+        async def consume():
+            FakeAsyncPool.added = asyncio.Event()
+            async with AsyncConsumer('', 0, '', '', 'q', prefetch=2) as consumer:
+                await asyncio.sleep(0.2)
+                polls = list(consumer._wait_pool.timeouts)
+                start = time.monotonic()
+                FakeAsyncPool.tasks.append('a')
+                FakeAsyncPool.added.set()
+                _, message_id = await consumer.__anext__()
+                return consumer, polls, message_id, time.monotonic() - start
+
+        consumer, polls, message_id, elapsed = asyncio.run(consume())
+        self.assertEqual(message_id, 'a')
+        self.assertLess(elapsed, 0.1)
+        # 预取的请求不带timeout，队列为空时只在单独的连接上挂起一个长轮询的请求
+        self.assertEqual(set(consumer._mingmq_pool.timeouts), {None})
+        self.assertEqual(polls, [5])
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from mingmq.exchange import Exchange, ExchangeMemory, TopicTrie
+
+
+class TopicTrieTest(TestCase):
+    def test_wildcards(self):
+        trie = TopicTrie()
+        trie.add('stock.*.nyse', 'a')
+        trie.add('stock.#', 'b')
+        trie.add('#', 'c')
+        trie.add('*.ibm.#', 'd')
+        trie.add('stock.ibm', 'e')
+
+        self.assertEqual(sorted(trie.match('stock.ibm.nyse')), ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(trie.match('stock')), ['b', 'c'])
+        self.assertEqual(sorted(trie.match('stock.ibm')), ['b', 'c', 'd', 'e'])
+        self.assertEqual(sorted(trie.match('bond.ibm')), ['c', 'd'])
+        self.assertEqual(sorted(trie.match('stock.ibm.nyse.x')), ['b', 'c', 'd'])
+
+    def test_remove(self):
+        trie = TopicTrie()
+        trie.add('a.*.c', 'q1')
+        trie.add('a.*.c', 'q2')
+        trie.remove('a.*.c', 'q1')
+        self.assertEqual(list(trie.match('a.b.c')), ['q2'])
+
+        trie.remove('a.*.c', 'q2')
+        trie.remove('x.y', 'q2')  # 没有的绑定不会报错
+        self.assertEqual(trie._root.children, {})
+
+    def test_many_hashes(self):
+        trie = TopicTrie()
+        trie.add('#.#.#.#.#.z', 'q')
+        self.assertEqual(list(trie.match('.'.join(['a'] * 50) + '.z')), ['q'])
+
+
+class ExchangeTest(TestCase):
+    def test_direct(self):
+        exchange = Exchange('direct')
+        self.assertTrue(exchange.bind('q1', 'red'))
+        self.assertFalse(exchange.bind('q1', 'red'))
+        exchange.bind('q2', 'red')
+        exchange.bind('q2', 'blue')
+
+        self.assertEqual(exchange.route('red'), ['q1', 'q2'])
+        self.assertEqual(exchange.route('green'), [])
+        self.assertTrue(exchange.unbind('q1', 'red'))
+        self.assertEqual(exchange.route('red'), ['q2'])
+
+    def test_fanout(self):
+        exchange = Exchange('fanout')
+        exchange.bind('q1')
+        exchange.bind('q2', 'x')
+        exchange.bind('q2', 'y')
+        self.assertEqual(exchange.route('anything'), ['q1', 'q2'])
+
+        exchange.remove_queue('q2')
+        self.assertEqual(exchange.get_bindings(), [('q1', '')])
+
+    def test_bad_type(self):
+        self.assertRaises(ValueError, Exchange, 'headers')
+        self.assertFalse(ExchangeMemory().declare('e', 'headers'))
+
+    def test_memory(self):
+        memory = ExchangeMemory()
+        self.assertTrue(memory.declare('e', 'topic'))
+        self.assertFalse(memory.declare('e', 'direct'))
+        memory.bind('e', 'q', 'log.*')
+
+        self.assertEqual(memory.route('e', 'log.error'), ['q'])
+        self.assertIsNone(memory.route('nothing', 'log.error'))
+        self.assertEqual(memory.get_stat(), {'e': ['topic', 1]})
+
+        memory.remove_queue('q')
+        self.assertEqual(memory.route('e', 'log.error'), [])
@@ -0,0 +1,274 @@
+import json
+import shutil
+import socket
+import struct
+import tempfile
+import time
+from unittest import TestCase
+
+from mingmq.channel import BatchChannel
+from mingmq.handler import Handler, Broker, RECV_BUDGET
+from mingmq.memory import QueueMemory, TaskAckMemory, StatMemory
+from mingmq.message import (ACK_PROCESS_MESSAGE_FIELDS, COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS,
+                            MESSAGE_TYPE, SUCCESS, FAIL, RETRY, ReqLoginMessage, ReqPingMessage,
+                            ReqDeclareQueueMessage, ReqGetDataFromQueueMessage, ReqSendDataToQueueMessage,
+                            ReqDeclareExchangeMessage, ReqBindQueueMessage, ReqPublishMessage,
+                            ReqReadFromMessage, ReqCommitOffsetMessage, ReqSendDatasToQueueMessage,
+                            ReqACKMessage)
+from mingmq.status import ServerStatus
+from mingmq.waiter import GetWaiters
+
+
+class HandlerTest(TestCase):
+    def setUp(self):
+        self._server_sock, self._client_sock = socket.socketpair()
+        self._lazy_dir = tempfile.mkdtemp()
+        self._broker = Broker(QueueMemory(self._lazy_dir), TaskAckMemory(), StatMemory(),
+                              ServerStatus('', 0, 1, 'mingmq', 'mm5201314', 1),
+                              BatchChannel(COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS),
+                              BatchChannel(ACK_PROCESS_MESSAGE_FIELDS))
+        self._handler = Handler(self._server_sock, '', self._broker)
+
+    def tearDown(self):
+        self._server_sock.close()
+        self._client_sock.close()
+        shutil.rmtree(self._lazy_dir)
+
+    def _request(self, msg):
+        self._handler._deal_message(json.dumps(msg).encode())
+        size, = struct.unpack('!i', self._client_sock.recv(4))
+        return json.loads(self._client_sock.recv(size))
+
+    def test_requests(self):
+        self.assertEqual(self._request(ReqLoginMessage('mingmq', 'mm5201314'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqPingMessage()),
+                         {'type': MESSAGE_TYPE['PING'], 'status': SUCCESS, 'json_obj': []})
+        self.assertEqual(self._request(ReqDeclareQueueMessage('q'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q')),
+                         {'type': MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], 'status': FAIL, 'json_obj': [None]})
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('q', 'a'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q'))['json_obj'][0]['message_data'], 'a')
+
+    def test_not_found(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        for _type in (MESSAGE_TYPE['LOGIN'], 99, -1, 'x'):
+            self.assertEqual(self._request({'type': _type})['type'], MESSAGE_TYPE['NOT_FOUND'])
+
+    def test_publish(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        for queue_name in ('q1', 'q2', 'q3'):
+            self._request(ReqDeclareQueueMessage(queue_name))
+        self.assertEqual(self._request(ReqDeclareExchangeMessage('e', 'topic'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqBindQueueMessage('e', 'q1', 'log.*'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqBindQueueMessage('e', 'q2', 'log.#'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqBindQueueMessage('e', 'q3', 'metric.#'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqBindQueueMessage('e', 'nothing', '#'))['status'], FAIL)
+
+        result = self._request(ReqPublishMessage('e', 'log.error', 'boom'))
+        self.assertEqual(sorted(r['queue_name'] for r in result['json_obj']), ['q1', 'q2'])
+        self.assertEqual(len({r['message_id'] for r in result['json_obj']}), 2)
+
+        # 所有队列中是同一个字符串对象
+        queues = self._broker.queue_memory.get_self()
+        self.assertIs(queues['q1'].queue[0]['message_data'], queues['q2'].queue[0]['message_data'])
+        self.assertEqual(queues['q3'].qsize(), 0)
+
+        self.assertEqual(self._request(ReqPublishMessage('e', 'other', 'x'))['json_obj'], [])
+        self.assertEqual(self._request(ReqPublishMessage('nothing', 'log.error', 'x'))['status'], FAIL)
+
+    def test_stream(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self.assertEqual(self._request(ReqDeclareQueueMessage('s', {'type': 'stream'}))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqDeclareQueueMessage('s'))['status'], FAIL)
+        self.assertEqual(self._request(ReqDeclareQueueMessage('x', {'type': 'nothing'}))['status'], FAIL)
+        for i in range(3):
+            self.assertEqual(self._request(ReqSendDataToQueueMessage('s', str(i)))['status'], SUCCESS)
+
+        result = self._request(ReqReadFromMessage('s', 1, 10))
+        self.assertEqual([(r['offset'], r['message_data']) for r in result['json_obj']], [(1, '1'), (2, '2')])
+
+        self.assertEqual(self._request(ReqCommitOffsetMessage('s', 'g', 2))['status'], SUCCESS)
+        result = self._request(ReqReadFromMessage('s', None, 10, 'g'))
+        self.assertEqual([r['message_data'] for r in result['json_obj']], ['2'])
+
+        self.assertEqual(self._request(ReqReadFromMessage('s', 'a', 10))['status'], FAIL)
+        self.assertEqual(self._request(ReqReadFromMessage('q', 0, 10))['status'], FAIL)
+        # 流队列不经过sqlite
+        self.assertEqual(self._broker.completely_persistent_process_queue.get_stat()['records'], 0)
+
+    def test_dedup_key(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self._request(ReqDeclareQueueMessage('q'))
+        first = self._request(ReqSendDataToQueueMessage('q', 'a', 'k1'))
+        self.assertEqual(first['status'], SUCCESS)
+        self.assertFalse(first['json_obj'][0]['duplicate'])
+
+        again = self._request(ReqSendDataToQueueMessage('q', 'a', 'k1'))
+        self.assertEqual(again['json_obj'], [{'message_id': first['json_obj'][0]['message_id'], 'duplicate': True}])
+        self.assertFalse(self._request(ReqSendDataToQueueMessage('q', 'b', 'k2'))['json_obj'][0]['duplicate'])
+        self.assertEqual(self._broker.queue_memory.get_self()['q'].qsize(), 2)
+
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('nothing', 'a', 'k1'))['status'], FAIL)
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('q', 'a', 1))['status'], FAIL)
+
+    def test_unique_queue(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        arguments = {'unique': True, 'initial_capacity': 100, 'error_rate': 0.001}
+        self.assertEqual(self._request(ReqDeclareQueueMessage('urls', arguments))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('urls', 'http://a/'))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('urls', 'http://a/')),
+                         {'type': MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], 'status': SUCCESS,
+                          'json_obj': [{'message_id': None, 'duplicate': True}]})
+        # 指定了unique_key时按unique_key判断
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('urls', 'x', None, 'k'))['json_obj'], [])
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('urls', 'y', None, 'k'))['json_obj'],
+                         [{'message_id': None, 'duplicate': True}])
+        # 带dedup_key时也一样
+        res = self._request(ReqSendDataToQueueMessage('urls', 'z', 'd', 'k'))
+        self.assertEqual((res['status'], res['json_obj']), (SUCCESS, [{'message_id': None, 'duplicate': True}]))
+
+        message_ids = self._request(ReqSendDatasToQueueMessage('urls', ['http://b/', 'http://a/', 'http://b/']))
+        self.assertEqual([message_id is None for message_id in message_ids['json_obj']], [False, True, True])
+        self.assertEqual(self._broker.queue_memory.get_self()['urls'].qsize(), 3)
+
+        # 普通队列不受影响
+        self._request(ReqDeclareQueueMessage('q'))
+        self._request(ReqSendDataToQueueMessage('q', 'a'))
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('q', 'a'))['status'], SUCCESS)
+
+    def test_lazy_queue(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self.assertEqual(self._request(ReqDeclareQueueMessage('lazy', {'lazy': True, 'head_bytes': 1}))['status'], SUCCESS)
+        for data in ('a', 'b', 'c'):
+            self._request(ReqSendDataToQueueMessage('lazy', data))
+        self.assertEqual(self._broker.queue_memory.get_self()['lazy'].get_spilled(), 2)
+        self.assertEqual([self._request(ReqGetDataFromQueueMessage('lazy'))['json_obj'][0]['message_data']
+                          for _ in range(3)], ['a', 'b', 'c'])
+        self._broker.queue_memory.delete('lazy')
+
+    def test_recv_budget(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self._request(ReqDeclareQueueMessage('q'))
+        self._server_sock.setblocking(False)
+        self._client_sock.setblocking(False)
+
+        body = json.dumps(ReqSendDataToQueueMessage('q', 'x' * (RECV_BUDGET * 2))).encode()
+        frame = struct.pack('!i', len(body)) + body
+        reads = 0
+        while not self._handler.is_ok():
+            try:
+                frame = frame[self._client_sock.send(frame):]
+            except BlockingIOError:
+                pass
+            before = len(self._handler._buf or b'')
+            self._handler.handle_epoll_mode_read()
+            self.assertLessEqual(len(self._handler._buf) - before, RECV_BUDGET)
+            reads += 1
+        self.assertGreater(reads, 3)
+        self.assertEqual(self._handler.get_frame_size(), len(body))
+
+        self._client_sock.setblocking(True)
+        self._handler.handle_epoll_mode_write()
+        size, = struct.unpack('!i', self._client_sock.recv(4))
+        self.assertEqual(json.loads(self._client_sock.recv(size))['status'], SUCCESS)
+        self.assertEqual(self._broker.queue_memory.get_bytes('q'), RECV_BUDGET * 2)
+
+    def test_requeue_unacked(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self._request(ReqDeclareQueueMessage('q'))
+        for data in ('a', 'b', 'c', 'd'):
+            self._request(ReqSendDataToQueueMessage('q', data))
+        tasks = [self._request(ReqGetDataFromQueueMessage('q'))['json_obj'][0] for _ in range(3)]
+        self._request(ReqACKMessage('q', tasks[1]['message_id']))
+
+        self.assertEqual(self._handler.requeue_unacked(), 2)
+        self.assertEqual(self._handler.requeue_unacked(), 0)
+        # 放回队列头部，保持原来的顺序，旧的message_id作废
+        queue = self._broker.queue_memory.get_self()['q'].queue
+        self.assertEqual([t['message_data'] for t in queue], ['a', 'c', 'd'])
+        self.assertNotEqual(queue[0]['message_id'], tasks[0]['message_id'])
+        self.assertEqual(self._broker.task_ack_memory.get_self()['q'], {})
+
+    def _no_response(self):
+        self._client_sock.setblocking(False)
+        try:
+            with self.assertRaises(BlockingIOError):
+                self._client_sock.recv(4)
+        finally:
+            self._client_sock.setblocking(True)
+
+    def _response(self):
+        size, = struct.unpack('!i', self._client_sock.recv(4))
+        return json.loads(self._client_sock.recv(size))
+
+    def test_delivery_rate(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self.assertEqual(self._request(ReqDeclareQueueMessage('q', {'max_delivery_rate': 0.5}))['status'], SUCCESS)
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q'))['status'], FAIL)
+        for data in ('a', 'b'):
+            self._request(ReqSendDataToQueueMessage('q', data))
+
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q'))['status'], SUCCESS)
+        res = self._request(ReqGetDataFromQueueMessage('q'))
+        self.assertEqual(res['status'], RETRY)
+        self.assertTrue(1.5 < res['json_obj'][0]['retry_after'] <= 2)
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q', 'x'))['status'], FAIL)
+
+    def test_long_poll(self):
+        waiters = self._broker.waiters = GetWaiters()
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self._request(ReqDeclareQueueMessage('q', {'max_delivery_rate': 10}))
+
+        # 队列为空，挂起，有任务放入时再投递
+        self._handler._deal_message(json.dumps(ReqGetDataFromQueueMessage('q', 5)).encode())
+        self._no_response()
+        self.assertIn(self._handler, waiters)
+        self._request(ReqSendDataToQueueMessage('q', 'a'))
+        self._request(ReqSendDataToQueueMessage('q', 'b'))
+        self.assertEqual(waiters.next_time(), 0)
+        now = time.monotonic()
+        self.assertEqual(waiters.run(now, self._broker.queue_memory), [self._handler])
+        self.assertEqual(self._response()['json_obj'][0]['message_data'], 'a')
+
+        # 被限速，令牌补充之后再投递
+        self._handler._deal_message(json.dumps(ReqGetDataFromQueueMessage('q', 5)).encode())
+        self._no_response()
+        self.assertTrue(now < waiters.next_time() <= time.monotonic() + 0.1)
+        self.assertEqual(waiters.run(now, self._broker.queue_memory), [])
+        self.assertEqual(waiters.run(waiters.next_time(), self._broker.queue_memory), [self._handler])
+        self.assertEqual(self._response()['json_obj'][0]['message_data'], 'b')
+
+        # 超时
+        self._handler._deal_message(json.dumps(ReqGetDataFromQueueMessage('q', 5)).encode())
+        self._no_response()
+        self.assertEqual(waiters.run(time.monotonic() + 10, self._broker.queue_memory), [self._handler])
+        self.assertEqual(self._response(), {'type': MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], 'status': FAIL,
+                                            'json_obj': [None]})
+        self.assertIsNone(waiters.next_time())
+
+        # 连接关闭后不再投递
+        self._handler._deal_message(json.dumps(ReqGetDataFromQueueMessage('q', 5)).encode())
+        waiters.discard(self._handler)
+        self._request(ReqSendDataToQueueMessage('q', 'c'))
+        self.assertEqual(waiters.run(time.monotonic() + 1, self._broker.queue_memory), [])
+        self.assertEqual(len(waiters), 0)
+
+    def test_memory_blocked(self):
+        self._request(ReqLoginMessage('mingmq', 'mm5201314'))
+        self._request(ReqDeclareQueueMessage('q'))
+        self._request(ReqSendDataToQueueMessage('q', 'a'))
+        self.assertTrue(self._handler.is_publish_only())
+
+        self._broker.server_status.set_memory_blocked(True)
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('q', 'b')),
+                         {'type': MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], 'status': RETRY,
+                          'json_obj': [{'retry_after': 1}]})
+        self.assertEqual(self._request(ReqSendDatasToQueueMessage('q', ['c']))['status'], RETRY)
+        self.assertEqual(self._broker.queue_memory.get_bytes('q'), 1)
+
+        # 消费照常进行
+        self.assertEqual(self._request(ReqGetDataFromQueueMessage('q'))['json_obj'][0]['message_data'], 'a')
+        self.assertFalse(self._handler.is_publish_only())
+
+        self._broker.server_status.set_memory_blocked(False)
+        self.assertEqual(self._request(ReqSendDataToQueueMessage('q', 'b'))['status'], SUCCESS)
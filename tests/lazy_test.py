@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from queue import Empty
+from unittest import TestCase
+
+from mingmq.lazy import LazyQueue
+from mingmq.memory import QueueMemory
+from mingmq.message import Task
+
+
+class LazyQueueTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def test_fifo(self):
+        queue = LazyQueue(os.path.join(self._dir, 'q'), head_bytes=10, segment_bytes=100)
+        for i in range(100):
+            queue.put_nowait(Task('%05d' % i, 'id-%d' % i))
+        self.assertEqual(queue.qsize(), 100)
+        self.assertEqual(queue.get_spilled(), 98)
+        self.assertGreater(len(os.listdir(os.path.join(self._dir, 'q'))), 1)
+
+        self.assertEqual([task['message_data'] for task in queue.queue], ['%05d' % i for i in range(100)])
+
+        for i in range(60):
+            task = queue.get_nowait()
+            self.assertEqual(task, {'message_id': 'id-%d' % i, 'message_data': '%05d' % i})
+            # 队头始终是满的
+            self.assertEqual(queue.qsize() - queue.get_spilled(), 2)
+
+        # 有任务在磁盘上时新的任务排在后面
+        queue.put_nowait(Task('new', 'id-new'))
+        self.assertEqual([queue.get_nowait()['message_data'] for _ in range(41)][-2:], ['00099', 'new'])
+        self.assertRaises(Empty, queue.get_nowait)
+        # 读完的段都被删除了
+        self.assertEqual(os.listdir(os.path.join(self._dir, 'q')), [])
+
+        queue.put_nowait(Task('a'))
+        self.assertEqual(queue.get_spilled(), 0)
+        # 退回的任务排在最前面
+        queue.put_front(Task('b'))
+        self.assertEqual([task['message_data'] for task in queue.queue], ['b', 'a'])
+        queue.close()
+        self.assertFalse(os.path.exists(os.path.join(self._dir, 'q')))
+
+    def test_queue_memory(self):
+        queue_memory = QueueMemory(self._dir)
+        self.assertTrue(queue_memory.declare_lazy('a/b', 0))
+        self.assertFalse(queue_memory.declare_lazy('a/b', 0))
+        for i in range(5):
+            queue_memory.put('a/b', Task(str(i)))
+        self.assertEqual(queue_memory.get_self()['a/b'].get_spilled(), 5)
+        self.assertEqual(queue_memory.get('a/b')['message_data'], '0')
+        self.assertEqual(queue_memory.get_stat()['a/b'][0], 4)
+
+        self.assertTrue(queue_memory.clear('a/b'))
+        self.assertIsInstance(queue_memory.get_self()['a/b'], LazyQueue)
+        self.assertIsNone(queue_memory.get('a/b'))
+
+        queue_memory.put('a/b', Task('x'))
+        self.assertTrue(queue_memory.delete('a/b'))
+        self.assertEqual(os.listdir(self._dir), [])
@@ -0,0 +1,263 @@
+import gc
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mingmq.memory import QueueMemory, TaskAckMemory, StatMemory, RateWindow, Histogram, DedupMemory, TokenBucket
+from mingmq.message import Task
+
+
+class TaskAckMemoryTest(TestCase):
+    def test_pop_expired(self):
+        memory = TaskAckMemory()
+        memory.declare('q')
+        memory.put('q', 'a', 'data_a', 1.0)
+        memory.put('q', 'b', 'data_b', 2.0)
+        memory.put('q', 'c', 'data_c', 3.0)
+
+        self.assertTrue(memory.get('q', 'a'))  # 已经确认的不会重发
+        self.assertEqual(memory.pop_expired(2.5), [('q', 'b', 'data_b')])
+        self.assertEqual(memory.pop_expired(2.5), [])
+        self.assertFalse(memory.get('q', 'b'))
+        self.assertEqual(list(memory.get_self()['q']), ['c'])
+
+    def test_pop(self):
+        memory = TaskAckMemory()
+        memory.declare('q')
+        memory.put('q', 'a', 'data_a', 1.0)
+
+        self.assertEqual(memory.pop('q', 'a'), 1.0)
+        self.assertIsNone(memory.pop('q', 'a'))
+        self.assertIsNone(memory.pop('nothing', 'a'))
+
+    def test_deleted_queue(self):
+        memory = TaskAckMemory()
+        memory.declare('q')
+        memory.put('q', 'a', 'data_a', 1.0)
+        memory.delete('q')
+
+        self.assertEqual(memory.pop_expired(10.0), [])
+
+    def test_total_bytes(self):
+        memory = TaskAckMemory()
+        memory.declare('q')
+        memory.put('q', 'a', 'data_a', 1.0)
+        memory.put('q', 'b', 'bb', 2.0)
+        memory.put('q', 'c', None, 3.0)
+        memory.declare('q2')
+        memory.put('q2', 'a', 'aaa', 1.0)
+        self.assertEqual(memory.get_total_bytes(), 11)
+        self.assertEqual(memory.get_stat(), {'q': [3, 8], 'q2': [1, 3]})
+        memory.delete('q2')
+        self.assertEqual(memory.get_total_bytes(), 8)
+        self.assertIsNone(memory.get_bytes('q2'))
+
+        self.assertTrue(memory.get('q', 'a'))
+        self.assertEqual(memory.get_total_bytes(), 2)
+        memory.pop_expired(2.5)
+        self.assertEqual(memory.get_total_bytes(), 0)
+
+        memory.put('q', 'd', 'dd', 4.0)
+        memory.clear('q')
+        self.assertEqual(memory.get_total_bytes(), 0)
+
+    def test_pop_message(self):
+        memory = TaskAckMemory()
+        memory.declare('q')
+        memory.put('q', 'a', 'data_a', 1.0)
+
+        self.assertTrue(memory.has('q', 'a'))
+        self.assertEqual(memory.pop_message('q', 'a'), ('data_a', 1.0))
+        self.assertFalse(memory.has('q', 'a'))
+        self.assertIsNone(memory.pop_message('q', 'a'))
+        self.assertFalse(memory.has('nothing', 'a'))
+        self.assertEqual(memory.get_total_bytes(), 0)
+
+
+class QueueMemoryTest(TestCase):
+    def test_total_bytes(self):
+        lazy_dir = tempfile.mkdtemp()
+        try:
+            memory = QueueMemory(lazy_dir)
+            memory.decleare('q1')
+            memory.declare_lazy('q2', 4)
+            for queue_name in ('q1', 'q2'):
+                for data in ('aaa', 'bbb', 'ccc'):
+                    memory.put(queue_name, Task(data))
+            # 惰性队列只算队头
+            self.assertEqual(memory.get_bytes('q1'), 9)
+            self.assertEqual(memory.get_bytes('q2'), 3)
+            self.assertEqual(memory.get_total_bytes(), 12)
+            self.assertEqual(memory.get_stat(), {'q1': [3, 9], 'q2': [3, 3]})
+
+            memory.get('q1')
+            memory.get('q2')
+            self.assertEqual(memory.get_bytes('q2'), 3)
+            self.assertEqual(memory.get_total_bytes(), 9)
+
+            memory.put_front('q1', Task('z'))
+            self.assertEqual(memory.get_bytes('q1'), 7)
+            self.assertEqual(memory.get('q1')['message_data'], 'z')
+            self.assertFalse(memory.put_front('nothing', Task('z')))
+
+            memory.clear('q1')
+            self.assertEqual(memory.get_total_bytes(), 3)
+            memory.delete('q2')
+            self.assertEqual(memory.get_total_bytes(), 0)
+            self.assertIsNone(memory.get_bytes('q2'))
+        finally:
+            shutil.rmtree(lazy_dir)
+
+    def test_temp_lazy_dir(self):
+        # 没有指定目录时创建的临时目录在QueueMemory回收时删除
+        memory = QueueMemory()
+        self.assertTrue(memory.declare_lazy('q', 4))
+        lazy_dir = memory._lazy_dir
+        self.assertTrue(os.path.isdir(lazy_dir))
+        del memory
+        gc.collect()
+        self.assertFalse(os.path.exists(lazy_dir))
+
+    def test_lazy_queue_name(self):
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(snapshot_dir, 'journal.log'), 'w').close()
+            memory = QueueMemory(os.path.join(snapshot_dir, 'lazy'))
+            for queue_name in ('', '.', '..'):
+                self.assertFalse(memory.declare_lazy(queue_name, 4))
+                self.assertFalse(memory.clear(queue_name))
+                self.assertFalse(memory.delete(queue_name))
+            self.assertTrue(memory.declare_lazy('../x', 4))
+            self.assertTrue(memory.clear('../x'))
+            self.assertTrue(memory.delete('../x'))
+            self.assertTrue(os.path.exists(os.path.join(snapshot_dir, 'journal.log')))
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+    def test_get_limited(self):
+        memory = QueueMemory()
+        memory.decleare('q')
+        self.assertTrue(memory.set_delivery_rate('q', 2, 2))
+        self.assertFalse(memory.set_delivery_rate('nothing', 2))
+        self.assertEqual(memory.get_delivery_rate('q'), (2, 2))
+        now = time.monotonic()
+        # 队列为空时不消耗令牌
+        self.assertEqual(memory.get_limited('q', now), (None, 0.0))
+        for data in ('a', 'b', 'c', 'd'):
+            memory.put('q', Task(data))
+
+        self.assertEqual(memory.get_limited('q', now)[0]['message_data'], 'a')
+        self.assertEqual(memory.get_limited('q', now)[0]['message_data'], 'b')
+        self.assertEqual(memory.get_limited('q', now), (None, 0.5))
+        self.assertEqual(memory.get_limited('q', now + 0.5)[0]['message_data'], 'c')
+        self.assertEqual(memory.get_bytes('q'), 1)
+
+        memory.set_delivery_rate('q', None)
+        self.assertIsNone(memory.get_delivery_rate('q'))
+        self.assertEqual(memory.get_limited('q', now + 0.5)[0]['message_data'], 'd')
+        memory.set_delivery_rate('q', 1)
+        memory.delete('q')
+        self.assertIsNone(memory.get_delivery_rate('q'))
+
+
+class TokenBucketTest(TestCase):
+    def test_take(self):
+        bucket = TokenBucket(4, 2, now=0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertEqual(bucket.take(0), 0.25)
+        self.assertEqual(bucket.take(0.125), 0.125)
+        self.assertEqual(bucket.take(0.25), 0)
+        # 空闲再久也只能积攒capacity个令牌
+        self.assertEqual(bucket.wait_time(100), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class RateWindowTest(TestCase):
+    def test_rate(self):
+        window = RateWindow()
+        window.add(10, 100.0)
+        window.add(10, 100.5)
+        window.add(30, 101.2)
+        self.assertEqual(window.rate(101.9), 50 / RateWindow.WINDOW)
+        # 超过窗口的桶不再计算
+        self.assertEqual(window.rate(100.0 + RateWindow.WINDOW), 30 / RateWindow.WINDOW)
+        self.assertEqual(window.rate(200.0), 0)
+
+    def test_reuse_bucket(self):
+        window = RateWindow()
+        window.add(5, 100.0)
+        window.add(7, 100.0 + RateWindow.WINDOW)
+        self.assertEqual(window.rate(100.0 + RateWindow.WINDOW), 7 / RateWindow.WINDOW)
+
+
+class HistogramTest(TestCase):
+    def test_percentile(self):
+        histogram = Histogram()
+        for _ in range(90):
+            histogram.observe(0.0001)  # 100微秒
+        for _ in range(10):
+            histogram.observe(0.1)
+
+        self.assertEqual(histogram.get_count(), 100)
+        self.assertEqual(histogram.percentile(50), 128 / 1000000)
+        self.assertEqual(histogram.percentile(99), 0.1)
+        self.assertEqual(histogram.get_buckets()[-1], (float('inf'), 100))
+
+    def test_large_and_negative(self):
+        histogram = Histogram()
+        histogram.observe(-1)
+        histogram.observe(10 ** 6)
+        self.assertEqual(histogram.get_buckets()[0][1], 1)
+        self.assertEqual(histogram.get_stat()['max'], 10 ** 9)
+
+
+class StatMemoryTest(TestCase):
+    def test_queue(self):
+        memory = StatMemory()
+        self.assertTrue(memory.declare_queue('q'))
+        self.assertFalse(memory.declare_queue('q'))
+
+        memory.set('send_q', 20, 100.0)
+        memory.set('ack_q', 10, 100.0)
+        memory.observe_latency('deliver', 'q', 0.002)
+        memory.observe_service('PING', 0.00001)
+
+        self.assertEqual(memory.get('send_q'), 20)
+        self.assertEqual(memory.get_speed('send_q', 100.5), 20 / RateWindow.WINDOW)
+        self.assertEqual(memory.get_speed('redeliver_q', 100.5), 0)
+
+        metrics = memory.get_metrics()
+        self.assertEqual(metrics['latency']['q']['deliver']['count'], 1)
+        self.assertEqual(metrics['latency']['q']['ack']['count'], 0)
+        self.assertEqual(metrics['service']['PING']['count'], 1)
+
+        self.assertTrue(memory.delete_queue('q'))
+        self.assertIsNone(memory.get('send_q'))
+        self.assertEqual(memory.get_stat(), {})
+
+
+class DedupMemoryTest(TestCase):
+    def test_window(self):
+        memory = DedupMemory(max_size=3, max_age=10)
+        self.assertIsNone(memory.put('q', 'a', 'id-a', now=100))
+        self.assertEqual(memory.put('q', 'a', 'id-x', now=101), 'id-a')
+        # 不同队列的dedup_key互不影响
+        self.assertIsNone(memory.put('other', 'a', 'id-b', now=101))
+
+        for key in ('b', 'c', 'd'):
+            memory.put('q', key, 'id-' + key, now=102)
+        # 超过max_size，最早的a被淘汰
+        self.assertEqual(memory.get_stat()['q'], 3)
+        self.assertIsNone(memory.put('q', 'a', 'id-a2', now=103))
+
+        # 超过max_age的都被淘汰
+        self.assertIsNone(memory.put('q', 'b', 'id-b2', now=113))
+        self.assertEqual(list(memory.get_self()['q']), ['a', 'b'])
+
+        memory.remove('q', 'a')
+        self.assertIsNone(memory.put('q', 'a', 'id-a3', now=113))
+        self.assertTrue(memory.delete('q'))
+        self.assertFalse(memory.delete('q'))
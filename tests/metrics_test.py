@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from mingmq.memory import StatMemory, Histogram
+from mingmq.metrics import render
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        stat_memory = StatMemory()
+        stat_memory.declare_queue('q"1')
+        stat_memory.set('send_q"1', 3)
+        stat_memory.observe_latency('ack', 'q"1', 0.003)
+        stat_memory.observe_service('PING', 0.00001)
+
+        metrics = stat_memory.get_metrics()
+        metrics['connections'] = 2
+        metrics['memory'] = {'used_bytes': 500, 'high_watermark': 1000, 'low_watermark': 800,
+                             'blocked': False, 'paused_connections': 0}
+        metrics['channels'] = {'ack': {'records': 5, 'batches': 1, 'sent_bytes': 100, 'buffered_bytes': 7,
+                                       'backlog_records': 2, 'commit_latency': Histogram().get_stat()}}
+        self.stat = {
+            'queue_infor': {'q"1': [4, 400]},
+            'speed_infor': stat_memory.get_stat(),
+            'task_ack_infor': {'q"1': [1, 100]},
+            'metrics': metrics
+        }
+
+    def test_render(self):
+        lines = render(self.stat).splitlines()
+
+        self.assertIn('# TYPE mingmq_queue_messages gauge', lines)
+        self.assertIn('mingmq_queue_messages{queue="q\\"1"} 4', lines)
+        self.assertIn('mingmq_queue_unacked_bytes{queue="q\\"1"} 100', lines)
+        self.assertIn('mingmq_queue_events_total{queue="q\\"1",action="send"} 3', lines)
+        self.assertIn('mingmq_connections 2', lines)
+        self.assertIn('mingmq_memory_bytes 500', lines)
+        self.assertIn('mingmq_memory_blocked 0', lines)
+        self.assertIn('mingmq_ipc_buffered_bytes{channel="ack"} 7', lines)
+        self.assertIn('mingmq_persistence_backlog_records{channel="ack"} 2', lines)
+        self.assertIn('mingmq_persistence_commit_seconds_count{channel="ack"} 0', lines)
+        self.assertIn('mingmq_command_duration_seconds_count{command="PING"} 1', lines)
+
+    def test_histogram(self):
+        lines = render(self.stat).splitlines()
+        buckets = [line for line in lines
+                   if line.startswith('mingmq_queue_latency_seconds_bucket{queue="q\\"1",stage="ack"')]
+
+        self.assertEqual(len(buckets), Histogram.BUCKETS)
+        self.assertTrue(buckets[-1].endswith('le="+Inf"} 1'))
+        # 3毫秒落在(2048, 4096]微秒的桶
+        self.assertIn('mingmq_queue_latency_seconds_bucket{queue="q\\"1",stage="ack",le="0.004096"} 1', lines)
+        self.assertIn('mingmq_queue_latency_seconds_bucket{queue="q\\"1",stage="ack",le="0.002048"} 0', lines)
@@ -0,0 +1,90 @@
+import logging
+import time
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from mingmq.client import Pool
+from mingmq.error import ClientPoolEmpty
+from mingmq.message import SUCCESS
+
+logging.basicConfig(level=logging.ERROR)
+
+from .settings import *
+
+
+class PoolTest(TestCase):
+    def test_lazy_and_bounded(self):
+        pool = Pool(IP, PORT, USER, PASSWD, 10)
+        self.assertEqual(len(pool.all()), 1)
+
+        results = []
+
+        def ping():
+            for _ in range(20):
+                results.append(pool.opera('ping'))
+
+        ts = [Thread(target=ping) for _ in range(100)]
+        for t in ts: t.start()
+        for t in ts: t.join()
+
+        self.assertEqual(len(results), 2000)
+        self.assertTrue(all(result['status'] == SUCCESS for result in results))
+        self.assertLessEqual(len(pool.all()), 10)
+        pool.release()
+
+    def test_borrow_timeout(self):
+        pool = Pool(IP, PORT, USER, PASSWD, 1, borrow_timeout=0.1)
+        conn = pool.get_conn()
+        self.assertRaises(ClientPoolEmpty, pool.get_conn)
+        pool.back_conn(conn)
+        self.assertIs(pool.get_conn(), conn)
+        pool.back_conn(conn)
+        pool.release()
+
+    def test_idle_timeout(self):
+        pool = Pool(IP, PORT, USER, PASSWD, 2, idle_timeout=0)
+        conn = pool.get_conn()
+        pool.back_conn(conn)
+        new_conn = pool.get_conn()
+        self.assertIsNot(new_conn, conn)
+        self.assertFalse(conn.is_connected())
+        pool.back_conn(new_conn)
+        pool.release()
+
+
+class FakeClient:
+    def __init__(self, host, port):
+        self.closed = False
+
+    def login(self, user_name, passwd):
+        return SUCCESS
+
+    def ping(self):
+        return True
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+@patch('mingmq.client.Client', FakeClient)
+class PoolIdleTest(TestCase):
+    def test_evict_surplus(self):
+        pool = Pool('', 0, '', '', 10, idle_timeout=0.2)
+        conns = [pool.get_conn() for _ in range(10)]
+        for conn in conns:
+            pool.back_conn(conn)
+        self.assertEqual(len(pool.all()), 10)
+
+        # 高峰过后每次只用一个连接，多出来的连接也要空闲超时关闭
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            pool.back_conn(pool.get_conn())
+            time.sleep(0.05)
+
+        self.assertEqual(len(pool.all()), 1)
+        self.assertEqual(sum(conn.closed for conn in conns), 9)
+        pool.release()
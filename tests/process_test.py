@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import time
+from sqlite3 import connect
+from unittest import TestCase
+
+from mingmq.message import (PipeAckProcessGetMessage, PipeAckProcessAckMessage,
+                            PipeCompletelyPersistentProcessSendMessage, PipeCompletelyPersistentProcessGetMessage)
+from mingmq.process import AckProcess, CompletelyPersistentProcess, WriteBehindThread
+
+ACK = WriteBehindThread.ACK
+COMPLETELY_PERSISTENT = WriteBehindThread.COMPLETELY_PERSISTENT
+
+
+class WriteBehindThreadTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._ack_db_file = os.path.join(self._dir, 'ack.db')
+        self._send_db_file = os.path.join(self._dir, 'send.db')
+        ack_process = AckProcess(self._ack_db_file, '127.0.0.1', 0, 'mingmq', 'mm5201314', None)
+        completely_persistent_process = CompletelyPersistentProcess(self._send_db_file, None,
+                                                                    '127.0.0.1', 0, 'mingmq', 'mm5201314')
+        self._wbt = WriteBehindThread(ack_process, completely_persistent_process,
+                                      self._ack_db_file, self._send_db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _rows(self, db_file, table):
+        conn = connect(db_file)
+        try:
+            return [row[0] for row in conn.execute('select message_id from %s order by message_id' % table)]
+        finally:
+            conn.close()
+
+    def test_write(self):
+        self._wbt.start()
+        ack_sink = self._wbt.ack_sink()
+        send_sink = self._wbt.completely_persistent_sink()
+
+        # 和服务器中的顺序一样：发送、获取、确认交替出现，同一个事务中的确认要在获取之后执行
+        send_sink.put_nowait(PipeCompletelyPersistentProcessSendMessage('q', 'a', 'm1'))
+        send_sink.put_nowait(PipeCompletelyPersistentProcessSendMessage('q', 'b', 'm2'))
+        ack_sink.put_nowait(PipeAckProcessGetMessage('m1', 'q', 'a'))
+        send_sink.put_nowait(PipeCompletelyPersistentProcessGetMessage('q', 'm1'))
+        ack_sink.put_nowait(PipeAckProcessAckMessage('m1', 'q'))
+        ack_sink.put_nowait(PipeAckProcessGetMessage('m2', 'q', 'b'))
+        send_sink.put_nowait(PipeCompletelyPersistentProcessGetMessage('q', 'm2'))
+        send_sink.put_nowait(PipeCompletelyPersistentProcessSendMessage('q', 'c', 'm3'))
+        send_sink.flush()
+
+        deadline = time.time() + 5
+        while ack_sink.get_stat()['backlog_records'] and time.time() < deadline:
+            time.sleep(0.01)
+
+        stat = ack_sink.get_stat()
+        self.assertEqual(stat['committed_records'], 8)
+        self.assertEqual(stat['commit_latency']['count'], 1)
+        self.assertEqual(self._rows(self._send_db_file, 'send_msg'), ['m3'])
+        self.assertEqual(self._rows(self._ack_db_file, 'ack_msg'), ['m2'])
+
+    def test_rollback(self):
+        self._wbt._write([(COMPLETELY_PERSISTENT, PipeCompletelyPersistentProcessSendMessage('q', 'a', 'm1')),
+                          (ACK, PipeAckProcessGetMessage('m0', 'q', 'z'))])
+
+        # 批次中间出错时整个事务回滚，两个数据库都不会写入一半
+        bad = PipeAckProcessGetMessage('m3', 'q', 'c')
+        bad['pub_date'] = 'bad'
+        with self.assertRaises(ValueError):
+            self._wbt._write([(COMPLETELY_PERSISTENT, PipeCompletelyPersistentProcessSendMessage('q', 'b', 'm2')),
+                              (ACK, PipeAckProcessAckMessage('m0', 'q')),
+                              (COMPLETELY_PERSISTENT, PipeCompletelyPersistentProcessGetMessage('q', 'm1')),
+                              (ACK, bad)])
+
+        self.assertEqual(self._rows(self._send_db_file, 'send_msg'), ['m1'])
+        self.assertEqual(self._rows(self._ack_db_file, 'ack_msg'), ['m0'])
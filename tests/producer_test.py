@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+from mingmq.async_client import AsyncProducer
+from mingmq.client import BatchProducer, Producer
+from mingmq.message import MESSAGE_TYPE, SUCCESS, RETRY
+
+logging.basicConfig(level=logging.ERROR)
+
+
+def _retry(_type):
+    return {'type': MESSAGE_TYPE[_type], 'status': RETRY, 'json_obj': [{'retry_after': 0.01}]}
+
+
+class FakeClient:
+    """前retries个发送请求返回RETRY，之后成功
+    """
+    retries = 0
+
+    def __init__(self, host, port):
+        self.sent = []
+
+    def login(self, user_name, passwd):
+        return SUCCESS
+
+    def declare_queue(self, queue_name):
+        return {'status': SUCCESS}
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+    def send_data_to_queue(self, queue_name, message_data):
+        if FakeClient.retries:
+            FakeClient.retries -= 1
+            return _retry('SEND_DATA_TO_QUEUE')
+        self.sent.append(message_data)
+        return {'type': MESSAGE_TYPE['SEND_DATA_TO_QUEUE'], 'status': SUCCESS, 'json_obj': [len(self.sent)]}
+
+    def send_datas_to_queue(self, queue_name, message_datas):
+        if FakeClient.retries:
+            FakeClient.retries -= 1
+            return _retry('SEND_DATAS_TO_QUEUE')
+        self.sent.extend(message_datas)
+        return {'type': MESSAGE_TYPE['SEND_DATAS_TO_QUEUE'], 'status': SUCCESS,
+                'json_obj': list(range(len(self.sent) - len(message_datas), len(self.sent)))}
+
+
+class FakeAsyncPool:
+    def __init__(self, host, port, user_name, passwd, size):
+        self.client = FakeClient(host, port)
+
+    async def init(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def opera(self, method_name, *args):
+        return getattr(self.client, method_name)(*args)
+
+
+@patch('mingmq.client.Client', FakeClient)
+class ProducerRetryTest(TestCase):
+    def test_producer(self):
+        FakeClient.retries = 3
+        producer = Producer('', 0, '', '', 'q')
+        producer.send_task('a')
+        self.assertEqual(FakeClient.retries, 0)
+        self.assertEqual(producer._mingmq_conn.sent, ['"a"'])
+
+    def test_batch_producer(self):
+        FakeClient.retries = 3
+        producer = BatchProducer('', 0, '', '', 'q', batch_size=10, linger_ms=1)
+        futures = [producer.send_task(i) for i in range(20)]
+        self.assertTrue(producer.flush(5))
+        self.assertEqual([future.result() for future in futures], list(range(20)))
+        self.assertEqual(FakeClient.retries, 0)
+        producer.release()
+
+    def test_batch_producer_backpressure(self):
+        # 服务器一直返回RETRY时任务不会丢，缓冲区满了send_task就阻塞
+        FakeClient.retries = 1000
+        producer = BatchProducer('', 0, '', '', 'q', batch_size=1, linger_ms=0, max_buffer_bytes=10)
+        futures = [producer.send_task('x')]
+        with self.assertRaisesRegex(Exception, '缓冲区已满'):
+            for _ in range(10):
+                futures.append(producer.send_task('x', timeout=0.05))
+        self.assertFalse(any(future.done() for future in futures))
+
+        FakeClient.retries = 0
+        self.assertTrue(producer.flush(5))
+        self.assertTrue(all(future.exception() is None for future in futures))
+        producer.release()
+
+
+@patch('mingmq.async_client.AsyncPool', FakeAsyncPool)
+class AsyncProducerRetryTest(TestCase):
+    def test_send(self):
+        async def send():
+            async with AsyncProducer('', 0, '', '', 'q') as producer:
+                await producer.send_task('a')
+                self.assertEqual(FakeClient.retries, 0)
+                FakeClient.retries = 2
+                await producer.send_tasks(list(range(5)), batch_size=2)
+                return producer._mingmq_pool.client.sent
+
+        FakeClient.retries = 2
+        sent = asyncio.run(send())
+        self.assertEqual(FakeClient.retries, 0)
+        self.assertEqual(sorted(sent), ['"a"', '0', '1', '2', '3', '4'])
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mingmq.segment import SegmentLog, StreamMemory, check_arguments
+
+
+class SegmentLogTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_append_read(self):
+        log = SegmentLog(segment_bytes=10)
+        for i in range(10):
+            self.assertEqual(log.append('%05d' % i), i)
+
+        self.assertEqual(log.get_segment_count(), 5)
+        self.assertEqual([data for _, _, data in log.read(3, 4)], ['00003', '00004', '00005', '00006'])
+        self.assertEqual([offset for offset, _, _ in log.read(8, 100)], [8, 9])
+        self.assertEqual(log.read(10, 100), [])
+
+    def test_retain(self):
+        log = SegmentLog(segment_bytes=10, max_bytes=20)
+        for i in range(10):
+            log.append('%05d' % i)
+        self.assertLessEqual(log.get_size(), 20)
+        self.assertEqual(log.first_offset(), 6)
+        # 读取被删除的offset时从最老的消息开始
+        self.assertEqual(log.read(0, 1)[0][0], 6)
+
+        log = SegmentLog(segment_bytes=10, max_age=10)
+        for i in range(6):
+            log.append('%05d' % i, now=100 + i)
+        self.assertEqual(log.retain(now=114), 2)
+        self.assertEqual(log.first_offset(), 4)
+        # 正在写的段不会被删除
+        self.assertEqual(log.retain(now=1000), 0)
+        self.assertEqual(log.next_offset(), 6)
+
+    def test_restore(self):
+        log = SegmentLog(self._dir, segment_bytes=10)
+        for i in range(5):
+            log.append('%05d' % i)
+        log.close()
+
+        log = SegmentLog(self._dir, segment_bytes=10)
+        self.assertEqual(log.next_offset(), 5)
+        self.assertEqual(log.append('x'), 5)
+        self.assertEqual([data for _, _, data in log.read(0, 100)], ['00000', '00001', '00002', '00003', '00004', 'x'])
+
+        log.truncate()
+        log.close()
+        log = SegmentLog(self._dir, segment_bytes=10)
+        self.assertEqual(log.read(0, 100), [])
+        self.assertEqual(log.append('y'), 6)
+        log.close()
+
+
+class StreamMemoryTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_check_arguments(self):
+        self.assertEqual(check_arguments(None), {'type': 'classic', 'lazy': False, 'unique': False})
+        self.assertEqual(check_arguments({'unique': True, 'error_rate': 0.01}),
+                         {'type': 'classic', 'lazy': False, 'unique': True,
+                          'initial_capacity': 100000, 'error_rate': 0.01})
+        self.assertEqual(check_arguments({'type': 'stream', 'max_age': 60}),
+                         {'type': 'stream', 'max_age': 60, 'lazy': False, 'unique': False})
+        self.assertEqual(check_arguments({'lazy': True})['head_bytes'], 16 * 1024 * 1024)
+        self.assertEqual(check_arguments({'max_delivery_rate': 0.5})['delivery_burst'], 1)
+        for arguments in ('stream', {'type': 'x'}, {'type': 'stream', 'max_bytes': 0},
+                          {'type': 'stream', 'max_bytes': '1'}, {'type': 'stream', 'max_age': True},
+                          {'unique': 1}, {'unique': True, 'error_rate': 1}, {'unique': True, 'initial_capacity': 1.5},
+                          {'lazy': True, 'type': 'stream'}, {'lazy': True, 'head_bytes': -1},
+                          {'max_delivery_rate': 0}, {'max_delivery_rate': True}, {'max_delivery_rate': '5'},
+                          {'max_delivery_rate': 5, 'delivery_burst': 0}, {'max_delivery_rate': 5, 'delivery_burst': 1.5},
+                          {'max_delivery_rate': 5, 'type': 'stream'}):
+            self.assertIsNone(check_arguments(arguments))
+
+    def test_queue_name_path(self):
+        streams = os.path.join(self._dir, 'streams')
+        open(os.path.join(self._dir, 'journal.log'), 'w').close()
+        memory = StreamMemory(streams)
+        for queue_name in ('', '.', '..', 1):
+            self.assertFalse(memory.declare(queue_name, {'type': 'stream'}))
+        self.assertTrue(memory.declare('../x', {'type': 'stream'}))
+        self.assertEqual(os.listdir(streams), ['..%2Fx'])
+        self.assertTrue(memory.delete('../x'))
+        self.assertFalse(memory.delete('..'))
+        self.assertTrue(os.path.exists(os.path.join(self._dir, 'journal.log')))
+
+    def test_offsets(self):
+        memory = StreamMemory(self._dir)
+        self.assertTrue(memory.declare('s/1', {'type': 'stream'}))
+        self.assertFalse(memory.declare('s/1', {'type': 'stream'}))
+        for i in range(5):
+            memory.append('s/1', str(i))
+        self.assertIsNone(memory.append('nothing', 'x'))
+
+        self.assertEqual(len(memory.read('s/1', None, 100, 'g1')), 5)
+        self.assertTrue(memory.commit_offset('s/1', 'g1', 3))
+        self.assertEqual([data for _, _, data in memory.read('s/1', None, 100, 'g1')], ['3', '4'])
+        # 其它消费组互不影响
+        self.assertEqual(len(memory.read('s/1', None, 100, 'g2')), 5)
+        memory.flush()
+        memory.close()
+
+        memory = StreamMemory(self._dir)
+        self.assertEqual(memory.restore(), ['s/1'])
+        self.assertEqual([data for _, _, data in memory.read('s/1', None, 100, 'g1')], ['3', '4'])
+        self.assertEqual(memory.get_stat()['s/1'][:2], [0, 5])
+
+        self.assertTrue(memory.delete('s/1'))
+        self.assertEqual(os.listdir(self._dir), [])
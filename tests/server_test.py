@@ -0,0 +1,110 @@
+import json
+import platform
+import socket
+import struct
+import time
+import unittest
+from threading import Thread
+from unittest import TestCase
+
+from mingmq.channel import BatchChannel
+from mingmq.message import (ACK_PROCESS_MESSAGE_FIELDS, COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS,
+                            MESSAGE_TYPE, SUCCESS, FAIL, ReqLoginMessage, ReqPingMessage,
+                            ReqDeclareQueueMessage, ReqGetDataFromQueueMessage, ReqSendDataToQueueMessage)
+from mingmq.server import Server
+from mingmq.status import ServerStatus
+
+
+def _start_server(server_status):
+    """在线程中运行服务器，返回监听的端口
+    """
+    channels = (BatchChannel(COMPLETELY_PERSISTENT_PROCESS_MESSAGE_FIELDS), BatchChannel(ACK_PROCESS_MESSAGE_FIELDS))
+    for channel in channels:
+        Thread(target=lambda c=channel: [c.get_batch() for _ in iter(int, 1)], daemon=True).start()
+    server = Server(server_status, *channels)
+    server.init_server_socket()
+    Thread(target=server.serv_forever, daemon=True).start()
+    return server._sock.getsockname()[1]
+
+
+@unittest.skipUnless(platform.platform().startswith('Linux'), '只有linux使用epoll模式')
+class EpollServerTest(TestCase):
+    """在线程中运行epoll模式的服务器，用原始的socket流水线发送请求
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._port = _start_server(ServerStatus('127.0.0.1', 0, 100, 'mingmq', 'mm5201314', 1))
+
+    def setUp(self):
+        self._sock = socket.create_connection(('127.0.0.1', self._port))
+        self._sock.settimeout(5)
+        self.assertEqual(self._request(ReqLoginMessage('mingmq', 'mm5201314'))['status'], SUCCESS)
+
+    def tearDown(self):
+        self._sock.close()
+
+    def _send(self, *msgs):
+        data = b''
+        for msg in msgs:
+            pkg = json.dumps(msg).encode()
+            data += struct.pack('!i', len(pkg)) + pkg
+        self._sock.sendall(data)
+
+    def _recv_exactly(self, size):
+        buf = b''
+        while len(buf) < size:
+            chunk = self._sock.recv(size - len(buf))
+            self.assertTrue(chunk)
+            buf += chunk
+        return buf
+
+    def _response(self):
+        size, = struct.unpack('!i', self._recv_exactly(4))
+        return json.loads(self._recv_exactly(size))
+
+    def _request(self, msg):
+        self._send(msg)
+        return self._response()
+
+    def test_pipelined_long_poll(self):
+        self._request(ReqDeclareQueueMessage('pipelined'))
+        start = time.monotonic()
+        # 长轮询的请求超时之前，后面的PING不能先响应
+        self._send(ReqGetDataFromQueueMessage('pipelined', 0.3), ReqPingMessage())
+        res = self._response()
+        self.assertEqual(res, {'type': MESSAGE_TYPE['GET_DATA_FROM_QUEUE'], 'status': FAIL, 'json_obj': [None]})
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        self.assertEqual(self._response()['type'], MESSAGE_TYPE['PING'])
+
+        # 两个长轮询的请求都会响应，顺序不变
+        self._send(ReqGetDataFromQueueMessage('pipelined', 5), ReqGetDataFromQueueMessage('pipelined', 5),
+                   ReqPingMessage())
+        producer = socket.create_connection(('127.0.0.1', self._port))
+        try:
+            for msg in (ReqLoginMessage('mingmq', 'mm5201314'), ReqSendDataToQueueMessage('pipelined', 'a'),
+                        ReqSendDataToQueueMessage('pipelined', 'b')):
+                pkg = json.dumps(msg).encode()
+                producer.sendall(struct.pack('!i', len(pkg)) + pkg)
+                size, = struct.unpack('!i', producer.recv(4))
+                producer.recv(size)
+        finally:
+            producer.close()
+
+        self.assertEqual([self._response()['json_obj'][0]['message_data'] for _ in range(2)], ['a', 'b'])
+        self.assertEqual(self._response()['type'], MESSAGE_TYPE['PING'])
+
+
+@unittest.skipUnless(platform.platform().startswith('Linux'), '只有linux使用epoll模式')
+class IdleTimeoutTest(TestCase):
+    def test_idle_timeout(self):
+        # epoll的等待时间是默认的10秒，空闲的连接也要在IDLE_TIMEOUT之后一个tick之内断开
+        port = _start_server(ServerStatus('127.0.0.1', 0, 100, 'mingmq', 'mm5201314', 10, idle_timeout=1))
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.settimeout(5)
+        try:
+            start = time.monotonic()
+            self.assertEqual(sock.recv(1), b'')
+            self.assertLess(time.monotonic() - start, 2.5)
+        finally:
+            sock.close()
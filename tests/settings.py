@@ -2,6 +2,7 @@ IP = 'localhost'
 PORT = 15673
 USER = 'mingmq'
 PASSWD = 'mm5201314'
+UNIX_SOCKET = 'unix:///tmp/mingmq.sock'
 
 HTML = ''
 BUG0 = ''
@@ -0,0 +1,210 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mingmq.bloom import UniqueMemory
+from mingmq.codec import encode_record, iter_records
+from mingmq.exchange import ExchangeMemory
+from mingmq.memory import QueueMemory, TaskAckMemory
+from mingmq.message import Task
+from mingmq.snapshot import Checkpointer, has_checkpoint
+
+
+class CodecTest(TestCase):
+    def test_round_trip(self):
+        buf = encode_record(3, 'q', 'task_id:1', '你好') + encode_record(255, 7, 1.5, None, b'\x00')
+        records = [(op, fields) for op, fields, _ in iter_records(buf)]
+        self.assertEqual(records, [(3, ('q', 'task_id:1', '你好')), (255, (7, 1.5, None, b'\x00'))])
+
+    def test_truncated_tail(self):
+        buf = encode_record(0, 'a') + encode_record(0, 'b')[:-1]
+        self.assertEqual(len(list(iter_records(buf))), 1)
+
+
+class CheckpointerTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _restore(self):
+        queue_memory, task_ack_memory = QueueMemory(os.path.join(self._dir, 'lazy')), TaskAckMemory()
+        checkpointer = Checkpointer(self._dir, 3600)
+        checkpointer.restore(queue_memory, task_ack_memory)
+        return checkpointer, queue_memory, task_ack_memory
+
+    def _write(self, checkpointer, queue_memory, task_ack_memory, queue_name, message_data):
+        task = Task(message_data, 'task_id:' + message_data)
+        queue_memory.put(queue_name, task)
+        checkpointer.get_journal().put(queue_name, task)
+
+    def test_snapshot_and_journal(self):
+        self.assertFalse(has_checkpoint(self._dir))
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+
+        journal = checkpointer.get_journal()
+        queue_memory.decleare('q')
+        task_ack_memory.declare('q')
+        journal.declare('q')
+        for data in ('a', 'b', 'c'):
+            self._write(checkpointer, queue_memory, task_ack_memory, 'q', data)
+
+        task = queue_memory.get('q')
+        task_ack_memory.put('q', task['message_id'], task['message_data'], 100.0)
+        journal.get('q', task['message_id'], 100.0)
+
+        checkpointer.checkpoint(queue_memory, task_ack_memory)
+        # 快照之后的修改只在日志中
+        self._write(checkpointer, queue_memory, task_ack_memory, 'q', 'd')
+        while checkpointer._child_pid is not None:
+            checkpointer.tick(queue_memory, task_ack_memory)
+            time.sleep(0.01)
+        checkpointer.close()
+
+        self.assertTrue(has_checkpoint(self._dir))
+        self.assertEqual(sorted(os.listdir(self._dir)), ['journal.2', 'snapshot.2'])
+
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        checkpointer.close()
+
+        self.assertEqual([t['message_data'] for t in queue_memory.get_self()['q'].queue], ['b', 'c', 'd'])
+        self.assertEqual(task_ack_memory.get_self()['q'], {'task_id:a': ('a', 100.0)})
+
+    def test_requeue(self):
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        journal = checkpointer.get_journal()
+        queue_memory.decleare('q')
+        task_ack_memory.declare('q')
+        journal.declare('q')
+        for data in ('a', 'b'):
+            self._write(checkpointer, queue_memory, task_ack_memory, 'q', data)
+
+        task = queue_memory.get('q')
+        task_ack_memory.put('q', task['message_id'], task['message_data'], 100.0)
+        journal.get('q', task['message_id'], 100.0)
+        # 连接断开，'a'放回队列头部
+        task_ack_memory.pop_message('q', task['message_id'])
+        journal.ack('q', task['message_id'])
+        requeued = Task('a', 'task_id:a2')
+        queue_memory.put_front('q', requeued)
+        journal.requeue('q', requeued)
+        checkpointer.close()
+
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        checkpointer.close()
+
+        self.assertEqual([t['message_id'] for t in queue_memory.get_self()['q'].queue], ['task_id:a2', 'task_id:b'])
+        self.assertEqual(task_ack_memory.get_self()['q'], {})
+
+    def test_delivery_rate(self):
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        journal = checkpointer.get_journal()
+        for queue_name in ('q1', 'q2'):
+            queue_memory.decleare(queue_name)
+            task_ack_memory.declare(queue_name)
+            journal.declare(queue_name)
+        queue_memory.set_delivery_rate('q1', 5, 2)
+        journal.set_delivery_rate('q1', 5, 2)
+
+        checkpointer.checkpoint(queue_memory, task_ack_memory)
+        # 快照之后的修改只在日志中
+        queue_memory.set_delivery_rate('q2', 0.5, 1)
+        journal.set_delivery_rate('q2', 0.5, 1)
+        while checkpointer._child_pid is not None:
+            checkpointer.tick(queue_memory, task_ack_memory)
+            time.sleep(0.01)
+        checkpointer.close()
+
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        checkpointer.close()
+
+        self.assertEqual(queue_memory.get_delivery_rate('q1'), (5, 2))
+        self.assertEqual(queue_memory.get_delivery_rate('q2'), (0.5, 1))
+
+    def test_exchanges(self):
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        exchange_memory = ExchangeMemory()
+        journal = checkpointer.get_journal()
+
+        exchange_memory.declare('e1', 'topic')
+        journal.declare_exchange('e1', 'topic')
+        exchange_memory.bind('e1', 'q', 'a.#')
+        journal.bind('e1', 'q', 'a.#')
+
+        checkpointer.checkpoint(queue_memory, task_ack_memory, exchange_memory)
+        exchange_memory.declare('e2', 'fanout')
+        journal.declare_exchange('e2', 'fanout')
+        journal.bind('e2', 'q', '')
+        journal.unbind('e2', 'q', '')
+        while checkpointer._child_pid is not None:
+            checkpointer.tick(queue_memory, task_ack_memory, exchange_memory)
+            time.sleep(0.01)
+        checkpointer.close()
+
+        exchange_memory = ExchangeMemory()
+        checkpointer = Checkpointer(self._dir, 3600)
+        checkpointer.restore(QueueMemory(), TaskAckMemory(), exchange_memory)
+        checkpointer.close()
+
+        self.assertEqual(exchange_memory.get_stat(), {'e1': ['topic', 1], 'e2': ['fanout', 0]})
+        self.assertEqual(exchange_memory.route('e1', 'a.b.c'), ['q'])
+
+    def test_unique(self):
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        unique_memory = UniqueMemory()
+        journal = checkpointer.get_journal()
+
+        for queue_name in ('q', 'deleted'):
+            unique_memory.declare(queue_name, 10, 0.01)
+            journal.declare_unique(queue_name, 10, 0.01)
+        for i in range(25):
+            unique_memory.add('q', str(i))
+            journal.unique_add('q', str(i))
+
+        checkpointer.checkpoint(queue_memory, task_ack_memory, None, unique_memory)
+        unique_memory.add('q', 'after')
+        journal.unique_add('q', 'after')
+        journal.delete('deleted')
+        while checkpointer._child_pid is not None:
+            checkpointer.tick(queue_memory, task_ack_memory, None, unique_memory)
+            time.sleep(0.01)
+        checkpointer.close()
+
+        unique_memory = UniqueMemory()
+        checkpointer = Checkpointer(self._dir, 3600)
+        checkpointer.restore(QueueMemory(), TaskAckMemory(), None, unique_memory)
+        checkpointer.close()
+
+        self.assertEqual(list(unique_memory.get_self()), ['q'])
+        self.assertEqual(unique_memory.get_stat()['q'][0], 26)
+        self.assertFalse(any(unique_memory.add('q', str(i)) for i in range(25)))
+        self.assertFalse(unique_memory.add('q', 'after'))
+
+    def test_lazy(self):
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        journal = checkpointer.get_journal()
+        queue_memory.declare_lazy('lazy', 2)
+        task_ack_memory.declare('lazy')
+        journal.declare_lazy('lazy', 2)
+        for data in ('a', 'b', 'c'):
+            self._write(checkpointer, queue_memory, task_ack_memory, 'lazy', data)
+
+        checkpointer.checkpoint(queue_memory, task_ack_memory)
+        self._write(checkpointer, queue_memory, task_ack_memory, 'lazy', 'd')
+        while checkpointer._child_pid is not None:
+            checkpointer.tick(queue_memory, task_ack_memory)
+            time.sleep(0.01)
+        checkpointer.close()
+        queue_memory.delete('lazy')
+
+        checkpointer, queue_memory, task_ack_memory = self._restore()
+        checkpointer.close()
+
+        queue = queue_memory.get_self()['lazy']
+        self.assertEqual(queue.head_bytes, 2)
+        self.assertEqual(queue.get_spilled(), 2)
+        self.assertEqual([t['message_data'] for t in queue.queue], ['a', 'b', 'c', 'd'])
+        queue_memory.delete('lazy')
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from mingmq.timer import TimingWheel
+
+
+class TimingWheelTest(TestCase):
+    def test_advance(self):
+        wheel = TimingWheel(tick=1, slots=8, now=0)
+        wheel.add('a', 3)
+        wheel.add('b', 3.5)
+        wheel.add('c', 11)  # 超过一圈，和'a'在同一个槽
+        wheel.add('d', 0)  # 已经过期的最早在下一个tick到期
+
+        self.assertEqual(wheel.advance(0.5), [])
+        self.assertEqual(wheel.advance(1), ['d'])
+        self.assertEqual(sorted(wheel.advance(3)), ['a', 'b'])
+        self.assertEqual(wheel.advance(10), [])
+        self.assertEqual(wheel.advance(11), ['c'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_add_and_remove(self):
+        wheel = TimingWheel(tick=1, slots=8, now=0)
+        wheel.add('a', 2)
+        wheel.add('a', 5)  # 重新设置
+        wheel.add('b', 2)
+        wheel.remove('b')
+        wheel.remove('nothing')
+
+        self.assertEqual(wheel.advance(4), [])
+        self.assertIn('a', wheel)
+        self.assertEqual(wheel.advance(5), ['a'])
+        self.assertNotIn('a', wheel)
+
+    def test_long_pause(self):
+        wheel = TimingWheel(tick=1, slots=4, now=0)
+        for i in range(20):
+            wheel.add(i, i + 1)
+        # 超过几圈没有转动，到期的一次全部返回，没到期的留下
+        self.assertEqual(sorted(wheel.advance(15)), list(range(15)))
+        self.assertEqual(sorted(wheel.advance(100)), list(range(15, 20)))
+
+    def test_next_time(self):
+        wheel = TimingWheel(tick=1, slots=4, now=0)
+        self.assertIsNone(wheel.next_time())
+        wheel.add('a', 10)  # 超过一圈
+        self.assertEqual(wheel.next_time(), 10)
+        wheel.add('b', 6)  # 和'a'在同一个槽
+        self.assertEqual(wheel.next_time(), 6)
+        wheel.add('c', 3)
+        self.assertEqual(wheel.next_time(), 3)
+        wheel.remove('c')
+        self.assertEqual(wheel.next_time(), 6)
+        self.assertEqual(wheel.advance(6), ['b'])
+        self.assertEqual(wheel.next_time(), 10)
+        wheel.advance(10)
+        self.assertIsNone(wheel.next_time())
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+from unittest import TestCase
+
+from mingmq.async_client import AsyncClient
+from mingmq.client import Client, Pool
+from mingmq.message import SUCCESS
+
+logging.basicConfig(level=logging.ERROR)
+
+from .settings import *
+
+
+class UnixSocketTest(TestCase):
+    def test_client(self):
+        client = Client(UNIX_SOCKET, None)
+        self.assertEqual(client.login(USER, PASSWD), SUCCESS)
+        client.declare_queue('unix_socket')
+        self.assertEqual(client.send_data_to_queue('unix_socket', 'hello')['status'], SUCCESS)
+        client.close()
+
+    def test_pool(self):
+        pool = Pool(UNIX_SOCKET, None, USER, PASSWD, 2)
+        self.assertEqual(pool.opera('ping')['status'], SUCCESS)
+        pool.release()
+
+    def test_async_client(self):
+        async def ping():
+            client = AsyncClient(UNIX_SOCKET, None)
+            await client.connect()
+            await client.login(USER, PASSWD)
+            result = await client.ping()
+            await client.close()
+            return result
+
+        self.assertEqual(asyncio.run(ping())['status'], SUCCESS)
@@ -1,5 +1,8 @@
 from unittest import TestCase
-from mingmq.utils import get_size
+import os
+import tempfile
+
+from mingmq.utils import get_size, queue_dir
 from .settings import *
 
 
@@ -47,4 +50,13 @@ class VariableTest(TestCase):
         b = 1.1
 
         print('%sKB' % repr(get_size(a) / 1024))
-        print('%sKB' % repr(get_size(b) / 1024))
\ No newline at end of file
+        print('%sKB' % repr(get_size(b) / 1024))
+
+
+class QueueDirTest(TestCase):
+    def test_queue_dir(self):
+        root = tempfile.gettempdir()
+        self.assertEqual(queue_dir(root, 'a/b'), os.path.join(root, 'a%2Fb'))
+        self.assertEqual(queue_dir(root, '..a'), os.path.join(root, '..a'))
+        for queue_name in ('', '.', '..', None, 1):
+            self.assertIsNone(queue_dir(root, queue_name))